@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Same as the tests: run from the project root.
+PROJECT_PATH = os.getcwd()
+SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
+sys.path.append(SOURCE_PATH)
+os.environ.setdefault('CONFIG_PATH', os.path.join(PROJECT_PATH, 'config.yaml'))
+
+DATA_PATH = os.path.join(PROJECT_PATH, 'tests', 'data')
@@ -0,0 +1,79 @@
+"""Offline benchmarks of the reader and syncer hot paths
+
+Run from the project root: python -m benchmarks [--comments 1000] [--only reader]
+Results are printed, and written as JSON to benchmarks/results/ so runs can be compared over time.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+from benchmarks import PROJECT_PATH
+from benchmarks import batcher, database, endtoend, markdown, reader, syncer, workers
+from benchmarks.fake_lemmy import parse_fault
+
+SUITES = {'reader': reader, 'markdown': markdown, 'syncer': syncer, 'batcher': batcher, 'database': database,
+          'endtoend': endtoend, 'workers': workers}
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--comments', type=int, default=1000, help='Comments in the synthetic thread')
+    parser.add_argument('--depth', type=int, default=6, help='Deepest reply level in the synthetic thread')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark')
+    parser.add_argument('--reader', choices=list(endtoend.READERS), default='html',
+                        help='Reader backend for end-to-end runs')
+    parser.add_argument('--db-comments', type=int, default=1000000,
+                        help='Comments in the synthetic database, for database runs')
+    parser.add_argument('--posts', type=int, default=5, help='Posts in the synthetic feed, for end-to-end runs')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes sharing the database, for worker runs')
+    parser.add_argument('--lemmy-latency', type=float, default=0, help='Milliseconds the fake Lemmy takes per call')
+    parser.add_argument('--lemmy-jitter', type=float, default=0, help='Milliseconds the latency varies by, either way')
+    parser.add_argument('--lemmy-fault', type=parse_fault, action='append', default=[], metavar='STATUS=RATE',
+                        help='Share of writes the fake Lemmy fails with 429, 502 or 504, can be repeated')
+    parser.add_argument('--lemmy-drop', type=float, default=0,
+                        help='Share of writes the fake Lemmy makes, but never answers')
+    parser.add_argument('--only', action='append', choices=SUITES, help='Run only these suites')
+    parser.add_argument('--output', help='Where to write the results, defaults to benchmarks/results/<time>.json')
+    options = parser.parse_args()
+
+    started = datetime.utcnow()
+    results = []
+    for name in options.only or SUITES:
+        for result in SUITES[name].run(options):
+            result = result.as_dict()
+            results.append(result)
+            memory = f" {result['peak_memory'] / 2 ** 20:10.1f} MB peak" if 'peak_memory' in result else ''
+            print(f"{result['name']:36} {result['median'] * 1000:10.1f} ms {result['items_per_second']:12.0f} items/s"
+                  f"{memory}")
+            if 'checks' in result:
+                print(' ' * 4 + ', '.join(f'{key}={value}' for key, value in result['checks'].items()))
+
+    output = options.output or os.path.join(PROJECT_PATH, 'benchmarks', 'results',
+                                            started.strftime('%Y-%m-%dT%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({
+            'started': started.isoformat() + 'Z',
+            'commit': _commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'options': {key: value for key, value in vars(options).items() if key != 'output'},
+            'results': results,
+        }, file, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Saving new comments to a SQLite database file, one commit per row against the write batcher"""
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.harness import Result, measure
+from models.models import Base, Comment, Post
+from utils.batcher import WriteBatcher
+
+POST_ID = 1
+BATCH_SIZES = [100, 1000]
+
+
+def _database(directory: str):
+    """A session on a fresh database file, with the post the comments belong to"""
+    database = os.path.join(directory, f'leddit-{time.perf_counter_ns()}.sqlite')
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    db.add(Post(id=POST_ID, community_id=1, reddit_link='https://www.reddit.com/r/bench/comments/p1/',
+                lemmy_link='https://lem.my/post/1', created=datetime.utcnow(), updated=datetime.utcnow(),
+                author='/u/bench', enabled=1))
+    db.commit()
+    return db
+
+
+def _comments(count: int) -> List[Comment]:
+    now = datetime.utcnow()
+    return [Comment(id=number, reddit_id=f'c{number}', created=now, post_id=POST_ID, body_hash='hash')
+            for number in range(1, count + 1)]
+
+
+def run(options) -> List[Result]:
+    directory = tempfile.TemporaryDirectory()
+    sessions = []
+
+    def fresh_database():
+        sessions.append(_database(directory.name))
+        return sessions[-1], _comments(options.comments)
+
+    def commit_per_row(arguments):
+        db, comments = arguments
+        for comment in comments:
+            db.add(comment)
+            db.commit()
+
+    def batched(batch_size: int):
+        def setup():
+            db, comments = fresh_database()
+            journal = os.path.join(directory.name, f'journal-{time.perf_counter_ns()}.jsonl')
+            return WriteBatcher(db, journal, batch_size, batch_interval=60000), comments
+
+        def insert(arguments):
+            batcher, comments = arguments
+            for comment in comments:
+                batcher.add(comment)
+            batcher.flush()
+
+        return setup, insert
+
+    try:
+        results = [measure('batcher.commit_per_row', commit_per_row, fresh_database, items=options.comments,
+                           repeat=options.repeat, comments=options.comments)]
+        for batch_size in BATCH_SIZES:
+            setup, insert = batched(batch_size)
+            results.append(measure(f'batcher.batches_of_{batch_size}', insert, setup, items=options.comments,
+                                   repeat=options.repeat, comments=options.comments, batch_size=batch_size))
+        return results
+    finally:
+        for db in sessions:
+            db.close()
+        directory.cleanup()
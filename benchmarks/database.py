@@ -0,0 +1,94 @@
+"""Dedup lookups and pruning, against a synthetic SQLite database file with --db-comments comments
+
+The database is built once, with a post for every 50 comments. Every pruning run first adds 1000 aged posts with their
+comments, untimed, and then removes them again.
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import List
+from unittest import mock
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.harness import Result, measure
+from models.models import Base, Comment, CommentDTO, Post, PostDTO
+from utils import syncer as syncer_module
+from utils.syncer import Syncer
+
+COMMENTS_PER_POST = 50
+AGED_POSTS = 1000
+LOOKUPS = 2000
+_INSERT_CHUNK_SIZE = 10000
+
+
+def _post_row(post_id: int, created: datetime) -> dict:
+    return {'id': post_id, 'community_id': 1, 'reddit_link': f'https://www.reddit.com/r/bench/comments/p{post_id}/',
+            'lemmy_link': f'https://lem.my/post/{post_id}', 'created': created, 'updated': created,
+            'author': '/u/bench', 'enabled': True, 'next_update_at': created}
+
+
+def _add_posts(db, first_post: int, posts: int, created: datetime):
+    """Insert posts with COMMENTS_PER_POST comments each, a chunk at a time"""
+    db.execute(insert(Post), [_post_row(post_id, created) for post_id in range(first_post, first_post + posts)])
+    comments = ({'id': post_id * COMMENTS_PER_POST + number, 'reddit_id': f'c{post_id}x{number}',
+                 'created': created, 'post_id': post_id, 'body_hash': 'hash'}
+                for post_id in range(first_post, first_post + posts) for number in range(COMMENTS_PER_POST))
+    chunk = []
+    for comment in comments:
+        chunk.append(comment)
+        if len(chunk) >= _INSERT_CHUNK_SIZE:
+            db.execute(insert(Comment), chunk)
+            chunk = []
+    if chunk:
+        db.execute(insert(Comment), chunk)
+    db.commit()
+
+
+def _syncer(directory: str, comments: int) -> Syncer:
+    """A Syncer with a database file holding the given number of comments, and a fake Lemmy"""
+    database = os.path.join(directory, 'leddit.sqlite')
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    _add_posts(db, 1, max(comments // COMMENTS_PER_POST, 1), datetime.utcnow())
+
+    with mock.patch.object(syncer_module, 'Lemmy'), \
+            mock.patch.object(syncer_module, 'WRITE_JOURNAL', os.path.join(directory, 'journal.jsonl')):
+        return Syncer(db=db, reddit_reader=mock.Mock(), username='bench', password='bench')
+
+
+def run(options) -> List[Result]:
+    directory = tempfile.TemporaryDirectory()
+    syncer = _syncer(directory.name, options.db_comments)
+    db = syncer._db
+    try:
+        posts = max(options.db_comments // COMMENTS_PER_POST, 1)
+        params = {'db_comments': options.db_comments, 'db_posts': posts}
+        now = datetime.utcnow()
+        # Half of the lookups are of rows that exist, spread over the table
+        step = max(posts // LOOKUPS, 1)
+        comments = [CommentDTO(id=f'c{1 + (number * step) % posts}x{number % COMMENTS_PER_POST}' if number % 2
+                               else f'new{number}', created=now, author='bench', body='', parent='p', post_id='p')
+                    for number in range(LOOKUPS)]
+        links = [PostDTO(reddit_link=_post_row(1 + (number * step) % posts, now)['reddit_link'] if number % 2
+                         else f'https://www.reddit.com/r/bench/comments/new{number}/', title='Bench', created=now,
+                         updated=now, author='/u/bench') for number in range(LOOKUPS)]
+
+        def add_aged():
+            aged = now - timedelta(seconds=syncer_module.MAX_POST_AGE + 60)
+            _add_posts(db, posts + 1, AGED_POSTS, aged)
+
+        return [
+            measure('database.stored_comments', lambda _: syncer.stored_comments(comments), items=LOOKUPS,
+                    repeat=options.repeat, **params),
+            measure('database.filter_posted', lambda _: syncer.filter_posted(links), items=LOOKUPS,
+                    repeat=options.repeat, **params),
+            measure('database.clear_aged', lambda _: syncer.clear_aged(), add_aged,
+                    items=AGED_POSTS * (COMMENTS_PER_POST + 1), repeat=options.repeat, aged_posts=AGED_POSTS,
+                    **params),
+        ]
+    finally:
+        db.close()
+        directory.cleanup()
@@ -0,0 +1,174 @@
+"""Full sync cycles against a fake Lemmy that also serves synthetic Reddit pages
+
+Every run scrapes new posts with part of their comments, then lets the threads grow and updates them, the way the bot
+does over a couple of rounds. Afterwards, what ended up on Lemmy is checked against the Reddit pages and the database.
+"""
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, List
+from unittest import mock
+
+from bs4 import BeautifulSoup
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.fake_lemmy import FakeLemmy
+from benchmarks.generator import SUBREDDIT, generate_feed, generate_thread, generate_thread_json, post_link
+from benchmarks.harness import measure, Result
+from models.models import Base, Comment, Post, SORT_NEW
+from reddit.json_reader import RedditJsonReader
+from reddit.reader import RedditReader
+from reddit.stream_reader import RedditStreamReader
+from utils import syncer as syncer_module
+from utils.ratelimiter import TokenBucket
+from utils.syncer import Syncer
+
+COMMUNITY = {'subreddit': SUBREDDIT, 'community': 'til', 'sort': SORT_NEW, 'post_header': '##### Benchmark'}
+# Share of the comments that are already there when a post is first scraped
+FIRST_ROUND = 0.8
+_COMMENT_MARKER = re.compile(r'ID: `(\w+)`')
+_POST_MARKER = re.compile(r'\[The original]\(https://old\.reddit\.com/r/\w+/comments/(\w+)/')
+_POST_LINK = re.compile(r'/comments/(\w+)/')
+READERS = {'html': RedditReader, 'json': RedditJsonReader, 'stream': RedditStreamReader}
+
+
+def reddit_pages(post_ids: List[str], comments: int, depth: int) -> Dict[str, str]:
+    """Reddit's feed and comment pages, as HTML and as JSON, by their path"""
+    pages = {f'/r/{SUBREDDIT}/new/.rss': generate_feed(post_ids, datetime.utcnow())}
+    for number, post_id in enumerate(post_ids):
+        path = post_link(post_id)[len('https://www.reddit.com'):]
+        pages[path] = generate_thread(comments, depth, seed=number, post_id=post_id)
+        pages[path + '.json'] = generate_thread_json(comments, depth, seed=number, post_id=post_id)
+    return pages
+
+
+def expected_parents(pages: Dict[str, str]) -> Dict[str, str]:
+    """The Reddit ID of the parent of every comment, by the comment's Reddit ID"""
+    reader = RedditReader()
+    parents = {}
+    for path, page in pages.items():
+        if not path.endswith(('.rss', '.json')):
+            for comment in reader.get_comment_details(BeautifulSoup(page, 'html.parser')):
+                parents[comment.id] = comment.parent
+    return parents
+
+
+def check(lemmy: FakeLemmy, db, parents: Dict[str, str]) -> Dict[str, int]:
+    """Compare what was posted to Lemmy with what's on Reddit and in the database
+
+    Posts and comments are recognized by the Reddit link and ID that the syncer puts in their text.
+    """
+    lemmy_posts = {}
+    duplicate_posts = 0
+    for post in lemmy.posts.values():
+        reddit_id = _POST_MARKER.search(post['body']).group(1)
+        duplicate_posts += reddit_id in lemmy_posts
+        lemmy_posts.setdefault(reddit_id, post['id'])
+
+    lemmy_comments = {}
+    reddit_ids = {}
+    duplicate_comments = 0
+    for comment in lemmy.comments.values():
+        reddit_id = _COMMENT_MARKER.search(comment['content']).group(1)
+        reddit_ids[comment['id']] = reddit_id
+        duplicate_comments += reddit_id in lemmy_comments
+        lemmy_comments.setdefault(reddit_id, comment['id'])
+
+    wrong_parents = 0
+    for comment in lemmy.comments.values():
+        expected = parents.get(reddit_ids[comment['id']])
+        actual = reddit_ids.get(comment['parent_id']) if comment['parent_id'] else None
+        # Top level comments have the post as their parent on Reddit
+        wrong_parents += actual != (expected if expected in parents else None)
+
+    wrong_post_rows = sum(lemmy_posts.get(_POST_LINK.search(reddit_link).group(1)) != post_id
+                          for post_id, reddit_link in db.query(Post.id, Post.reddit_link))
+    wrong_comment_rows = sum(lemmy_comments.get(reddit_id) != comment_id
+                             for comment_id, reddit_id in db.query(Comment.id, Comment.reddit_id))
+    return {
+        'lemmy_posts': len(lemmy.posts),
+        'lemmy_comments': len(lemmy.comments),
+        'missing_comments': len(parents.keys() - lemmy_comments.keys()),
+        'duplicate_posts': duplicate_posts,
+        'duplicate_comments': duplicate_comments,
+        'wrong_parents': wrong_parents,
+        'wrong_post_rows': wrong_post_rows,  # Saved with the Lemmy ID of another post, or one that doesn't exist
+        'wrong_comment_rows': wrong_comment_rows,
+        **{f'injected_{kind}': count for kind, count in sorted(lemmy.injected.items())},
+    }
+
+
+class _Cycle:
+    """One bot, with its own database and fake Lemmy, going through a scrape and an update round"""
+
+    def __init__(self, directory: str, options, post_ids: List[str]):
+        self.lemmy = FakeLemmy(options.lemmy_latency / 1000, options.lemmy_jitter / 1000, dict(options.lemmy_fault),
+                               options.lemmy_drop).start()
+        first_round = max(int(options.comments * FIRST_ROUND), 1)
+        self.lemmy.serve_reddit(reddit_pages(post_ids, first_round, options.depth))
+        self.final_pages = reddit_pages(post_ids, options.comments, options.depth)
+        self.crashes = 0
+
+        database = os.path.join(directory, f'leddit-{len(os.listdir(directory))}.sqlite')
+        engine = create_engine(f'sqlite:///{database}')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        reader = READERS[options.reader](TokenBucket(0))
+        self.lemmy.redirect_reddit(reader.session)
+        with mock.patch.object(syncer_module, 'LEMMY_BASE_URI', self.lemmy.url), \
+                mock.patch.object(syncer_module, 'WRITE_JOURNAL', database + '.journal'):
+            self.syncer = Syncer(db=self.db, reddit_reader=reader, username='bench', password='bench')
+
+    def run(self):
+        with mock.patch.object(syncer_module.config, 'community_map', [COMMUNITY]):
+            self._round(self.syncer.scrape_new_posts)
+            self.lemmy.serve_reddit(self.final_pages)
+            self.db.execute(update(Post).values(next_update_at=datetime.utcnow() - timedelta(seconds=1)))
+            self.db.commit()
+            self._round(self.syncer.update_comments)
+
+    def _round(self, sync):
+        # The bot doesn't survive these, but the checks should still see what was posted before
+        try:
+            sync()
+        except Exception as e:
+            logging.getLogger(__name__).warning(f'Round crashed: {type(e).__name__}: {str(e)}')
+            self.db.rollback()
+            self.crashes += 1
+
+    def close(self):
+        self.lemmy.stop()
+        self.db.close()
+
+
+def run(options) -> List[Result]:
+    post_ids = [f'zy{number:04d}' for number in range(options.posts)]
+    parents = expected_parents(reddit_pages(post_ids, options.comments, options.depth))
+    directory = tempfile.TemporaryDirectory()
+    cycles = []
+
+    def setup() -> _Cycle:
+        cycles.append(_Cycle(directory.name, options, post_ids))
+        return cycles[-1]
+
+    # Keep the fake servers and the syncer's own logging out of the benchmark output
+    logging.getLogger('pythorhead').setLevel(logging.CRITICAL)
+    logging.getLogger(syncer_module.__name__).setLevel(logging.CRITICAL)
+    try:
+        result = measure('endtoend.sync_cycle', lambda cycle: cycle.run(), setup,
+                         items=options.posts + len(parents), repeat=options.repeat, posts=options.posts,
+                         comments=options.comments, depth=options.depth, reader=options.reader,
+                         lemmy_latency=options.lemmy_latency, lemmy_jitter=options.lemmy_jitter,
+                         lemmy_faults=dict(options.lemmy_fault), lemmy_drop=options.lemmy_drop,
+                         fetch_workers=syncer_module.FETCH_WORKERS,
+                         comment_workers=syncer_module.COMMENT_WORKERS)
+        last = cycles[-1]
+        result.checks = {**check(last.lemmy, last.db, parents), 'crashed_rounds': last.crashes}
+        return [result]
+    finally:
+        for cycle in cycles:
+            cycle.close()
+        directory.cleanup()
@@ -0,0 +1,341 @@
+"""A stand-in for a Lemmy instance, and optionally Reddit, to run the syncer against without touching either
+
+Implements the endpoints pythorhead uses for the syncer: nodeinfo, login, community discovery, creating and editing
+posts and comments, and listing the newest posts of a community or comments on a post. Writes can be slowed down and made to fail the way they do behind a busy reverse proxy:
+
+- 429 and 502 are returned before anything is written
+- 504 is returned after the post or comment has been created, like a proxy giving up on a slow Lemmy
+- a dropped response also creates the post or comment, but closes the connection without answering
+
+Run it on its own, and point lemmy_base_uri at it:
+python -m benchmarks.fake_lemmy --port 8536 --latency 50 --jitter 20 --fault 504=0.02 --drop 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API = '/api/v3'
+TOKEN = 'fake-lemmy-jwt'
+_REDDIT_HOSTS = ('https://www.reddit.com', 'https://old.reddit.com')
+
+
+class FakeLemmy:
+    """Lemmy's API in memory, served over HTTP on a local port
+
+    Posts and comments are kept as the JSON they were created with, by their ID, so a run can be checked afterwards.
+    Reddit pages given to serve_reddit() are served as well, for a RedditReader that was passed to redirect_reddit().
+    """
+
+    def __init__(self, latency: float = 0, jitter: float = 0, faults: Optional[Dict[int, float]] = None,
+                 drop_rate: float = 0, seed: int = 0, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency  # Seconds every API call takes
+        self.jitter = jitter  # Seconds the latency varies by, either way
+        self.faults = faults or {}  # Share of writes that fail with each status code
+        self.drop_rate = drop_rate  # Share of writes that are made, but never answered
+        self.posts: Dict[int, dict] = {}
+        self.comments: Dict[int, dict] = {}
+        self.communities: Dict[str, int] = {}
+        self.requests = Counter()  # Handled requests, by endpoint
+        self.injected = Counter()  # Injected failures, by kind
+        self._pages: Dict[str, str] = {}
+        self._post_ids = itertools.count(1)
+        self._comment_ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.lemmy = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeLemmy':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-lemmy', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeLemmy':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def serve_reddit(self, pages: Dict[str, str]):
+        """Serve saved Reddit pages and feeds, by their path on reddit.com. Replaces any pages served before"""
+        with self._lock:
+            self._pages = dict(pages)
+
+    def redirect_reddit(self, session: requests.Session):
+        """Send the requests a session makes to Reddit to this server instead"""
+        redirect_reddit(session, self.url)
+
+    def page(self, path: str) -> Optional[str]:
+        with self._lock:
+            return self._pages.get(path)
+
+    def count(self, counter: Counter, key: str):
+        with self._lock:
+            counter[key] += 1
+
+    def delay(self):
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def pick_fault(self) -> Optional[str]:
+        """Decide how a write fails: a status code, 'drop', or None to succeed"""
+        with self._lock:
+            roll = self._random.random()
+        for status, rate in self.faults.items():
+            if roll < rate:
+                return str(status)
+            roll -= rate
+        return 'drop' if roll < self.drop_rate else None
+
+    def community(self, name: str) -> int:
+        with self._lock:
+            return self.communities.setdefault(name, len(self.communities) + 1)
+
+    def create_post(self, data: dict) -> dict:
+        with self._lock:
+            post_id = next(self._post_ids)
+            post = {'id': post_id, 'name': data['name'], 'body': data.get('body'), 'url': data.get('url'),
+                    'community_id': data['community_id'], 'nsfw': data.get('nsfw', False),
+                    'ap_id': f'{self.url}/post/{post_id}'}
+            self.posts[post_id] = post
+        return {'post_view': {'post': post}}
+
+    def create_comment(self, data: dict) -> Optional[dict]:
+        """Create a comment, or return None if the post or the parent doesn't exist"""
+        with self._lock:
+            parent_id = data.get('parent_id')
+            parent = self.comments.get(parent_id) if parent_id is not None else None
+            if data['post_id'] not in self.posts or (parent_id is not None and
+                                                     (parent is None or parent['post_id'] != data['post_id'])):
+                return None
+            comment_id = next(self._comment_ids)
+            comment = {'id': comment_id, 'content': data['content'], 'post_id': data['post_id'],
+                       'parent_id': parent_id, 'path': (parent['path'] if parent else '0') + f'.{comment_id}',
+                       'ap_id': f'{self.url}/comment/{comment_id}'}
+            self.comments[comment_id] = comment
+        return {'comment_view': {'comment': comment}}
+
+    def edit(self, kind: str, data: dict) -> Optional[dict]:
+        """Change the body of a post or comment, or return None if it doesn't exist"""
+        items, field = (self.posts, 'body') if kind == 'post' else (self.comments, 'content')
+        with self._lock:
+            item = items.get(data.get(f'{kind}_id'))
+            if item is None:
+                return None
+            if field in data:
+                item[field] = data[field]
+        return {f'{kind}_view': {kind: item}}
+
+    def list_posts(self, community_id: int, page: int, limit: int) -> List[dict]:
+        """A page of the newest posts of a community, as post views"""
+        with self._lock:
+            posts = [post for post in self.posts.values() if post['community_id'] == community_id]
+        return [{'post': post} for post in _page(posts, page, limit)]
+
+    def list_comments(self, post_id: int, page: int, limit: int) -> List[dict]:
+        """A page of the newest comments on a post, as comment views"""
+        with self._lock:
+            comments = [comment for comment in self.comments.values() if comment['post_id'] == post_id]
+        return [{'comment': comment} for comment in _page(comments, page, limit)]
+
+
+def _page(items: List[dict], page: int, limit: int) -> List[dict]:
+    """Newest first, the way Lemmy sorts by New. Lemmy lists at most 50 items at a time"""
+    limit = min(limit, 50)
+    return sorted(items, key=lambda item: item['id'], reverse=True)[(page - 1) * limit:page * limit]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which on a reused connection would wait for a delayed ACK every time
+    disable_nagle_algorithm = True
+    server: ThreadingHTTPServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body, content_type: str = 'application/json', headers: Optional[dict] = None):
+        data = (json.dumps(body) if content_type == 'application/json' else body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, error: str):
+        self._send(status, {'error': error})
+
+    def do_GET(self):
+        lemmy: FakeLemmy = self.server.lemmy
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/nodeinfo/2.0.json':
+            self._send(200, {'version': '2.0', 'software': {'name': 'lemmy', 'version': '0.18.0'}})
+        elif url.path == f'{API}/community':
+            lemmy.count(lemmy.requests, 'community')
+            lemmy.delay()
+            if 'name' not in query:
+                return self._error(400, 'couldnt_find_community')
+            community_id = lemmy.community(query['name'])
+            self._send(200, {'community_view': {'community': {'id': community_id, 'name': query['name']}}})
+        elif url.path in (f'{API}/post/list', f'{API}/comment/list'):
+            endpoint = url.path[len(API) + 1:]
+            lemmy.count(lemmy.requests, endpoint)
+            lemmy.delay()
+            page, limit = int(query.get('page', 1)), int(query.get('limit', 10))
+            if endpoint == 'post/list':
+                self._send(200, {'posts': lemmy.list_posts(int(query.get('community_id', 0)), page, limit)})
+            else:
+                self._send(200, {'comments': lemmy.list_comments(int(query.get('post_id', 0)), page, limit)})
+        elif (page := lemmy.page(url.path)) is not None:
+            lemmy.count(lemmy.requests, 'reddit')
+            content_type = {'.rss': 'application/atom+xml', '.json': 'application/json'}.get(
+                url.path[url.path.rfind('.'):], 'text/html')
+            self._send(200, page, f'{content_type}; charset=UTF-8')
+        else:
+            self._error(404, 'not_found')
+
+    def do_POST(self):
+        lemmy: FakeLemmy = self.server.lemmy
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._error(400, 'invalid_json')
+
+        if self.path == f'{API}/user/login':
+            lemmy.count(lemmy.requests, 'login')
+            lemmy.delay()
+            return self._send(200, {'jwt': TOKEN})
+        if self.path not in (f'{API}/post', f'{API}/comment'):
+            return self._error(404, 'not_found')
+
+        endpoint = self.path[len(API) + 1:]
+        lemmy.count(lemmy.requests, endpoint)
+        lemmy.delay()
+        if data.get('auth') != TOKEN:
+            return self._error(400, 'not_logged_in')
+
+        fault = lemmy.pick_fault()
+        if fault:
+            lemmy.count(lemmy.injected, fault)
+        if fault == '429':
+            return self._send(429, {'error': 'rate_limit_error'}, headers={'Retry-After': '1'})
+        if fault == '502':
+            return self._send(502, '<html><body><h1>502 Bad Gateway</h1></body></html>', 'text/html')
+
+        if endpoint == 'post':
+            response = lemmy.create_post(data)
+        else:
+            response = lemmy.create_comment(data)
+            if response is None:
+                return self._error(400, 'couldnt_create_comment')
+
+        if fault == '504':
+            self._send(504, '<html><body><h1>504 Gateway Time-out</h1></body></html>', 'text/html')
+        elif fault == 'drop':
+            self.close_connection = True
+        else:
+            self._send(200, response)
+
+    def do_PUT(self):
+        lemmy: FakeLemmy = self.server.lemmy
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._error(400, 'invalid_json')
+        if self.path not in (f'{API}/post', f'{API}/comment'):
+            return self._error(404, 'not_found')
+
+        kind = self.path[len(API) + 1:]
+        lemmy.count(lemmy.requests, f'{kind}/edit')
+        lemmy.delay()
+        if data.get('auth') != TOKEN:
+            return self._error(400, 'not_logged_in')
+        response = lemmy.edit(kind, data)
+        if response is None:
+            return self._error(400, f'couldnt_update_{kind}')
+        self._send(200, response)
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Rewrites requests to Reddit so they go to a local server"""
+
+    def __init__(self, base_url: str):
+        super().__init__()
+        self._base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = self._base_url + url.path + (f'?{url.query}' if url.query else '')
+        return super().send(request, **kwargs)
+
+
+def redirect_reddit(session: requests.Session, url: str):
+    """Send the requests a session makes to Reddit to the fake Lemmy at url, like from another process"""
+    adapter = _RedirectAdapter(url)
+    for host in _REDDIT_HOSTS:
+        session.mount(host, adapter)
+
+
+def parse_fault(value: str):
+    """Parse a STATUS=RATE command line option"""
+    status, _, rate = value.partition('=')
+    return int(status), float(rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8536)
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds every API call takes')
+    parser.add_argument('--jitter', type=float, default=0, help='Milliseconds the latency varies by, either way')
+    parser.add_argument('--fault', type=parse_fault, action='append', default=[], metavar='STATUS=RATE',
+                        help='Share of writes that fail with 429, 502 or 504, can be repeated')
+    parser.add_argument('--drop', type=float, default=0, help='Share of writes that are made, but never answered')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    lemmy = FakeLemmy(options.latency / 1000, options.jitter / 1000, dict(options.fault), options.drop, options.seed,
+                      options.host, options.port)
+    print(f'Fake Lemmy listening on {lemmy.url}')
+    try:
+        lemmy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f'{len(lemmy.posts)} posts and {len(lemmy.comments)} comments created, requests: {dict(lemmy.requests)}, '
+          f'injected failures: {dict(lemmy.injected)}')
+
+
+if __name__ == '__main__':
+    main()
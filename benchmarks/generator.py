@@ -0,0 +1,184 @@
+"""Synthetic old-reddit pages, shaped like the ones the reader parses"""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from html import escape
+from typing import List, Optional, Tuple
+
+POST_ID = 'zz0001'
+SUBREDDIT = 'todayilearned'
+CREATED = datetime(2023, 6, 17, 19, 22, 37)
+
+_AUTHORS = ['alice', 'Flares117', 'carol_', 'dave', 'erin', 'frank_the_tank', 'grace', 'heidi']
+# The markdown of a body, and the HTML Reddit renders it to
+_BODIES = [
+    ('Six hundred servants?', '<p>Six hundred servants?</p>\n'),
+    ('It was *also* built on **waqf** land.', '<p>It was <em>also</em> built on <strong>waqf</strong> land.</p>\n'),
+    ('Source: [the wiki](/r/todayilearned/wiki/rules) and [Mumbai](https://en.wikipedia.org/wiki/Mumbai).',
+     '<p>Source: <a href="/r/todayilearned/wiki/rules">the wiki</a> and '
+     '<a href="https://en.wikipedia.org/wiki/Mumbai">Mumbai</a>.</p>\n'),
+    ('> most expensive private residences\n\nCitation needed.',
+     '<blockquote>\n<p>most expensive private residences</p>\n</blockquote>\n\n<p>Citation needed.</p>\n'),
+    ('Reasons:\n\n* location\n* size, *27 floors*\n* staff',
+     '<p>Reasons:</p>\n\n<ul>\n<li>location</li>\n<li>size, <em>27 floors</em></li>\n<li>staff</li>\n</ul>\n'),
+    ('Code: `print(1)`\n\n    for floor in range(27):\n        visit(floor)',
+     '<p>Code: <code>print(1)</code></p>\n\n<pre><code>for floor in range(27):\n    visit(floor)\n</code></pre>\n'),
+    ('&#x200B;\n\nIt has a snow\\_room and an ice cream parlour. E = mc^2',
+     '<p>&#x200B;</p>\n\n<p>It has a snow_room and an ice cream parlour. E = mc<sup>2</sup></p>\n'),
+    ('Home|Price\n:--|:--\nAntilia|$2 billion',
+     '<table><thead>\n<tr>\n<th>Home</th>\n<th>Price</th>\n</tr>\n</thead><tbody>\n<tr>\n<td>Antilia</td>\n'
+     '<td>$2 billion</td>\n</tr>\n</tbody></table>\n'),
+]
+_TITLE = 'TIL: Antilia is one of the most expensive private residences in the world'
+
+
+def post_link(post_id: str) -> str:
+    return f'https://www.reddit.com/r/{SUBREDDIT}/comments/{post_id}/til_synthetic_thread/'
+
+
+POST_LINK = post_link(POST_ID)
+
+
+def _comment_id(post_id: str, number: int) -> str:
+    # Unique across posts, like Reddit's own IDs
+    return f'{post_id}k{number:05x}'
+
+
+def _comment_fields(seed: int, number: int) -> Tuple[datetime, Optional[str], Tuple[str, str]]:
+    """The time, author and body of a comment, or no author for deleted comments"""
+    # Every comment gets its own generator, so it looks the same in a larger version of the thread
+    rng = random.Random(f'{seed}-{number}')
+    created = CREATED + timedelta(minutes=number)
+    if rng.random() < 0.02:
+        return created, None, ('[deleted]', '<p>[deleted]</p>\n')
+    return created, rng.choice(_AUTHORS), rng.choice(_BODIES)
+
+
+def _comment(seed: int, post_id: str, number: int, replies: str) -> str:
+    comment_id = _comment_id(post_id, number)
+    link = post_link(post_id)
+    created, name, (_, body) = _comment_fields(seed, number)
+    if name is None:
+        author = '<em>[deleted]</em>'
+    else:
+        author = f'<a href="https://old.reddit.com/user/{name}" class="author may-blank id-t2_{name}" >{name}</a>' \
+                 f'<span class="userattrs"></span>'
+    return (
+        f'<div class=" thing id-t1_{comment_id} noncollapsed   comment " id="thing_t1_{comment_id}" '
+        f'data-fullname="t1_{comment_id}" data-type="comment" ><p class="parent"><a name="{comment_id}" ></a></p>'
+        f'<div class="midcol unvoted" ><div class="arrow up login-required access-required" role="button" '
+        f'aria-label="upvote" tabindex="0" ></div><div class="arrow down login-required access-required" '
+        f'role="button" aria-label="downvote" tabindex="0" ></div></div><div class="entry unvoted">'
+        f'<p class="tagline"><a href="javascript:void(0)" class="expand" onclick="return togglecomment(this)">'
+        f'[&ndash;]</a>{author} <span class="score unvoted" title="12">12 points</span>&#32;'
+        f'<time title="{created.isoformat()}+00:00" datetime="{created.isoformat()}+00:00" class="live-timestamp">'
+        f'2 hours ago</time></p><form action="#" class="usertext warn-on-unload" '
+        f'onsubmit="return post_form(this, \'editusertext\')" id="form-t1_{comment_id}f3a">'
+        f'<input type="hidden" name="thing_id" value="t1_{comment_id}"/>'
+        f'<div class="usertext-body may-blank-within md-container " ><div class="md">{body}</div>\n</div></form>'
+        f'<ul class="flat-list buttons"><li class="first"><a href="{link}{comment_id}/" '
+        f'data-event-action="permalink" class="bylink" rel="nofollow" >permalink</a></li></ul></div>'
+        f'<div class="child" >{replies}</div><div class="clearleft"></div></div><div class="clearleft"></div>'
+    )
+
+
+def _replies(comments: int, depth: int, seed: int) -> List[List[int]]:
+    """Pick a parent for every comment. Returns the replies to every comment, where comment 0 is the post"""
+    rng = random.Random(seed)
+    children: List[List[int]] = [[] for _ in range(comments + 1)]
+    depths = [0]
+    for number in range(1, comments + 1):
+        candidates = [0] + [rng.randrange(1, number) for _ in range(3) if number > 1]
+        parent = rng.choice([candidate for candidate in candidates if depths[candidate] < depth])
+        children[parent].append(number)
+        depths.append(depths[parent] + 1)
+    return children
+
+
+def generate_thread(comments: int = 1000, depth: int = 6, seed: int = 0, post_id: str = POST_ID) -> str:
+    """Build a comment page for a post with the given number of comments, nested up to the given depth
+
+    Every comment replies to a random earlier comment that isn't nested too deep yet, or to the post itself. About
+    one in fifty comments is deleted. With the same seed, a thread with more comments has the same comments and
+    replies as a smaller one, plus some new ones, like the page of a post that got more replies over time.
+    """
+    link = post_link(post_id)
+    children = _replies(comments, depth, seed)
+
+    def render(parent: int, sitetable_id: Optional[str], css_class: str) -> str:
+        if not children[parent]:
+            return ''
+        things = ''.join(_comment(seed, post_id, number,
+                                  render(number, f'siteTable_t1_{_comment_id(post_id, number)}', 'listing'))
+                         for number in children[parent])
+        return f'<div id="{sitetable_id}" class="sitetable {css_class}">{things}</div>'
+
+    title = _TITLE
+    return (
+        f'<!doctype html><html xmlns="http://www.w3.org/1999/xhtml" lang="en" xml:lang="en"><head>'
+        f'<title>{escape(title)} : {SUBREDDIT}</title></head>'
+        f'<body class="listing-page comments-page single-page" ><div class="content" role="main">'
+        f'<div id="siteTable" class="sitetable linklisting"><div class=" thing id-t3_{post_id} odd&#32; link self" '
+        f'id="thing_t3_{post_id}" data-fullname="t3_{post_id}" data-type="link" data-author="Flares117" '
+        f'data-subreddit="todayilearned" data-timestamp="{int(CREATED.timestamp() * 1000)}" '
+        f'data-url="/r/todayilearned/comments/{post_id}/til_synthetic_thread/" data-domain="self.todayilearned" '
+        f'data-comments-count="{comments}" data-nsfw="false" data-spoiler="false" ><p class="parent"></p>'
+        f'<div class="entry unvoted"><div class="top-matter"><p class="title"><a class="title may-blank" '
+        f'href="{link}">{escape(title)}</a></p></div><div class="expando" ><form action="#" class="usertext">'
+        f'<div class="usertext-body may-blank-within md-container " ><div class="md">{_BODIES[4][1]}</div></div>'
+        f'</form></div></div><div class="child" ></div><div class="clearleft"></div></div>'
+        f'<div class="clearleft"></div></div><div class=\'commentarea\' >'
+        f'{render(0, f"siteTable_t3_{post_id}", "nestedlisting")}</div></div></body></html>'
+    )
+
+
+def generate_thread_json(comments: int = 1000, depth: int = 6, seed: int = 0, post_id: str = POST_ID) -> str:
+    """Build the JSON representation of the same thread as generate_thread(), as Reddit serves it with raw_json=1"""
+    children = _replies(comments, depth, seed)
+
+    def listing(things: List[dict]) -> dict:
+        return {'kind': 'Listing', 'data': {'after': None, 'dist': None, 'children': things, 'before': None}}
+
+    def render(parent: int) -> List[dict]:
+        things = []
+        for number in children[parent]:
+            created, name, (markdown, html) = _comment_fields(seed, number)
+            replies = render(number)
+            things.append({'kind': 't1', 'data': {
+                'id': _comment_id(post_id, number), 'name': f't1_{_comment_id(post_id, number)}',
+                'parent_id': f't1_{_comment_id(post_id, parent)}' if parent else f't3_{post_id}',
+                'link_id': f't3_{post_id}', 'author': name or '[deleted]', 'body': markdown,
+                'body_html': f'<div class="md">{html}</div>', 'score': 12,
+                'created_utc': created.replace(tzinfo=timezone.utc).timestamp(),
+                'replies': listing(replies) if replies else '',
+            }})
+        return things
+
+    body_markdown, body_html = _BODIES[4]
+    post = {'kind': 't3', 'data': {
+        'id': post_id, 'name': f't3_{post_id}', 'subreddit': SUBREDDIT, 'title': _TITLE, 'author': 'Flares117',
+        'selftext': body_markdown, 'selftext_html': f'<!-- SC_OFF --><div class="md">{body_html}</div><!-- SC_ON -->',
+        'is_self': True, 'over_18': False, 'num_comments': comments, 'url': post_link(post_id),
+        'permalink': f'/r/{SUBREDDIT}/comments/{post_id}/til_synthetic_thread/',
+        'created_utc': CREATED.replace(tzinfo=timezone.utc).timestamp(),
+    }}
+    return json.dumps([listing([post]), listing(render(0))])
+
+
+def generate_feed(post_ids: List[str], newest: datetime) -> str:
+    """Build the Atom feed of the newest posts of the subreddit, one a minute, newest first"""
+    entries = []
+    for number, post_id in enumerate(post_ids):
+        published = (newest - timedelta(minutes=number)).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        author = _AUTHORS[number % len(_AUTHORS)]
+        entries.append(
+            f'<entry><author><name>/u/{author}</name><uri>https://www.reddit.com/user/{author}</uri></author>'
+            f'<category term="{SUBREDDIT}" label="r/{SUBREDDIT}"/><id>t3_{post_id}</id>'
+            f'<link href="{post_link(post_id)}" /><updated>{published}</updated><published>{published}</published>'
+            f'<title>TIL synthetic fact number {number}</title></entry>'
+        )
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+        f'<category term="{SUBREDDIT}" label="r/{SUBREDDIT}"/><id>/r/{SUBREDDIT}/new/.rss?sort=new</id>'
+        f'<title>Today I Learned (TIL)</title>{"".join(entries)}</feed>'
+    )
@@ -0,0 +1,56 @@
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+
+@dataclass
+class Result:
+    name: str
+    items: int  # Things handled by a single run, like comments parsed
+    timings: List[float]  # Seconds per run
+    params: Dict[str, Any] = field(default_factory=dict)
+    checks: Dict[str, int] = field(default_factory=dict)  # Correctness of the outcome, for end-to-end runs
+    peak_memory: Optional[int] = None  # Most bytes allocated at once during a run, if measured
+
+    def as_dict(self) -> dict:
+        median = statistics.median(self.timings)
+        return {
+            'name': self.name,
+            'params': self.params,
+            'items': self.items,
+            'runs': len(self.timings),
+            'min': min(self.timings),
+            'median': median,
+            'mean': statistics.mean(self.timings),
+            'items_per_second': self.items / median if median else None,
+            **({'checks': self.checks} if self.checks else {}),
+            **({'peak_memory': self.peak_memory} if self.peak_memory is not None else {}),
+        }
+
+
+def measure(name: str, run: Callable[[Any], Any], setup: Optional[Callable[[], Any]] = None, items: int = 1,
+            repeat: int = 5, **params) -> Result:
+    """Time a function a number of times. setup() prepares a fresh argument for every run, and isn't timed"""
+    timings = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        run(argument)
+        timings.append(time.perf_counter() - start)
+    return Result(name=name, items=items, timings=timings, params=params)
+
+
+def peak_memory(run: Callable[[Any], Any], setup: Optional[Callable[[], Any]] = None) -> int:
+    """Measure the most memory a single run allocates at once, on top of what its argument takes
+
+    Tracing allocations slows a run down many times over, so it's done in a separate, untimed run.
+    """
+    argument = setup() if setup else None
+    tracemalloc.start()
+    try:
+        run(argument)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
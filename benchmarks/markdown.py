@@ -0,0 +1,41 @@
+"""Markdown conversion of post and comment bodies"""
+import os
+from typing import List
+
+from bs4 import BeautifulSoup
+
+from benchmarks import DATA_PATH
+from benchmarks.generator import generate_thread
+from benchmarks.harness import Result, measure
+from reddit.reader import RedditReader
+
+PAGES = ['today_i_learned.html', 'today_i_learned_thread.html', 'reddit_markdown.html']
+
+
+def _bodies(html: str) -> List[str]:
+    return [str(body) for body in BeautifulSoup(html, 'html.parser').select('.md')]
+
+
+def run(options) -> List[Result]:
+    reader = RedditReader()
+    corpus = []
+    for page in PAGES:
+        with open(os.path.join(DATA_PATH, page)) as file:
+            corpus.extend(_bodies(file.read()))
+    thread = _bodies(generate_thread(options.comments, options.depth))
+
+    def parsed(bodies: List[str]):
+        # Conversion may modify the tree, so every run gets its own
+        return lambda: [BeautifulSoup(body, 'html.parser').div for body in bodies]
+
+    def convert_all(convert):
+        return lambda trees: [convert(tree) for tree in trees]
+
+    return [
+        measure('markdown.corpus.markdownify', convert_all(reader._html_node_to_markdown_fallback), parsed(corpus),
+                items=len(corpus), repeat=options.repeat),
+        measure('markdown.corpus', convert_all(reader._html_node_to_markdown), parsed(corpus),
+                items=len(corpus), repeat=options.repeat),
+        measure('markdown.thread', convert_all(reader._html_node_to_markdown), parsed(thread),
+                items=len(thread), repeat=options.repeat, comments=options.comments),
+    ]
@@ -0,0 +1,55 @@
+"""Parsing Reddit pages and feeds"""
+import os
+from typing import List
+from unittest import mock
+
+from bs4 import BeautifulSoup
+
+from benchmarks import DATA_PATH
+from benchmarks.generator import POST_LINK, generate_thread, generate_thread_json
+from benchmarks.harness import Result, measure, peak_memory
+from models.models import PostDTO
+from reddit.json_reader import RedditJsonReader
+from reddit.reader import RedditReader
+from reddit.stream_reader import RedditStreamReader
+
+
+def _reader(text: str, reader_class=RedditReader) -> RedditReader:
+    """A reader that gets the same response for every request"""
+    reader = reader_class()
+    reader._request = mock.Mock(return_value=mock.Mock(status_code=200, text=text, headers={}))
+    return reader
+
+
+def run(options) -> List[Result]:
+    params = {'comments': options.comments, 'depth': options.depth}
+    thread = generate_thread(options.comments, options.depth)
+    reader = _reader(thread)
+    stream_reader = _reader(thread, RedditStreamReader)
+    json_reader = _reader(generate_thread_json(options.comments, options.depth), RedditJsonReader)
+    with open(os.path.join(DATA_PATH, 'today_i_learned.rss')) as file:
+        feed_reader = _reader(file.read())
+
+    def post(_=None) -> PostDTO:
+        return PostDTO(reddit_link=POST_LINK, title='Synthetic thread', created=None, updated=None, author='/u/a')
+
+    def with_peak_memory(result: Result, reader: RedditReader) -> Result:
+        result.peak_memory = peak_memory(reader.get_post_details, post)
+        return result
+
+    return [
+        measure('reader.get_page_fingerprint', lambda _: reader.get_page_fingerprint(thread),
+                items=options.comments, repeat=options.repeat, **params),
+        measure('reader.parse_page', lambda _: BeautifulSoup(thread, 'html.parser'),
+                items=options.comments, repeat=options.repeat, **params),
+        measure('reader.get_comment_details', reader.get_comment_details, lambda: BeautifulSoup(thread, 'html.parser'),
+                items=options.comments, repeat=options.repeat, **params),
+        with_peak_memory(measure('reader.get_post_details', reader.get_post_details, post,
+                                 items=options.comments, repeat=options.repeat, **params), reader),
+        with_peak_memory(measure('reader.get_post_details_stream', stream_reader.get_post_details, post,
+                                 items=options.comments, repeat=options.repeat, **params), stream_reader),
+        with_peak_memory(measure('reader.get_post_details_json', json_reader.get_post_details, post,
+                                 items=options.comments, repeat=options.repeat, **params), json_reader),
+        measure('reader.get_subreddit_topics', lambda _: feed_reader.get_subreddit_topics('todayilearned'),
+                items=25, repeat=options.repeat),
+    ]
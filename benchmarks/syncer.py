@@ -0,0 +1,86 @@
+"""Preparing and posting to Lemmy, against a fake Lemmy and a real SQLite database file"""
+import itertools
+import os
+import tempfile
+import time
+from dataclasses import replace
+from datetime import datetime
+from typing import List
+from unittest import mock
+
+from bs4 import BeautifulSoup
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.generator import POST_LINK, generate_thread
+from benchmarks.harness import Result, measure
+from models.models import Base, Post, PostDTO
+from reddit.reader import RedditReader
+from utils import syncer as syncer_module
+from utils.syncer import Syncer
+
+LEMMY_POST_ID = 1
+
+
+class FakeLemmyComments:
+    """Hands out comment IDs like Lemmy would, after an optional delay"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._ids = itertools.count(1)
+
+    def create(self, content: str, post_id: int, parent_id: int = None, **kwargs) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        return {'comment_view': {'comment': {'id': next(self._ids), 'post_id': post_id, 'parent_id': parent_id}}}
+
+
+def _syncer(directory: str, latency: float) -> Syncer:
+    """A Syncer with a fresh database file and a fake Lemmy"""
+    database = os.path.join(directory, f'leddit-{time.perf_counter_ns()}.sqlite')
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    db.add(Post(id=LEMMY_POST_ID, community_id=1, reddit_link=POST_LINK, lemmy_link='https://lem.my/post/1',
+                created=datetime.utcnow(), updated=datetime.utcnow(), author='/u/Flares117', enabled=1))
+    db.commit()
+
+    with mock.patch.object(syncer_module, 'Lemmy'), \
+            mock.patch.object(syncer_module, 'WRITE_JOURNAL', os.path.join(directory, 'journal.jsonl')):
+        syncer = Syncer(db=db, reddit_reader=mock.Mock(), username='bench', password='bench')
+    syncer._lemmy.comment = FakeLemmyComments(latency)
+    return syncer
+
+
+def run(options) -> List[Result]:
+    params = {'comments': options.comments, 'depth': options.depth}
+    comments = RedditReader().get_comment_details(BeautifulSoup(generate_thread(options.comments, options.depth),
+                                                                'html.parser'))
+    post = PostDTO(reddit_link=POST_LINK, title='TIL: Antilia is one of the most expensive private residences',
+                   created=datetime(2023, 6, 17, 19, 22), updated=datetime(2023, 6, 17, 19, 22), author='/u/Flares117',
+                   body='Reasons:\n\n* location\n* size\n', lemmy_id=LEMMY_POST_ID)
+    directory = tempfile.TemporaryDirectory()
+
+    def fresh_comments():
+        # Preparing a comment changes its body
+        return [replace(comment) for comment in comments]
+
+    def clone(arguments):
+        syncer, batch = arguments
+        syncer.clone_comments_to_lemmy(post, batch)
+
+    try:
+        return [
+            measure('syncer.prepare_post', lambda posts: [Syncer.prepare_post(p, 'todayilearned', '##### Header')
+                                                          for p in posts],
+                    lambda: [replace(post) for _ in range(1000)], items=1000, repeat=options.repeat),
+            measure('syncer.prepare_comment', lambda batch: [Syncer.prepare_comment(POST_LINK, post.author, c)
+                                                             for c in batch],
+                    fresh_comments, items=len(comments), repeat=options.repeat, **params),
+            measure('syncer.clone_comments_to_lemmy', clone,
+                    lambda: (_syncer(directory.name, options.lemmy_latency / 1000), fresh_comments()),
+                    items=len(comments), repeat=options.repeat, lemmy_latency=options.lemmy_latency,
+                    comment_workers=syncer_module.COMMENT_WORKERS, **params),
+        ]
+    finally:
+        directory.cleanup()
@@ -0,0 +1,140 @@
+"""Several worker processes sharing a SQLite database file, against a fake Lemmy that also serves synthetic Reddit pages
+
+The workers scrape the feed and then update its posts, taking turns through their leases in the database, the way
+the bot does when it's scaled out. The update round is timed with one worker and with --workers of them, to see how it
+scales. Afterwards, what ended up on Lemmy is checked for posts and comments that were synced twice.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import List
+from unittest import mock
+
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.endtoend import COMMUNITY, FIRST_ROUND, READERS, check, expected_parents, reddit_pages
+from benchmarks.fake_lemmy import FakeLemmy, redirect_reddit
+from benchmarks.harness import measure, Result
+from models.models import Base, Post
+from utils import syncer as syncer_module
+from utils.ratelimiter import TokenBucket
+from utils.syncer import Syncer
+
+SCRAPE = 'scrape'
+UPDATE = 'update'
+
+
+def _work(connection, url: str, database: str, worker_id: str, reader: str):
+    """Run a worker in its own process, doing the rounds it's sent until it's sent None"""
+    logging.disable(logging.CRITICAL)
+    db = sessionmaker(bind=create_engine(f'sqlite:///{database}'))()
+    reddit_reader = READERS[reader](TokenBucket(0))
+    redirect_reddit(reddit_reader.session, url)
+    with mock.patch.object(syncer_module, 'LEMMY_BASE_URI', url), \
+            mock.patch.object(syncer_module, 'WRITE_JOURNAL', database + '.journal'), \
+            mock.patch.object(syncer_module.config, 'community_map', [COMMUNITY]):
+        syncer = Syncer(db=db, reddit_reader=reddit_reader, username='bench', password='bench', worker_id=worker_id)
+        for phase in iter(connection.recv, None):
+            try:
+                if phase == SCRAPE:
+                    syncer.scrape_new_posts()
+                else:
+                    # A post at a time, so the workers share the posts of a small feed
+                    while syncer.update_due_posts(1):
+                        pass
+                connection.send(None)
+            except Exception as e:
+                db.rollback()
+                connection.send(f'{type(e).__name__}: {str(e)}')
+        syncer.release_leases()
+
+
+class _Team:
+    """Worker processes with a shared database file and fake Lemmy, going through a scrape and an update round"""
+
+    def __init__(self, directory: str, options, post_ids: List[str], workers: int):
+        self.lemmy = FakeLemmy(options.lemmy_latency / 1000, options.lemmy_jitter / 1000, dict(options.lemmy_fault),
+                               options.lemmy_drop).start()
+        first_round = max(int(options.comments * FIRST_ROUND), 1)
+        self.lemmy.serve_reddit(reddit_pages(post_ids, first_round, options.depth))
+        self.final_pages = reddit_pages(post_ids, options.comments, options.depth)
+        self.crashes = 0
+
+        database = os.path.join(directory, f'leddit-{len(os.listdir(directory))}.sqlite')
+        engine = create_engine(f'sqlite:///{database}')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        # Forking a process that runs the fake Lemmy's threads isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.processes = []
+        for number in range(workers):
+            connection, child = context.Pipe()
+            process = context.Process(target=_work, args=(child, self.lemmy.url, database, f'worker{number}',
+                                                          options.reader), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def scrape(self) -> '_Team':
+        self._round(SCRAPE)
+        self.lemmy.serve_reddit(self.final_pages)
+        self.db.execute(update(Post).values(next_update_at=datetime.utcnow() - timedelta(seconds=1)))
+        self.db.commit()
+        return self
+
+    def update(self):
+        self._round(UPDATE)
+
+    def _round(self, phase: str):
+        for connection in self.connections:
+            connection.send(phase)
+        for connection in self.connections:
+            error = connection.recv()
+            if error is not None:
+                logging.getLogger(__name__).warning(f'Round crashed: {error}')
+                self.crashes += 1
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.lemmy.stop()
+        self.db.close()
+
+
+def run(options) -> List[Result]:
+    post_ids = [f'zy{number:04d}' for number in range(options.posts)]
+    parents = expected_parents(reddit_pages(post_ids, options.comments, options.depth))
+    directory = tempfile.TemporaryDirectory()
+    logging.getLogger('pythorhead').setLevel(logging.CRITICAL)
+    results = []
+    try:
+        for workers in sorted({1, options.workers}):
+            teams = []
+
+            def setup() -> _Team:
+                teams.append(_Team(directory.name, options, post_ids, workers))
+                return teams[-1].scrape()
+
+            try:
+                # Every comment of every post is read again
+                result = measure(f'workers.update_round_{workers}', lambda team: team.update(), setup,
+                                 items=options.posts * options.comments, repeat=options.repeat, workers=workers,
+                                 posts=options.posts, comments=options.comments, depth=options.depth,
+                                 reader=options.reader, lemmy_latency=options.lemmy_latency,
+                                 lemmy_jitter=options.lemmy_jitter, lemmy_faults=dict(options.lemmy_fault),
+                                 lemmy_drop=options.lemmy_drop)
+                last = teams[-1]
+                result.checks = {**check(last.lemmy, last.db, parents), 'crashed_rounds': last.crashes}
+                results.append(result)
+            finally:
+                for team in teams:
+                    team.close()
+        return results
+    finally:
+        directory.cleanup()
@@ -0,0 +1,30 @@
+"""Add post fingerprint
+
+Revision ID: 317e4da452c9
+Revises: 
+Create Date: 2026-10-17 02:14:26.113191
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '317e4da452c9'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('fingerprint', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('etag', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('last_modified', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('last_modified')
+        batch_op.drop_column('etag')
+        batch_op.drop_column('fingerprint')
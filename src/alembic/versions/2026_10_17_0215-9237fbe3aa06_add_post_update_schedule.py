@@ -0,0 +1,33 @@
+"""Add post update schedule
+
+Revision ID: 9237fbe3aa06
+Revises: 317e4da452c9
+Create Date: 2026-10-17 02:15:43.926985
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9237fbe3aa06'
+down_revision = '317e4da452c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('next_update_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('update_interval', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_posts_enabled_next_update_at', ['enabled', 'next_update_at'])
+
+    # Existing posts are due right away, the ones that waited longest first
+    op.execute('UPDATE posts SET next_update_at = updated')
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_index('ix_posts_enabled_next_update_at')
+        batch_op.drop_column('update_interval')
+        batch_op.drop_column('next_update_at')
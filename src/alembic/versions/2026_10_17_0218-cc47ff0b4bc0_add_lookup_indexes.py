@@ -0,0 +1,37 @@
+"""Add lookup indexes
+
+Revision ID: cc47ff0b4bc0
+Revises: 9237fbe3aa06
+Create Date: 2026-10-17 02:18:32.638255
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cc47ff0b4bc0'
+down_revision = '9237fbe3aa06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Deleted comments all shared one placeholder ID. Their rows are kept, each under an ID of its own.
+    op.execute("UPDATE comments SET reddit_id = 'deleted-' || id WHERE reddit_id = 'deleted'")
+    # Unique indexes can't be created while there are duplicates. Keep the first copy of every post and comment; the
+    # comments of duplicate posts go with them.
+    op.execute('DELETE FROM comments WHERE post_id IN '
+               '(SELECT id FROM posts WHERE id NOT IN (SELECT MIN(id) FROM posts GROUP BY reddit_link))')
+    op.execute('DELETE FROM posts WHERE id NOT IN (SELECT MIN(id) FROM posts GROUP BY reddit_link)')
+    op.execute('DELETE FROM comments WHERE id NOT IN (SELECT MIN(id) FROM comments GROUP BY reddit_id)')
+
+    op.create_index('ix_posts_reddit_link', 'posts', ['reddit_link'], unique=True)
+    op.create_index('ix_comments_reddit_id', 'comments', ['reddit_id'], unique=True)
+    op.create_index('ix_comments_post_id', 'comments', ['post_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_comments_post_id', table_name='comments')
+    op.drop_index('ix_comments_reddit_id', table_name='comments')
+    op.drop_index('ix_posts_reddit_link', table_name='posts')
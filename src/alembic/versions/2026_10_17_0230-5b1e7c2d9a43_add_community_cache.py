@@ -0,0 +1,29 @@
+"""Add community cache
+
+Revision ID: 5b1e7c2d9a43
+Revises: cc47ff0b4bc0
+Create Date: 2026-10-17 02:30:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7c2d9a43'
+down_revision = 'cc47ff0b4bc0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'communities',
+        sa.Column('name', sa.String(), primary_key=True),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('resolved_at', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('communities')
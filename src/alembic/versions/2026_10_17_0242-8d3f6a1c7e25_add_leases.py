@@ -0,0 +1,29 @@
+"""Add leases
+
+Revision ID: 8d3f6a1c7e25
+Revises: 5b1e7c2d9a43
+Create Date: 2026-10-17 02:42:51.207614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a1c7e25'
+down_revision = '5b1e7c2d9a43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'leases',
+        sa.Column('resource', sa.String(), primary_key=True),
+        sa.Column('owner', sa.String(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('leases')
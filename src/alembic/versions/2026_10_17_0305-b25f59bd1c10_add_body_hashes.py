@@ -0,0 +1,30 @@
+"""Add body hashes
+
+Revision ID: b25f59bd1c10
+Revises: 8d3f6a1c7e25
+Create Date: 2026-10-17 03:05:12.480316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b25f59bd1c10'
+down_revision = '8d3f6a1c7e25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('body_hash', sa.String(), nullable=True))
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.add_column(sa.Column('body_hash', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('body_hash')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('body_hash')
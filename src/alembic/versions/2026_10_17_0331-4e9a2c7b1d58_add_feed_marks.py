@@ -0,0 +1,30 @@
+"""Add feed marks
+
+Revision ID: 4e9a2c7b1d58
+Revises: b25f59bd1c10
+Create Date: 2026-10-17 03:31:08.417263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e9a2c7b1d58'
+down_revision = 'b25f59bd1c10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'feed_marks',
+        sa.Column('subreddit', sa.String(), primary_key=True),
+        sa.Column('sort', sa.String(), primary_key=True),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('reddit_link', sa.String(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('feed_marks')
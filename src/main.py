@@ -3,45 +3,131 @@ import logging
 import os
 import signal
 import sys
-import time
+from datetime import datetime, timedelta
+from typing import Dict, List
 
 from alembic import command
 from alembic.config import Config
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 
-from models.models import Base
+from models.models import Base, Post
+from reddit.json_reader import RedditJsonReader
 from reddit.reader import RedditReader
+from reddit.stream_reader import RedditStreamReader
+from utils.maintenance import SqliteMaintenance
+from utils.metrics import start_exporter
+from utils.scheduler import Scheduler, WorkItem, PRIORITY_FEED, PRIORITY_POSTS, PRIORITY_PRUNE
 from utils.syncer import Syncer
-from utils.config import SCRAPE_INTERVAL
+from utils.config import config, READER_BACKEND, SCRAPE_INTERVAL, VACUUM_THRESHOLD, UPDATE_BATCH_SIZE, \
+    PRUNE_INTERVAL, MIN_UPDATE_INTERVAL
 
 syncer: Syncer
+# The config file is checked for changes before every work item
+scheduler = Scheduler(before_next=lambda: reload_config())
+# Groups of communities whose feeds are read, by feed name, as of the last time the config was read
+feeds: Dict[str, List[dict]] = {}
+# Work items reading feeds, by feed name. The items of removed feeds stay until they're due and see they're gone
+feed_items: Dict[str, WorkItem] = {}
 load_dotenv()
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
                     level=os.getenv('LOGLEVEL', logging.INFO))
-keep_running = True
+READERS = {'html': RedditReader, 'json': RedditJsonReader, 'stream': RedditStreamReader}
 
 
 def handle_signal(signum, frame):
-    global keep_running
     logging.warning(f"Received signal {signum}. Stopping gracefully...")
-    keep_running = False
+    scheduler.stop()
+
+
+def handle_reload(signum, frame):
+    logging.info(f"Received signal {signum}. Reloading the config...")
+    config.request_reload()
+    scheduler.wake()
+
+
+def reload_config():
+    """Apply changes to the config file before the next work item"""
+    if config.reload_if_changed():
+        schedule_feeds(syncer)
+
+
+def schedule_feeds(syncer: Syncer):
+    """Plan reading the feeds of the community map, and stop reading feeds that were removed from it
+
+    Feeds that were already planned keep their deadline, and what the syncer saw of them. New feeds are due right away.
+    """
+    now = datetime.utcnow()
+    groups = {Syncer.feed_name(group): group for group in Syncer.feed_groups(config.community_map)}
+    for name in feeds.keys() - groups.keys():
+        syncer.forget_feed(name)
+    feeds.clear()
+    feeds.update(groups)
+
+    for name in groups.keys() - feed_items.keys():
+        def scrape_feed(name=name):
+            group = feeds.get(name)
+            if group is None:
+                feed_items.pop(name)
+                return None
+            syncer.scrape_feed(group)
+            return datetime.utcnow() + timedelta(seconds=SCRAPE_INTERVAL)
+
+        feed_items[name] = WorkItem('feed', name, PRIORITY_FEED, now, scrape_feed)
+        scheduler.add(feed_items[name])
+
+
+def schedule_work(syncer: Syncer, maintenance: SqliteMaintenance):
+    """Plan the bot's work: reading feeds, updating posts and pruning the database
+
+    Everything is due right away. Feeds go first, so new posts don't wait for due posts to be updated.
+    """
+    now = datetime.utcnow()
+    schedule_feeds(syncer)
+
+    def update_posts():
+        checked = syncer.update_due_posts(UPDATE_BATCH_SIZE)
+        now = datetime.utcnow()
+        next_due = syncer.next_update_due()
+        if not checked and next_due is not None and next_due <= now:
+            # Posts are due, but couldn't be updated, like when logging in to Lemmy fails
+            return now + Scheduler.RETRY_DELAY
+        # Posts that are scraped in the meantime are due after min_update_interval, so look again by then
+        latest = now + timedelta(seconds=MIN_UPDATE_INTERVAL)
+        return min(next_due, latest) if next_due else latest
+
+    scheduler.add(WorkItem('posts', 'due posts', PRIORITY_POSTS, now, update_posts))
+
+    def prune():
+        syncer.clear_aged()
+        # Return pages of deleted rows to the file system, once there are enough of them
+        maintenance.run()
+        return datetime.utcnow() + timedelta(seconds=PRUNE_INTERVAL)
+
+    scheduler.add(WorkItem('prune', 'database', PRIORITY_PRUNE, now, prune))
 
 
 def initialize_database(db_url):
     """Initialize the database if it doesn't exist and run migrations."""
     engine = create_engine(db_url)
-    Base.metadata.create_all(engine)
+    maintenance = SqliteMaintenance(engine, VACUUM_THRESHOLD)
 
-    # Run migrations using Alembic
     alembic_cfg = Config("../alembic.ini")
     alembic_cfg.set_main_option("script_location", "alembic")  # Adjust the script location if needed
     alembic_cfg.set_main_option("sqlalchemy.url", db_url)
-    command.upgrade(alembic_cfg, "head")
+
+    if inspect(engine).has_table(Post.__tablename__):
+        # Run migrations using Alembic
+        command.upgrade(alembic_cfg, "head")
+    else:
+        # A new database already matches the models, so it only needs to be marked as up-to-date
+        Base.metadata.create_all(engine)
+        command.stamp(alembic_cfg, "head")
+    maintenance.prepare()
 
     session = sessionmaker(bind=engine)
-    return session(), engine
+    return session(), maintenance
 
 
 if __name__ == '__main__':
@@ -49,28 +135,30 @@ if __name__ == '__main__':
         if not os.getenv(var_name):
             logging.error(f'Error: {var_name} environment variable is not set.')
             sys.exit(1)
+    if READER_BACKEND not in READERS:
+        logging.error(f"Error: reader_backend must be one of {', '.join(READERS)}, not '{READER_BACKEND}'.")
+        sys.exit(1)
+
+    metrics_location = start_exporter()
+    if metrics_location:
+        logging.info(f'Exporting metrics to {metrics_location}')
 
     database_url = os.getenv('DATABASE_URL')
     username = os.getenv('LEMMY_USERNAME')
     password = os.getenv('LEMMY_PASSWORD')
+    worker_id = os.getenv('WORKER_ID')
 
-    db_session, db_engine = initialize_database(database_url)
+    db_session, db_maintenance = initialize_database(database_url)
 
-    reddit_scraper = RedditReader()
-    syncer = Syncer(db=db_session, reddit_reader=reddit_scraper, username=username, password=password)
+    reddit_scraper = READERS[READER_BACKEND]()
+    syncer = Syncer(db=db_session, reddit_reader=reddit_scraper, username=username, password=password,
+                    worker_id=worker_id)
 
     # Set up signal handlers
     signal.signal(signal.SIGINT, handle_signal)
     signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGHUP, handle_reload)
 
-
-    while keep_running:
-        # Vacuum empty rows to reduce database file size and operation time
-        with db_engine.connect() as conn:
-            with conn.execution_options(isolation_level='AUTOCOMMIT'):
-                conn.execute(text("vacuum"))
-
-        syncer.update_comments()
-        syncer.scrape_new_posts()
-        logging.info(f'Update complete. Sleeping for {SCRAPE_INTERVAL} seconds.')
-        time.sleep(SCRAPE_INTERVAL)
+    schedule_work(syncer, db_maintenance)
+    scheduler.run()
+    syncer.release_leases()
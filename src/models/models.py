@@ -1,14 +1,33 @@
-from dataclasses import dataclass
+import hashlib
+import re
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
+from html import unescape
+from typing import Dict, Optional, Tuple
 
-from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Boolean
+from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Boolean, Index
 from sqlalchemy.orm import relationship, Mapped, declarative_base
 
 Base = declarative_base()
 
 SORT_HOT = 'hot'
 SORT_NEW = 'new'
+# Starts the hashes of the text and links of bodies, to tell them from older hashes that were taken of the markdown
+BODY_HASH_PREFIX = 'h:'
+_TAG = re.compile(r'<[^>]*>')
+_LINK = re.compile(r'href=["\']([^"\']*)')
+
+
+def body_hash(html: Optional[str]) -> str:
+    """Summarize the HTML Reddit renders a body to, to notice when it's edited
+
+    Only the text and the link targets count, with whitespace collapsed, so the hash is the same whichever reader
+    backend read the body, and however the reader turned it into markdown.
+    """
+    html = html or ''
+    text = ' '.join(unescape(_TAG.sub(' ', html)).split())
+    links = ' '.join(unescape(link) for link in _LINK.findall(html))
+    return BODY_HASH_PREFIX + hashlib.sha1(f'{text}\n{links}'.encode()).hexdigest()
 
 @dataclass
 class PostDTO:
@@ -21,11 +40,25 @@ class PostDTO:
     body: Optional[str] = None
     nsfw: bool = False
     lemmy_id: int = 0
+    fingerprint: Optional[str] = None  # Summary of the comments on the page, to detect changes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    body_hash: Optional[str] = field(default=None, compare=False)  # Set together with the body
 
     def __str__(self) -> str:
         return f"'{self.title}' at {self.reddit_link} updated: {self.updated}"
 
 
+@dataclass
+class FeedDTO:
+    """What was seen of the feed of one or more subreddits, the last time it was read"""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fingerprint: Optional[str] = None  # Summary of the entries, to detect changes when the validators aren't honoured
+    # Newest post of each subreddit that has been synced, by subreddit: when it was updated, and its link
+    marks: Dict[str, Tuple[datetime, str]] = field(default_factory=dict)
+
+
 class Post(Base):
     __tablename__: str = 'posts'
 
@@ -37,6 +70,17 @@ class Post(Base):
     updated: datetime = Column(DateTime, nullable=False)
     author: str = Column(String, nullable=False)
     enabled: bool = Column(Boolean, nullable=False, server_default='1') # To scrape or not to scrape
+    fingerprint: str = Column(String, nullable=True) # Comments on the page when it was last synced completely
+    etag: str = Column(String, nullable=True) # HTTP validators of the page when it was last synced completely
+    last_modified: str = Column(String, nullable=True)
+    next_update_at: datetime = Column(DateTime, nullable=True) # When to look for new comments again
+    update_interval: int = Column(Integer, nullable=True) # Seconds between updates, adapted to the comment activity
+    body_hash: str = Column(String, nullable=True) # Of the body on Reddit when it was last synced, to notice edits
+
+    __table_args__ = (
+        Index('ix_posts_enabled_next_update_at', 'enabled', 'next_update_at'),
+        Index('ix_posts_reddit_link', 'reddit_link', unique=True),
+    )
 
     def __str__(self) -> str:
         return f"'#{self.id}: {self.title}' on {self.community.name}"
@@ -57,6 +101,7 @@ class CommentDTO:
     body: str
     parent: str # Reddit parent ID
     post_id: str # Reddit original post ID
+    body_hash: Optional[str] = field(default=None, compare=False) # Set together with the body
 
 class Comment(Base):
     __tablename__: str = 'comments'
@@ -65,8 +110,48 @@ class Comment(Base):
     reddit_id: str = Column(String, nullable=False) # Comment ID on Reddit
     created: datetime = Column(DateTime, nullable=False)
     post_id: int = Column(Integer, ForeignKey('posts.id'), nullable=False) # Parent post ID on Lemmy
+    body_hash: str = Column(String, nullable=True) # Of the body on Reddit when it was last synced, to notice edits
 
     post: Mapped[Post] = relationship('Post')
 
+    __table_args__ = (
+        Index('ix_comments_reddit_id', 'reddit_id', unique=True),
+        Index('ix_comments_post_id', 'post_id'),
+    )
+
     def __str__(self) -> str:
         return f"'#{self.id}: child of {self.parent}' on {self.post_id}"
+
+
+class Community(Base):
+    __tablename__: str = 'communities'
+
+    name: str = Column(String, primary_key=True) # Community name on Lemmy
+    id: int = Column(Integer, nullable=False) # Community ID on Lemmy
+    resolved_at: datetime = Column(DateTime, nullable=False) # When Lemmy was last asked for the ID
+
+    def __str__(self) -> str:
+        return f"'#{self.id}: {self.name}' resolved at {self.resolved_at}"
+
+
+class Lease(Base):
+    __tablename__: str = 'leases'
+
+    resource: str = Column(String, primary_key=True) # What the lease is for, like 'post:12' or 'feed:todayilearned'
+    owner: str = Column(String, nullable=False) # The worker holding the lease
+    expires_at: datetime = Column(DateTime, nullable=False) # When other workers may take it over
+
+    def __str__(self) -> str:
+        return f"'{self.resource}' held by {self.owner} until {self.expires_at}"
+
+
+class FeedMark(Base):
+    __tablename__: str = 'feed_marks'
+
+    subreddit: str = Column(String, primary_key=True) # As written in the community map
+    sort: str = Column(String, primary_key=True)
+    updated: datetime = Column(DateTime, nullable=False) # Of the newest post in the feed that has been synced
+    reddit_link: str = Column(String, nullable=False)
+
+    def __str__(self) -> str:
+        return f"'{self.sort}:{self.subreddit}' synced up to {self.reddit_link} updated: {self.updated}"
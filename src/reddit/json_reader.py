@@ -0,0 +1,127 @@
+import hashlib
+import json
+import re
+from typing import List, Optional
+
+from bs4 import BeautifulSoup
+from requests import HTTPError
+
+from models.models import CommentDTO, PostDTO, body_hash
+from reddit.reader import HiddenComments, RedditReader
+from utils.metrics import metrics, REDDIT_PARSE
+
+
+class RedditJsonReader(RedditReader):
+    """Reads post pages through the JSON representation of the thread, instead of scraping its HTML
+
+    Decoding the JSON is much cheaper than building a tree of the whole page. Bodies are taken as the markdown their
+    author wrote, and only converted from HTML when they use syntax that Lemmy would render differently.
+    """
+    # Superscript, spoilers, relative links, /r/ and /u/ mentions, HTML entities and headings without a space
+    _REDDIT_ONLY_MARKDOWN = re.compile(r'\^|>!|]\(/|(?<![\w/])/?[ru]/\w|&#?\w+;|^#+[^#\s]', re.MULTILINE)
+
+    def get_post_details(self, post: PostDTO) -> tuple[PostDTO, Optional[List[CommentDTO]]]:
+        """Enrich a PostDTO with all available extra data and retrieve comments
+
+        If the thread hasn't changed since the post's fingerprint was taken, comments is None.
+        """
+        json_url = post.reddit_link.replace('www', 'old').rstrip('/') + '/.json'
+        headers = {}
+        if post.etag:
+            headers['If-None-Match'] = post.etag
+        if post.last_modified:
+            headers['If-Modified-Since'] = post.last_modified
+        response = self._request('GET', json_url, params={'raw_json': 1}, headers=headers)
+
+        if response.status_code == 304:
+            return post, None
+        if response.status_code != 200:
+            raise HTTPError("Couldn't retrieve post detail page")
+
+        with metrics.time(REDDIT_PARSE, page='post'):
+            post_listing, comment_listing = json.loads(response.text)
+        post.etag = response.headers.get('ETag')
+        post.last_modified = response.headers.get('Last-Modified')
+        post_info = post_listing['data']['children'][0]['data']
+        fingerprint = self.get_thread_fingerprint(post_info, comment_listing)
+        if post.fingerprint == fingerprint:
+            return post, None
+        post.fingerprint = fingerprint
+
+        post.body = self._body(post_info.get('selftext'), post_info.get('selftext_html'))
+        post.body_hash = body_hash(post_info.get('selftext_html') if post.body else None)
+        post.title = post_info.get('title') or post.title
+        post.nsfw = bool(post_info.get('over_18'))
+        url = post_info.get('url') or ''
+        post.external_link = None if post_info.get('is_self') or url.startswith('/r/') else url
+
+        hidden = []
+        comments = self.get_listing_comments(comment_listing, post_info['id'], hidden)
+        return post, self.expand_hidden_comments(post, comments, hidden)
+
+    @staticmethod
+    def get_thread_fingerprint(post_info: dict, comment_listing: dict) -> str:
+        """Summarize the comments on a post using its comment count, comment IDs and bodies, like get_page_fingerprint()"""
+        comment_ids = []
+        pending = [comment_listing]
+        while pending:
+            listing = pending.pop()
+            replies = []
+            for thing in listing['data']['children']:
+                comment_ids.append(thing['data']['id'])
+                comment_ids.append(thing['data'].get('body') or '')
+                if thing['kind'] == 't1' and thing['data'].get('replies'):
+                    replies.append(thing['data']['replies'])
+            pending.extend(reversed(replies))
+        digest = hashlib.sha1(' '.join(comment_ids).encode()).hexdigest()
+        return f"{post_info.get('num_comments', '?')}:{digest}"
+
+    def get_listing_comments(self, comment_listing: dict, post_id: str, hidden: Optional[List[HiddenComments]] = None
+                             ) -> List[CommentDTO]:
+        """Retrieve comments sorted by parent, in the same order as get_comment_details()
+
+        Placeholders for comments that weren't loaded ("load more comments" and "continue this thread") are added to
+        hidden, if given.
+        """
+        comments = []
+        pending = [comment_listing]
+        while pending:
+            listing = pending.pop()
+            replies = []
+            for thing in listing['data']['children']:
+                data = thing['data']
+                if thing['kind'] != 't1':
+                    if thing['kind'] == 'more' and hidden is not None:
+                        hidden.append(self._hidden_from_json(data))
+                    continue
+                comments.append(self._comment_from_json(data, post_id))
+                if data.get('replies'):
+                    replies.append(data['replies'])
+
+            # Depth first, in document order
+            pending.extend(reversed(replies))
+
+        return comments
+
+    def _load_thread(self, link: str, post_id: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Load the comments of the JSON version of the page behind 'continue this thread'"""
+        response = self._request('GET', link.rstrip('/') + '/.json', params={'raw_json': 1})
+        if response.status_code != 200:
+            raise HTTPError("Couldn't load the rest of the thread")
+
+        with metrics.time(REDDIT_PARSE, page='thread'):
+            _, comment_listing = json.loads(response.text)
+        return self.get_listing_comments(comment_listing, post_id, hidden)
+
+    def _json_body(self, markdown: Optional[str], html: Optional[str]) -> Optional[str]:
+        return self._body(markdown, html)
+
+    def _body(self, markdown: Optional[str], html: Optional[str]) -> Optional[str]:
+        """Use the markdown of a body as is, unless it uses syntax that only Reddit understands"""
+        if not markdown:
+            return None
+        if not html or not self._REDDIT_ONLY_MARKDOWN.search(markdown):
+            return markdown
+
+        source = BeautifulSoup(html, 'html.parser').find(class_='md')
+        return self._html_node_to_markdown(source) if source else markdown
@@ -0,0 +1,221 @@
+import re
+from typing import List, Optional, Union
+
+from bs4 import Comment, Doctype, Tag
+
+_NESTED = frozenset(['ol', 'ul', 'li', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th'])
+_LISTS = ('ul', 'ol')
+_HEADINGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+_BULLETS = '*+-'
+_WHITESPACE = re.compile(r'[\t ]+')
+_LINE_BEGINNING = re.compile(r'^', re.MULTILINE)
+_ZERO_WIDTH_SPACE = '\u200b'
+_ASCII_SPACES = ' \n\t\x0c\r'
+
+
+def _preserves_whitespace(node: Tag) -> bool:
+    while node is not None:
+        if node.name in ('pre', 'textarea'):
+            return True
+        node = node.parent
+    return False
+
+
+class UnsupportedMarkup(ValueError):
+    """Raised for tags that Reddit doesn't use in comment and post bodies"""
+
+
+class RedditMarkdownConverter:
+    """Converts the HTML that Reddit renders for comment and post bodies back into markdown
+
+    Produces the same output as markdownify with its default options, but only knows the handful of tags that Reddit
+    emits. It works on the parsed tree as is, instead of serializing it and parsing it again, and doesn't modify it.
+    Other tags raise UnsupportedMarkup, so the caller can fall back to markdownify.
+    """
+
+    # Tags without markup of their own, that only contribute their content
+    _TRANSPARENT = frozenset(['div', 'span', 'thead', 'tbody', 'tfoot'])
+    _INLINE_MARKUP = {'em': '*', 'i': '*', 'strong': '**', 'b': '**', 'del': '~~', 's': '~~', 'sup': '', 'sub': ''}
+
+    def __init__(self, link_base: str = ''):
+        self.link_base = link_base  # Prepended to relative links
+
+    def convert(self, source: Tag) -> str:
+        """Convert the contents of a tag into markdown"""
+        return self._convert_children(source, None, False, 0, False)
+
+    @staticmethod
+    def _children(node: Tag) -> List[Union[Tag, str]]:
+        """Get the children that markdownify would see after its own clean-up, without removing anything from the tree
+
+        Zero-width spaces are removed, as are whitespace-only strings between the parts of lists and tables.
+        """
+        children = []
+        for child in node.contents:
+            if isinstance(child, Tag) or isinstance(child, (Comment, Doctype)):
+                children.append(child)
+            elif _ZERO_WIDTH_SPACE in child:
+                text = child.replace(_ZERO_WIDTH_SPACE, '')
+                if text and not text.strip(_ASCII_SPACES) and not _preserves_whitespace(node):
+                    # What's left would be collapsed by the parser, like any other whitespace between tags
+                    text = '\n' if '\n' in text else ' '
+                if text:
+                    children.append(text)
+            else:
+                children.append(str(child))
+
+        if node.name in _NESTED:
+            # markdownify removes these while iterating over the same list, so the node after a removed one is skipped
+            index = 0
+            while index < len(children):
+                child = children[index]
+                if not isinstance(child, Tag) and not child.strip():
+                    previous_child = children[index - 1] if index else None
+                    next_child = children[index + 1] if index + 1 < len(children) else None
+                    if (not previous_child or not next_child
+                            or getattr(previous_child, 'name', None) in _NESTED
+                            or getattr(next_child, 'name', None) in _NESTED):
+                        del children[index]
+                index += 1
+
+        return children
+
+    def _convert_children(self, node: Tag, node_previous: Optional[Union[Tag, str]], inline: bool, ul_depth: int,
+                          in_li: bool) -> str:
+        name = node.name
+        keep_whitespace = name == 'pre' or (name == 'code' and node.parent is not None and node.parent.name == 'pre')
+        escape = name != 'code' and name != 'pre'
+
+        children = self._children(node)
+        last = len(children) - 1
+        parts = []
+        for index, child in enumerate(children):
+            if isinstance(child, Tag):
+                parts.append(self._convert_tag(child, node, node_previous, children, index, inline, ul_depth, in_li))
+            elif isinstance(child, (Comment, Doctype)):
+                continue
+            else:
+                text = child if keep_whitespace else _WHITESPACE.sub(' ', child)
+                if escape:
+                    text = text.replace('*', r'\*').replace('_', r'\_')
+                if name == 'li' and (index == last or getattr(children[index + 1], 'name', None) in _LISTS):
+                    text = text.rstrip()
+                parts.append(text)
+        return ''.join(parts)
+
+    def _convert_tag(self, el: Tag, parent: Tag, parent_previous: Optional[Union[Tag, str]],
+                     siblings: List[Union[Tag, str]], index: int, inline: bool, ul_depth: int, in_li: bool) -> str:
+        name = el.name
+        previous_sibling = siblings[index - 1] if index else None
+        next_sibling = siblings[index + 1] if index + 1 < len(siblings) else None
+
+        if name in self._INLINE_MARKUP:
+            return self._inline(self._INLINE_MARKUP[name], self._convert_children(el, previous_sibling, inline,
+                                                                                  ul_depth, in_li))
+        if name == 'p':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth, in_li)
+            if inline:
+                return text
+            return f'{text}\n\n' if text else ''
+        if name == 'a':
+            return self._link(el, self._convert_children(el, previous_sibling, inline, ul_depth, in_li))
+        if name in self._TRANSPARENT:
+            return self._convert_children(el, previous_sibling, inline, ul_depth, in_li)
+        if name == 'code':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth, in_li)
+            return text if parent.name == 'pre' else self._inline('`', text)
+        if name == 'pre':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth, in_li)
+            return f'\n```\n{text}\n```\n' if text else ''
+        if name == 'ul' or name == 'ol':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth + (name == 'ul'), in_li)
+            if in_li:
+                return '\n' + (_LINE_BEGINNING.sub('\t', text) if text else '').rstrip()
+            before_paragraph = next_sibling and getattr(next_sibling, 'name', None) not in _LISTS
+            return text + ('\n' if before_paragraph else '')
+        if name == 'li':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth, True)
+            if parent.name == 'ol':
+                start = parent.get('start')
+                bullet = f'{(int(start) if start else 1) + index}.'
+            else:
+                bullet = _BULLETS[(ul_depth - 1) % len(_BULLETS)]
+            return f'{bullet} {(text or "").strip()}\n'
+        if name == 'blockquote':
+            text = self._convert_children(el, previous_sibling, inline, ul_depth, in_li)
+            if inline:
+                return text
+            return '\n' + (_LINE_BEGINNING.sub('> ', text) + '\n\n') if text else ''
+        if name in _HEADINGS:
+            text = self._convert_children(el, previous_sibling, True, ul_depth, in_li)
+            if inline:
+                return text
+            text = text.rstrip()
+            if name in ('h1', 'h2'):
+                return f"{text}\n{('=' if name == 'h1' else '-') * len(text)}\n\n" if text else ''
+            return f"{'#' * int(name[1])} {text}\n\n"
+        if name == 'br':
+            return '' if inline else '  \n'
+        if name == 'hr':
+            return '\n\n---\n\n'
+        if name == 'table':
+            return '\n\n' + self._convert_children(el, previous_sibling, inline, ul_depth, in_li) + '\n'
+        if name == 'tr':
+            return self._table_row(el, parent, parent_previous, previous_sibling,
+                                   self._convert_children(el, previous_sibling, inline, ul_depth, in_li))
+        if name == 'td' or name == 'th':
+            return ' ' + self._convert_children(el, previous_sibling, True, ul_depth, in_li) + ' |'
+        if name == 'img':
+            alt = el.get('alt') or ''
+            if inline:
+                return alt
+            title = (el.get('title') or '').replace(_ZERO_WIDTH_SPACE, '')
+            title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+            src = (el.get('src') or '').replace(_ZERO_WIDTH_SPACE, '')
+            return f'![{alt}]({src}{title_part})'
+
+        raise UnsupportedMarkup(name)
+
+    @staticmethod
+    def _chomp(text: str):
+        prefix = ' ' if text and text[0] == ' ' else ''
+        suffix = ' ' if text and text[-1] == ' ' else ''
+        return prefix, suffix, text.strip()
+
+    def _inline(self, markup: str, text: str) -> str:
+        prefix, suffix, text = self._chomp(text)
+        if not text:
+            return ''
+        return f'{prefix}{markup}{text}{markup}{suffix}'
+
+    def _link(self, el: Tag, text: str) -> str:
+        prefix, suffix, text = self._chomp(text)
+        if not text:
+            return ''
+        href = el.get('href')
+        if href is not None:
+            if href.startswith('/'):
+                href = self.link_base + href
+            href = href.replace(_ZERO_WIDTH_SPACE, '')
+        title = el.get('title')
+        if title:
+            title = title.replace(_ZERO_WIDTH_SPACE, '')
+        if text.replace(r'\_', '_') == href and not title:
+            return f'<{href}>'
+        title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+        return f'{prefix}[{text}]({href}{title_part}){suffix}' if href else text
+
+    @staticmethod
+    def _table_row(el: Tag, parent: Tag, parent_previous: Optional[Union[Tag, str]],
+                   previous_sibling: Optional[Union[Tag, str]], text: str) -> str:
+        cells = el.find_all(['td', 'th'])
+        overline = ''
+        underline = ''
+        if all(cell.name == 'th' for cell in cells) and not previous_sibling:
+            # First row is the header row
+            underline = '| ' + ' | '.join(['---'] * len(cells)) + ' |\n'
+        elif not previous_sibling and (parent.name == 'table' or (parent.name == 'tbody' and not parent_previous)):
+            # Tables without a header row get an empty one
+            overline = '| ' + ' | '.join([''] * len(cells)) + ' |\n'
+            overline += '| ' + ' | '.join(['---'] * len(cells)) + ' |\n'
+        return overline + '|' + text + '\n' + underline
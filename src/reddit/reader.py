@@ -1,36 +1,67 @@
+import hashlib
+import json
 import logging
 import re
-import time
-from datetime import datetime
-from typing import List, Optional
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
 import feedparser
 import requests
 from bs4 import BeautifulSoup, Tag
 from markdownify import markdownify
-from requests import HTTPError
+from requests import HTTPError, RequestException
+
+from models.models import PostDTO, SORT_HOT, SORT_NEW, CommentDTO, FeedDTO, body_hash
+from reddit.markdown import RedditMarkdownConverter, UnsupportedMarkup
+from utils.config import USER_AGENT, REQUEST_INTERVAL, REQUEST_BURST, MORE_COMMENTS_BATCH_SIZE, MORE_COMMENTS_DEPTH, \
+    MORE_COMMENTS_REQUESTS
+from utils.metrics import metrics, MARKDOWN, RATE_LIMIT_WAIT, REDDIT_FETCH, REDDIT_PARSE
+from utils.ratelimiter import TokenBucket
+
+
+@dataclass
+class HiddenComments:
+    """Comments that Reddit left out of a page, behind "load more comments" or "continue this thread"
+
+    Without ids, they're the rest of a thread that is too deep to show. That is found on link, or on the permalink of
+    the parent if there's no link.
+    """
+    parent: str  # Reddit ID of the comment or post they reply to
+    ids: List[str] = field(default_factory=list)  # Comments to load in batches
+    link: Optional[str] = None
+    depth: int = 0  # Number of expansions it took to find them
 
-from models.models import PostDTO, SORT_HOT, SORT_NEW, CommentDTO
-from utils.config import USER_AGENT, REQUEST_INTERVAL
 
 class RedditReader:
     _SUBREDDIT_REGEX = re.compile(r'(.*reddit\.com/|^/?)r/([^/]+).*')
     _STRIP_EMPTY_REGEX = re.compile(r'\n{3,}')
-    _next_request_after: int  # Updated on requests to reddit to prevent throttling
-
-    def __init__(self):
+    _COMMENT_COUNT_REGEX = re.compile(r'data-comments-count="(\d+)"')
+    _COMMENT_ID_REGEX = re.compile(r'id="thing_t1_(\w+)"')
+    _MORE_CHILDREN_REGEX = re.compile(r"morechildren\(this, '[^']*', '[^']*', '([\w,]+)'")
+    _BODY_REGEX = re.compile(r'<div class="md">(.*?)</div>', re.DOTALL)
+    _DELETED_BODY = '<div class="md"><p><em>This comment was deleted before it could be archived.</em></p></div>'
+    _DELETED_BODIES = ('[deleted]', '[removed]')
+    _DELETED_MARKDOWN = '*This comment was deleted before it could be archived.*'
+    _LINK_BASE = 'https://old.reddit.com'
+    _MORE_CHILDREN_URL = _LINK_BASE + '/api/morechildren.json'
+    _FEED_LIMIT = 100  # Most entries Reddit puts in a feed
+    _markdown = RedditMarkdownConverter(_LINK_BASE)
+    _rate_limiter: TokenBucket  # Shared by all threads sending requests to reddit to prevent throttling
+
+    def __init__(self, rate_limiter: Optional[TokenBucket] = None):
         self.session = requests.Session()
         self.session.headers.update({'User-Agent': USER_AGENT})
-        self._next_request_after = 0
+        self._rate_limiter = rate_limiter or TokenBucket(REQUEST_INTERVAL, REQUEST_BURST)
         self.logger: logging.Logger = logging.getLogger(__name__)
 
     def _request(self, *args, allow_recurse=True, **kwargs):
-        now = time.time()
-        if now < self._next_request_after:
-            self.logger.debug('Delaying next request')
-            time.sleep(self._next_request_after - now)
-        self._next_request_after = int(time.time()) + REQUEST_INTERVAL
-        response = self.session.request(*args, **kwargs)
+        wait = self._rate_limiter.acquire()
+        if wait:
+            self.logger.debug('Delayed request to prevent throttling')
+        metrics.observe(RATE_LIMIT_WAIT, wait)
+        with metrics.time(REDDIT_FETCH):
+            response = self.session.request(*args, **kwargs)
         if 'over18' in response.url:
             if not allow_recurse:
                 raise RecursionError('Reddit is trying to throw us into an infinite loop :(')
@@ -38,125 +69,456 @@ class RedditReader:
 
         return response
 
-    def get_subreddit_topics(self, subreddit: str, mode: str = SORT_NEW, since: datetime = None) -> List[PostDTO]:
-        """Get a topics from a subreddit through its RSS feed"""
+    def get_subreddit_topics(self, subreddit: str, mode: str = SORT_NEW, since: datetime = None,
+                             feed: Optional[FeedDTO] = None) -> Optional[List[PostDTO]]:
+        """Get a topics from a subreddit through its RSS feed
+
+        With the feed as it was last read, only posts newer than its marks are returned, or None if it didn't change.
+        """
+        entries = self._get_feed_entries(subreddit, mode, since, feed=feed)
+        return None if entries is None else [post for _, post in entries]
+
+    def get_grouped_topics(self, subreddits: List[str], mode: str = SORT_NEW, since: datetime = None,
+                           feed: Optional[FeedDTO] = None) -> Optional[Dict[str, List[PostDTO]]]:
+        """Get topics from several subreddits through one combined RSS feed, by subreddit
+
+        Entries are sorted back to their subreddit by the category Reddit gives them. The combined feed asks for as
+        many entries as Reddit allows, as the subreddits share them. Like get_subreddit_topics(), it returns None if
+        the feed didn't change.
+        """
+        entries = self._get_feed_entries('+'.join(subreddits), mode, since, self._FEED_LIMIT, feed)
+        if entries is None:
+            return None
+        topics = {subreddit: [] for subreddit in subreddits}
+        names = {subreddit.lower(): subreddit for subreddit in subreddits}
+        for entry_subreddit, post in entries:
+            subreddit = names.get(entry_subreddit.lower())
+            if subreddit is None:
+                self.logger.warning(f'Feed of {"+".join(subreddits)} has a post from /r/{entry_subreddit}: {post}')
+                continue
+            topics[subreddit].append(post)
+        return topics
+
+    def _get_feed_entries(self, subreddit: str, mode: str, since: Optional[datetime], limit: Optional[int] = None,
+                          feed: Optional[FeedDTO] = None) -> Optional[List[Tuple[str, PostDTO]]]:
+        """Get the posts in the RSS feed of a subreddit, or a combination of them, with the subreddit they're in
+
+        With the feed as it was last read, Reddit is asked to only send it if it changed, and None is returned if it
+        didn't. Its validators and fingerprint are updated otherwise. The new feed lists the newest posts first, so
+        it's only read up to the mark of each subreddit: the newest post of it that has been synced.
+        """
         if mode == SORT_NEW:
             feed_url = f"https://www.reddit.com/r/{subreddit}/new/.rss?sort=new"
         else:
             feed_url = f"https://www.reddit.com/r/{subreddit}/.rss"
+        if limit:
+            feed_url += f"{'&' if '?' in feed_url else '?'}limit={limit}"
 
-        feed = feedparser.parse(self._request('GET', feed_url).text)
+        if feed is None:
+            response = self._request('GET', feed_url)
+        else:
+            headers = {}
+            if feed.etag:
+                headers['If-None-Match'] = feed.etag
+            if feed.last_modified:
+                headers['If-Modified-Since'] = feed.last_modified
+            response = self._request('GET', feed_url, headers=headers)
+            if response.status_code == 304:
+                return None
+        with metrics.time(REDDIT_PARSE, page='feed'):
+            entries = feedparser.parse(response.text).entries
+
+        marks = {}
+        if feed is not None:
+            fingerprint = self.get_feed_fingerprint(entries)
+            if feed.fingerprint == fingerprint:
+                return None
+            feed.etag = response.headers.get('ETag')
+            feed.last_modified = response.headers.get('Last-Modified')
+            feed.fingerprint = fingerprint
+            if mode == SORT_NEW:
+                marks = {name.lower(): mark for name, mark in feed.marks.items()}
+        subreddits = len(subreddit.split('+'))
+        seen = set()  # Subreddits whose mark has been reached
 
         posts = []
-        for entry in feed.entries:
-            created = datetime.fromisoformat(entry.published)
+        for entry in entries:
+            entry_subreddit = self._entry_subreddit(entry, subreddit)
+            if entry_subreddit.lower() in seen:
+                continue
             updated = datetime.fromisoformat(entry.updated)
+            mark = marks.get(entry_subreddit.lower())
+            if mark is not None and (entry.link == mark[1] or updated < mark[0]):
+                # It has been synced, and so have the older posts of this subreddit after it
+                seen.add(entry_subreddit.lower())
+                if len(seen) == subreddits:
+                    break
+                continue
+            created = datetime.fromisoformat(entry.published)
             author = entry.author if 'author' in entry else '[deleted]'
             if not since or updated > since:
-                posts.append(PostDTO(reddit_link=entry.link, title=entry.title, created=created, updated=updated,
-                                     author=author))
+                posts.append((entry_subreddit,
+                              PostDTO(reddit_link=entry.link, title=entry.title, created=created, updated=updated,
+                                      author=author)))
         return posts
 
-    def get_post_details(self, post: PostDTO) -> tuple[PostDTO, List[CommentDTO]]:
-        """Enrich a PostDTO with all available extra data and retrieve comments"""
+    @staticmethod
+    def get_feed_fingerprint(entries: list) -> str:
+        """Summarize the posts in a feed, to detect whether it changed"""
+        return hashlib.sha1(''.join(f"{entry.get('id', entry.link)}@{entry.updated}\n" for entry in entries)
+                            .encode()).hexdigest()
+
+    def _entry_subreddit(self, entry, feed_subreddit: str) -> str:
+        """Find the subreddit of a feed entry through its category, or else its link"""
+        for tag in entry.get('tags', ()):
+            if tag.get('term'):
+                return tag['term']
+        match = self._SUBREDDIT_REGEX.match(entry.link)
+        return match.group(2) if match else feed_subreddit
+
+    def get_post_details(self, post: PostDTO) -> tuple[PostDTO, Optional[List[CommentDTO]]]:
+        """Enrich a PostDTO with all available extra data and retrieve comments
+
+        If the page hasn't changed since the post's fingerprint was taken, it isn't parsed and comments is None.
+        """
         old_url = post.reddit_link.replace('www', 'old')
-        response = self._request('GET', old_url)
-
+        headers = {}
+        if post.etag:
+            headers['If-None-Match'] = post.etag
+        if post.last_modified:
+            headers['If-Modified-Since'] = post.last_modified
+        response = self._request('GET', old_url, headers=headers)
+
+        if response.status_code == 304:
+            return post, None
         if response.status_code != 200:
             raise HTTPError("Couldn't retrieve post detail page")
 
-        soup = BeautifulSoup(response.text, "html.parser")
+        post.etag = response.headers.get('ETag')
+        post.last_modified = response.headers.get('Last-Modified')
+        # Decoded once, requests decodes the response again every time its text is used
+        html = response.text
+        fingerprint = self.get_page_fingerprint(html)
+        if post.fingerprint == fingerprint:
+            return post, None
+        post.fingerprint = fingerprint
 
+        # Extract all visible comments, then load the ones Reddit left out
+        hidden = []
+        comments = self._read_post_page(post, html, hidden)
+        comments = self.expand_hidden_comments(post, comments, hidden)
+
+        return post, comments
+
+    def _read_post_page(self, post: PostDTO, html: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Fill in the post's details from its page, and get the comments on it"""
+        with metrics.time(REDDIT_PARSE, page='post'):
+            soup = BeautifulSoup(html, "html.parser")
+        self._read_post_info(post, soup)
+        return self.get_comment_details(soup, hidden)
+
+    def _read_post_info(self, post: PostDTO, soup: BeautifulSoup):
+        """Fill in the body and other properties of a post from the part of its page above the comments"""
         # Extract the body text if it exists
         body_text = soup.select_one('.expando form .md')
         post.body = self._html_node_to_markdown(body_text) if body_text else None
+        post.body_hash = body_hash(str(body_text) if body_text else None)
+        title = soup.select_one('p.title a.title')
+        if title:
+            post.title = title.get_text()
 
         # Extract other properties
         post_info = soup.select_one('div[data-timestamp][data-nsfw]')
         post.nsfw = post_info['data-nsfw'] != 'false'
         post.external_link = None if post_info['data-url'].startswith('/r/') else post_info['data-url']
 
-        # Extract all (visible) comments
-        comments = self.get_comment_details(soup)
-
-        return post, comments
-
-    def get_comment_details(self, soup: BeautifulSoup) -> List[CommentDTO]:
-        """Retrieve comments sorted by parent"""
-        comment_threads = soup.select('.sitetable')
+    @classmethod
+    def get_page_fingerprint(cls, html: str) -> str:
+        """Summarize the comments on a post page without parsing it, using its comment count, comment IDs and bodies
+
+        Bodies are taken as they are on the page, so an edit changes the fingerprint, but a changing score doesn't.
+        """
+        count = cls._COMMENT_COUNT_REGEX.search(html)
+        digest = hashlib.sha1(' '.join(cls._COMMENT_ID_REGEX.findall(html)).encode())
+        for body in cls._BODY_REGEX.findall(html):
+            digest.update(body.encode())
+        return f"{count.group(1) if count else '?'}:{digest.hexdigest()}"
+
+    def get_comment_details(self, soup: BeautifulSoup, hidden: Optional[List[HiddenComments]] = None
+                            ) -> List[CommentDTO]:
+        """Retrieve comments sorted by parent
+
+        Walks the nested comment listings once. Every listing emits its own comments before its replies' listings are
+        visited, so a parent always precedes its children.
+        Placeholders for comments that weren't loaded are added to hidden, if given.
+        """
+        comment_threads = soup.select('.sitetable', limit=2)
         post_id = comment_threads[1]['id'].split('_')[2]
 
-        # Create tags for deleted accounts
-        deleted = BeautifulSoup('<a></a>', "html.parser")
-        deleted.string = "[deleted]"
-        deleted_body = BeautifulSoup(
-            '<div class="md"><p><em>This comment was deleted before it could be archived.</em></p></div>', "html.parser"
-            )
-        deleted_id = deleted
-        deleted_id['name'] = 'deleted'
+        # Skip first sitetable (represents the whole page, has no comments)
+        return self._listing_comments(comment_threads[1], post_id, post_id, hidden)
 
+    def _listing_comments(self, listing: Tag, parent: str, post_id: str, hidden: Optional[List[HiddenComments]]
+                          ) -> List[CommentDTO]:
+        """Get the comments in a listing that replies to parent, and in the listings of their replies, sorted by parent"""
         comments = []
+        pending = [(listing, parent)]
+        while pending:
+            sitetable, parent = pending.pop()
+            replies = []
+            for thing in self._child_tags(sitetable, 'thing'):
+                comment = self._extract_comment(thing, parent, post_id)
+                if comment:
+                    comments.append(comment)
+                elif hidden is not None:
+                    placeholder = self._extract_hidden(thing, parent)
+                    if placeholder:
+                        hidden.append(placeholder)
+
+                for child in self._child_tags(thing, 'child'):
+                    for reply_listing in self._child_tags(child, 'sitetable'):
+                        try:
+                            replies.append((reply_listing, reply_listing['id'].split('_')[2]))
+                        # Resolve broken sitetables caused by deleted comments
+                        except IndexError:
+                            replies.append((reply_listing, post_id))
+
+            # Depth first, in document order
+            pending.extend(reversed(replies))
 
-        for sitetable in comment_threads[1:]: # Skip first sitetable (represents the whole page, has no comments)
-            comment_index = 0
+        return comments
 
+    def _extract_comment(self, thing: Tag, parent: str, post_id: str) -> Optional[CommentDTO]:
+        """Build a CommentDTO from a single comment node, without its replies
+
+        Deleted comments get a placeholder author and body. Reddit doesn't show their ID, so they get one made of their
+        parent and the time they were posted, which stays the same from one read to the next.
+        Returns None for nodes that don't hold comment data, like "load more comments" and "continue this thread".
+        """
+        tagline = None
+        body = None
+        for entry in self._child_tags(thing, 'entry'):
+            for node in entry.children:
+                if not isinstance(node, Tag):
+                    continue
+                if tagline is None and 'tagline' in node.get('class', ()):
+                    tagline = node
+                elif body is None and node.name == 'form':
+                    body = node.find(class_='md')
+
+        # Ignore "show more comments" taglines (Their comment data is not fetched)
+        if tagline is None or tagline.find('span') is None:
+            return None
+        created = tagline.find('time')
+        if created is None:
+            return None
+
+        author = tagline.find(class_='author')
+        # Like in Reddit's JSON, deleted comments that are still shown because of their replies get the placeholder too
+        if body is None or (author is None and body.get_text().strip() in self._DELETED_BODIES):
+            body = BeautifulSoup(self._DELETED_BODY, "html.parser")
+        anchor = None
+        for permalink in self._child_tags(thing, 'parent'):
+            anchor = permalink.find('a')
+            if anchor:
+                break
+
+        markdown = self._html_node_to_markdown(body)
+        created = datetime.fromisoformat(created['datetime'])
+        return CommentDTO(
+            id=anchor['name'] if anchor else f'deleted-{parent}-{int(created.timestamp())}',  # Comment ID on Reddit
+            created=created,
+            author=author.get_text() if author else '[deleted]',
+            body=markdown,
+            parent=parent,
+            post_id=post_id,
+            body_hash=body_hash(str(body))
+        )
+
+    def _extract_hidden(self, thing: Tag, parent: str) -> Optional[HiddenComments]:
+        """Find out which comments a "load more comments" or "continue this thread" node stands for"""
+        if 'morechildren' in thing.get('class', ()):
+            button = thing.find('a', onclick=True)
+            match = self._MORE_CHILDREN_REGEX.search(button['onclick']) if button else None
+            return HiddenComments(parent, ids=match.group(1).split(',')) if match else None
+        if 'deepthread' in thing.get('class', ()):
+            link = thing.find('a', href=True)
+            return HiddenComments(parent, link=link['href']) if link else None
+        return None
+
+    def expand_hidden_comments(self, post: PostDTO, comments: List[CommentDTO], hidden: List[HiddenComments]
+                               ) -> List[CommentDTO]:
+        """Load comments that Reddit left out of the post page, and add them to the comments, still sorted by parent
+
+        Hidden comments are loaded MORE_COMMENTS_BATCH_SIZE at a time, the rest of a thread a page at a time. Loaded
+        comments can hide more comments in turn, which are loaded up to MORE_COMMENTS_DEPTH levels deep. At most
+        MORE_COMMENTS_REQUESTS extra requests are made per post. Loading them is best-effort: when a request fails, the
+        comments found so far are returned. If not all comments were loaded, the post loses its fingerprint, so it is
+        read again next time.
+        """
+        if not hidden or not comments or MORE_COMMENTS_REQUESTS <= 0:
+            return comments
+        post_id = comments[0].post_id
+        known = {post_id} | {comment.id for comment in comments}
+        batch_ids = [(placeholder.depth, comment_id) for placeholder in hidden for comment_id in placeholder.ids]
+        queued = {comment_id for _, comment_id in batch_ids}
+        threads = [placeholder for placeholder in hidden if not placeholder.ids]
+        requests = 0
+        failed = False
+
+        while (batch_ids or threads) and requests < MORE_COMMENTS_REQUESTS:
+            found_hidden = []
             try:
-                parent = sitetable['id'].split('_')[2]
-            # Resolve broken sitetables caused by deleted comments
-            except IndexError:
-                parent = post_id
-                # deleted_warning = '**This comment was deleted before it could be archived.**\n\n'
-
-            # Enhance comment author identification to resolve deleted accounts without the author class
-            comments_author = []
-            taglines = soup.select('#' + sitetable['id'] + ' > div > div > .tagline')
-            for tagline in taglines:
-
-                # Ignore "show more comments" taglines (Their comment data is not fetched)
-                if tagline.select_one('span') == None:
+                if batch_ids:
+                    batch, batch_ids = batch_ids[:MORE_COMMENTS_BATCH_SIZE], batch_ids[MORE_COMMENTS_BATCH_SIZE:]
+                    depth = max(depth for depth, _ in batch) + 1
+                    found = self._load_more_children(post_id, [comment_id for _, comment_id in batch], found_hidden)
+                else:
+                    thread = threads.pop(0)
+                    depth = thread.depth + 1
+                    link = thread.link or post.reddit_link.replace('www', 'old').rstrip('/') + f'/{thread.parent}/'
+                    found = self._load_thread(link, post_id, found_hidden)
+                    # The first comment on the page continues the thread where the placeholder was
+                    for comment in found:
+                        if comment.parent == post_id and comment.id not in known:
+                            comment.parent = thread.parent
+            except RequestException as e:
+                self.logger.warning(f'Stopped loading hidden comments of {post.reddit_link} after {requests} extra '
+                                    f'requests: {str(e)}')
+                failed = True
+                break
+            requests += 1
+
+            self._merge_comments(comments, found, known)
+            for placeholder in found_hidden:
+                if depth >= MORE_COMMENTS_DEPTH:
                     continue
+                placeholder.depth = depth
+                new_ids = [comment_id for comment_id in placeholder.ids if comment_id not in known | queued]
+                batch_ids.extend((depth, comment_id) for comment_id in new_ids)
+                queued.update(new_ids)
+                if not placeholder.ids:
+                    threads.append(placeholder)
+
+        if failed:
+            post.fingerprint = post.etag = post.last_modified = None
+        elif batch_ids or threads:
+            self.logger.info(f'{len(batch_ids)} comments and {len(threads)} threads of {post.reddit_link} are still '
+                             f'hidden after {requests} extra requests')
+            post.fingerprint = post.etag = post.last_modified = None
+        return comments
 
-                author = tagline.select('.author') if tagline.select('.author') != [] else [deleted]
-                comments_author.append(author)
-
-            # Extract attributes of all comments in the sitetable
-            comments_body = soup.select('#' + sitetable['id'] + ' > div > div > form .md')
-            comments_created = soup.select('#' + sitetable['id'] + ' > div > div > .tagline time')
-            comments_id = soup.select('#' + sitetable['id'] + ' > div > .parent a')
-
-            if len(comments_body) != len(comments_author) and [deleted] in comments_author:
-                for index, author in enumerate(comments_author):
-                    if author == [deleted]:
-                        print(index)
-                        comments_body.insert(index, deleted_body)
-                        comments_id.insert(index, deleted_id)
-
-            for child in comments_id:
-                comment_author = comments_author[comment_index][0]
-                comment_body =  comments_body[comment_index]
-                comment_created = comments_created[comment_index]
-                comment_index += 1
-
-                # Format attributes and remove HTML tags
-                id = child['name'] # Comment ID on Reddit
-                created = datetime.fromisoformat(comment_created['datetime'])
-                author = comment_author.contents[0]
-                body = self._html_node_to_markdown(comment_body)
-
-                comments.append(CommentDTO(id=id, created=created, author=author, body=body, parent=parent, post_id=post_id))
+    def _load_more_children(self, post_id: str, comment_ids: List[str], hidden: List[HiddenComments]
+                            ) -> List[CommentDTO]:
+        """Load hidden comments and their replies through the API behind 'load more comments'"""
+        response = self._request('GET', self._MORE_CHILDREN_URL, params={
+            'api_type': 'json', 'link_id': f't3_{post_id}', 'children': ','.join(comment_ids),
+            'limit_children': 'false', 'raw_json': 1,
+        })
+        if response.status_code != 200:
+            raise HTTPError("Couldn't load more comments")
 
+        with metrics.time(REDDIT_PARSE, page='more'):
+            things = json.loads(response.text)['json']['data']['things']
+        comments = []
+        for thing in things:
+            data = thing['data']
+            if thing['kind'] == 't1':
+                comments.append(self._comment_from_json(data, post_id))
+            elif thing['kind'] == 'more':
+                hidden.append(self._hidden_from_json(data))
         return comments
 
+    def _load_thread(self, link: str, post_id: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Load the comments on the page behind 'continue this thread'"""
+        response = self._request('GET', link)
+        if response.status_code != 200:
+            raise HTTPError("Couldn't load the rest of the thread")
+
+        return self._read_thread_page(response.text, hidden)
+
+    def _read_thread_page(self, html: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Get the comments on a page that only shows part of a post's comments"""
+        with metrics.time(REDDIT_PARSE, page='thread'):
+            soup = BeautifulSoup(html, "html.parser")
+        return self.get_comment_details(soup, hidden)
+
+    @staticmethod
+    def _merge_comments(comments: List[CommentDTO], found: List[CommentDTO], known: set):
+        """Add new comments to a list that is sorted by parent, in a way that keeps it sorted"""
+        waiting = {}
+        for comment in found:
+            if comment.id in known:
+                continue
+            if comment.parent not in known:
+                waiting.setdefault(comment.parent, []).append(comment)
+                continue
+            pending = [comment]
+            while pending:
+                ready = pending.pop()
+                comments.append(ready)
+                known.add(ready.id)
+                pending.extend(reversed(waiting.pop(ready.id, [])))
+        # Replies to comments that never showed up still go in, the syncer decides what to do with them
+        for replies in waiting.values():
+            comments.extend(replies)
+
+    @staticmethod
+    def _hidden_from_json(data: dict) -> HiddenComments:
+        """Turn a "more" placeholder of Reddit's JSON into HiddenComments
+
+        "Continue this thread" has no children, only the comment where the thread was cut off as its parent.
+        """
+        return HiddenComments(data['parent_id'].split('_', 1)[1], ids=list(data.get('children') or ()))
+
+    def _comment_from_json(self, data: dict, post_id: str) -> CommentDTO:
+        """Build a CommentDTO from a comment in Reddit's JSON"""
+        html = data.get('body_html')
+        if data['body'] in self._DELETED_BODIES and data['author'] == '[deleted]':
+            body = self._DELETED_MARKDOWN
+            html = self._DELETED_BODY
+        else:
+            body = self._json_body(data['body'], html)
+
+        return CommentDTO(
+            id=data['id'],
+            created=datetime.fromtimestamp(data['created_utc'], timezone.utc),
+            author=data['author'],
+            body=body,
+            parent=data['parent_id'].split('_', 1)[1],
+            post_id=post_id,
+            body_hash=body_hash(html)
+        )
+
+    def _json_body(self, markdown: Optional[str], html: Optional[str]) -> Optional[str]:
+        """Convert the HTML of a body in Reddit's JSON, like the bodies on pages"""
+        source = BeautifulSoup(html, 'html.parser').find(class_='md') if html else None
+        return self._html_node_to_markdown(source) if source else markdown or None
+
+    @staticmethod
+    def _child_tags(node: Tag, css_class: str) -> List[Tag]:
+        """Get the direct children of a node that have the given class"""
+        return [child for child in node.children if isinstance(child, Tag) and css_class in child.get('class', ())]
+
     def _html_node_to_markdown(self, source: Tag) -> Optional[str]:
         """Convert the contents of a BeautifulSoup Tag into markdown"""
+        with metrics.time(MARKDOWN):
+            try:
+                markdown = self._markdown.convert(source)
+            except UnsupportedMarkup as e:
+                self.logger.debug(f'Converting body with markdownify because of <{e}>')
+                markdown = self._html_node_to_markdown_fallback(source)
+
+        return self._STRIP_EMPTY_REGEX.sub('\n\n', markdown) if markdown else None
+
+    def _html_node_to_markdown_fallback(self, source: Tag) -> str:
+        """Convert any HTML by serializing it and running it through markdownify"""
         # Make all links absolute
         for link in source.find_all('a', href=True):
             if str(link['href']).startswith('/'):
-                link['href'] = 'https://old.reddit.com' + link['href']
+                link['href'] = self._LINK_BASE + link['href']
 
         # Remove extraneous empty paragraphs
         html = str(source).replace('\u200B', '')
-        markdown = markdownify(html)
-
-        return self._STRIP_EMPTY_REGEX.sub('\n\n', markdown) if markdown else None
+        return markdownify(html)
 
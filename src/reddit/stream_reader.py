@@ -0,0 +1,92 @@
+import re
+from typing import List, Optional, Tuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from models.models import CommentDTO, PostDTO
+from reddit.reader import HiddenComments, RedditReader
+from utils.metrics import metrics, REDDIT_PARSE
+
+
+class RedditStreamReader(RedditReader):
+    """Reads post pages one comment thread at a time, instead of building a tree of the whole page
+
+    The page is only scanned for where each top-level comment starts and ends. The post, and then every top-level
+    comment with its replies, is parsed on its own, and its tree is freed as soon as its comments are read. The memory
+    it takes depends on the largest thread, not on the size of the page. Comments come thread by thread, instead of
+    level by level, but still after their parent. Pages that can't be split are read as a whole.
+    """
+    # The listing of comments on a post page, or on the page behind 'continue this thread'
+    _COMMENT_AREA_REGEX = re.compile(r'<div\b[^>]*\bid="siteTable_t3_(\w+)"[^>]*>')
+    _DIV_REGEX = re.compile(r'<(/?)div\b')
+    # Everything but the header and the sidebar
+    _MAIN_CONTENT = SoupStrainer(attrs={'role': 'main'})
+
+    def _read_post_page(self, post: PostDTO, html: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Fill in the post's details from its page, and get the comments on it"""
+        with metrics.time(REDDIT_PARSE, page='post'):
+            area = self._split_comment_area(html)
+            if area is not None:
+                post_id, area_start, threads = area
+                soup = BeautifulSoup(html[:area_start], 'html.parser', parse_only=self._MAIN_CONTENT)
+        if area is None:
+            self.logger.warning(f"Couldn't split the comments of {post.reddit_link} into threads, reading the whole page")
+            return super()._read_post_page(post, html, hidden)
+
+        self._read_post_info(post, soup)
+        soup.decompose()
+        return self._thread_comments(html, threads, post_id, hidden)
+
+    def _read_thread_page(self, html: str, hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Get the comments on a page that only shows part of a post's comments"""
+        area = self._split_comment_area(html)
+        if area is None:
+            self.logger.warning("Couldn't split the comments of a thread page into threads, reading the whole page")
+            return super()._read_thread_page(html, hidden)
+        post_id, _, threads = area
+        return self._thread_comments(html, threads, post_id, hidden)
+
+    def _thread_comments(self, html: str, threads: List[Tuple[int, int]], post_id: str,
+                         hidden: List[HiddenComments]) -> List[CommentDTO]:
+        """Get the comments of every top-level comment's thread, each parsed from its own part of the page"""
+        comments = []
+        for start, end in threads:
+            with metrics.time(REDDIT_PARSE, page='thread'):
+                soup = BeautifulSoup(html[start:end], 'html.parser')
+            comments.extend(self._listing_comments(soup, post_id, post_id, hidden))
+            # Trees link to their parents, so they'd only be freed at the next garbage collection otherwise
+            soup.decompose()
+        return comments
+
+    @classmethod
+    def _split_comment_area(cls, html: str) -> Optional[Tuple[str, int, List[Tuple[int, int]]]]:
+        """Find where the comment listing of a page starts, and the start and end of each top-level thing in it
+
+        Returns the post's Reddit ID with those positions, or None if the page has no comment listing, or its <div>
+        tags don't add up.
+        """
+        area = cls._COMMENT_AREA_REGEX.search(html)
+        if area is None:
+            return None
+
+        threads = []
+        depth = 0
+        start = None
+        for tag in cls._DIV_REGEX.finditer(html, area.end()):
+            if not tag.group(1):
+                if depth == 0:
+                    start = tag.start()
+                depth += 1
+                continue
+            if depth == 0:
+                # The end of the comment listing
+                return area.group(1), area.start(), threads
+            depth -= 1
+            if depth == 0:
+                end = html.find('>', tag.end())
+                if end < 0:
+                    return None
+                # Leave out the spacers between things
+                if 'thing' in html[start:html.find('>', start)]:
+                    threads.append((start, end + 1))
+        return None
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Type
+
+from sqlalchemy import DateTime, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session as DbSession
+
+from models.models import Base, Comment, Post
+from utils.metrics import metrics, DB_COMMIT, ERRORS
+
+
+class WriteBatcher:
+    """Collects new rows and inserts them in bulk, instead of committing them one by one
+
+    Every row is appended to a journal file before it is queued, and the journal is emptied once the rows are committed.
+    Rows for things that already exist on Lemmy therefore survive a crash, and are inserted by replay() on the next
+    start. The journal is forced to disk once per batch rather than per row, so a crash of the machine, unlike one of
+    the bot, may lose the rows of the batch that was being collected.
+    """
+    # Parents are inserted before their children
+    _MODELS: List[Type[Base]] = [Post, Comment]
+
+    def __init__(self, db: DbSession, journal_path: str, batch_size: int = 100, batch_interval: int = 1000):
+        self._db = db
+        self._journal_path = journal_path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval / 1000  # Milliseconds
+        self._pending: Dict[str, List[dict]] = {model.__tablename__: [] for model in self._MODELS}
+        self._pending_count = 0
+        self._pending_since: Optional[float] = None
+        self._journal = open(journal_path, 'a+', encoding='utf-8')
+        self._logger: logging.Logger = logging.getLogger(__name__)
+
+    def add(self, row: Base):
+        """Queue a new row, flushing the queue when it is full or has been waiting for too long"""
+        table = row.__tablename__
+        values = {column.key: getattr(row, column.key) for column in row.__table__.columns}
+
+        self._journal.write(json.dumps({'table': table, 'row': values}, default=datetime.isoformat) + '\n')
+        self._journal.flush()
+
+        self._pending[table].append(values)
+        self._pending_count += 1
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+        if self._pending_count >= self.batch_size or time.monotonic() - self._pending_since >= self.batch_interval:
+            self.flush()
+
+    def flush(self) -> bool:
+        """Insert all queued rows. Returns False if they couldn't be saved; they stay queued and journaled"""
+        if not self._pending_count:
+            return True
+
+        try:
+            os.fsync(self._journal.fileno())
+            with metrics.time(DB_COMMIT, operation='insert'):
+                self._insert(self._pending)
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't save {self._pending_count} rows to the local database, will try again. {str(e)}")
+            return False
+
+        for rows in self._pending.values():
+            rows.clear()
+        self._pending_count = 0
+        self._pending_since = None
+        self._journal.truncate(0)
+        return True
+
+    def replay(self):
+        """Insert the rows that were journaled, but never committed before the last shutdown
+
+        Entries that can't be read or saved are logged and set aside in a file next to the journal, so they don't keep
+        the bot from starting.
+        """
+        self._journal.seek(0)
+        entries = []
+        for line in self._journal:
+            try:
+                entry = json.loads(line)
+                entries.append((line, entry['table'], self._deserialize(entry['table'], entry['row'])))
+            except json.JSONDecodeError:
+                # The last line may have been cut off by the crash. The Lemmy write it belongs to wasn't saved either.
+                self._reject(line, 'damaged')
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                self._reject(line, f'{type(e).__name__}: {str(e)}')
+
+        if entries:
+            self._logger.warning(f"Recovering {len(entries)} rows from {self._journal_path} that weren't saved before "
+                                 f"exiting")
+            try:
+                self._insert(self._by_table(entries))
+                self._db.commit()
+            except Exception as e:
+                self._db.rollback()
+                self._logger.warning(f"Couldn't recover the rows at once, trying them one by one. {str(e)}")
+                for entry in entries:
+                    try:
+                        self._insert(self._by_table([entry]))
+                        self._db.commit()
+                    except Exception as e:
+                        self._db.rollback()
+                        self._reject(entry[0], f'{type(e).__name__}: {str(e)}')
+        self._journal.truncate(0)
+
+    def _reject(self, line: str, reason: str):
+        """Set a journal entry that can't be recovered aside, so it can be looked into"""
+        path = self._journal_path + '.rejected'
+        self._logger.error(f"Journal entry can't be recovered ({reason}), moving it to {path}: {line.strip()}")
+        with open(path, 'a', encoding='utf-8') as rejected:
+            rejected.write(line.rstrip('\n') + '\n')
+
+    def _by_table(self, entries: List[Tuple[str, str, dict]]) -> Dict[str, List[dict]]:
+        rows = {model.__tablename__: [] for model in self._MODELS}
+        for _, table, row in entries:
+            rows[table].append(row)
+        return rows
+
+    def _insert(self, rows: Dict[str, List[dict]]):
+        """Bulk insert rows per table, ignoring rows that were already saved"""
+        dialect = self._db.get_bind().dialect.name
+        for model in self._MODELS:
+            if not rows[model.__tablename__]:
+                continue
+            if dialect == 'sqlite':
+                statement = sqlite.insert(model).on_conflict_do_nothing()
+            elif dialect == 'postgresql':
+                statement = postgresql.insert(model).on_conflict_do_nothing()
+            else:
+                statement = insert(model)
+            self._db.execute(statement, rows[model.__tablename__])
+
+    def _deserialize(self, table: str, row: dict) -> dict:
+        """Turn a journaled row back into column values. Raises KeyError for unknown tables and columns"""
+        columns = {model.__tablename__: model for model in self._MODELS}[table].__table__.columns
+        for key, value in row.items():
+            if value is not None and isinstance(columns[key].type, DateTime):
+                row[key] = datetime.fromisoformat(value)
+        return row
@@ -1,15 +1,137 @@
+import logging
+import os
+import threading
+from typing import List, Optional
+
 import yaml
 
-with open('./data/config.yaml') as config:
+CONFIG_PATH = os.getenv('CONFIG_PATH', './data/config.yaml')
+# Settings that take effect when the config file changes while the bot runs. The others need a restart.
+RELOADABLE = ('community_map', 'header_position')
+_REQUIRED = ('community_map', 'lemmy_base_uri', 'max_post_age', 'request_interval', 'scrape_interval', 'user_agent')
+_COMMUNITY_KEYS = ('subreddit', 'community', 'post_header')
+_SORTS = ('new', 'hot')
+_HEADER_POSITIONS = ('top', 'bottom')
+
+
+class ConfigError(ValueError):
+    """The config file can't be read, or holds settings the bot can't work with"""
+
+
+def read_config(path: str) -> dict:
+    """Read and check a config file, filling in the defaults of the community map. Raises ConfigError if it's invalid"""
     try:
-        data = yaml.safe_load(config)
-    except yaml.YAMLError as e:
-        print(e)
+        with open(path) as file:
+            data = yaml.safe_load(file)
+    except (OSError, yaml.YAMLError) as e:
+        raise ConfigError(f"Couldn't read {path}: {str(e)}") from e
+
+    if not isinstance(data, dict):
+        raise ConfigError(f'{path} should hold a mapping of settings')
+    missing = [key for key in _REQUIRED if key not in data]
+    if missing:
+        raise ConfigError(f"{path} misses {', '.join(missing)}")
+    if data.setdefault('header_position', 'top') not in _HEADER_POSITIONS:
+        raise ConfigError(f"header_position should be one of {', '.join(_HEADER_POSITIONS)}")
+
+    community_map = data['community_map']
+    if not isinstance(community_map, list):
+        raise ConfigError('community_map should be a list of communities')
+    subreddits = set()
+    for number, com in enumerate(community_map, start=1):
+        if not isinstance(com, dict) or any(not isinstance(com.get(key), str) for key in _COMMUNITY_KEYS):
+            raise ConfigError(f"Community {number} of community_map needs a {', '.join(_COMMUNITY_KEYS)}")
+        if com.setdefault('sort', 'new') not in _SORTS:
+            raise ConfigError(f"Sort of {com['subreddit']} should be one of {', '.join(_SORTS)}")
+        if com['subreddit'].lower() in subreddits:
+            raise ConfigError(f"{com['subreddit']} is in community_map more than once")
+        subreddits.add(com['subreddit'].lower())
+    return data
+
+
+class ReloadableConfig:
+    """The settings of the config file that can be changed without restarting the bot
+
+    The file is read again when it's modified, or when asked to with request_reload(), like on SIGHUP. Changes take
+    effect at the next call to reload_if_changed(), which the bot makes between work items. A file that can't be read
+    or is invalid is logged and ignored, so the bot carries on with the settings it has until the file is fixed.
+    """
+
+    def __init__(self, path: str, data: dict):
+        self._path = path
+        self._data = data
+        self._mtime = self._modified()
+        self._requested = threading.Event()
+        self._logger: logging.Logger = logging.getLogger(__name__)
+        self.community_map: List[dict] = data['community_map']
+        self.header_position: str = data['header_position']
+
+    def request_reload(self):
+        """Read the file again at the next check, even if it wasn't modified. Safe to call from a signal handler"""
+        self._requested.set()
+
+    def reload_if_changed(self) -> bool:
+        """Read the file again if it was modified or a reload was requested. Returns True if the settings changed"""
+        mtime = self._modified()
+        if mtime == self._mtime and not self._requested.is_set():
+            return False
+        self._requested.clear()
+        # An invalid file isn't read again until it's modified again
+        self._mtime = mtime
+        try:
+            data = read_config(self._path)
+        except ConfigError as e:
+            self._logger.error(f'Keeping the current settings: {str(e)}')
+            return False
+
+        restart = sorted(key for key in data.keys() | self._data.keys()
+                         if key not in RELOADABLE and data.get(key) != self._data.get(key))
+        if restart:
+            self._logger.warning(f"Changes to {', '.join(restart)} take effect after a restart")
+        changed = any(data[key] != self._data[key] for key in RELOADABLE)
+        # The settings that need a restart stay as they were read at the start
+        self._data = {key: data[key] if key in RELOADABLE else value for key, value in self._data.items()}
+        self.community_map = data['community_map']
+        self.header_position = data['header_position']
+        if changed:
+            self._logger.info(f'Reloaded {self._path}, mapping {len(self.community_map)} communities')
+        return changed
+
+    def _modified(self) -> Optional[int]:
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+
+data = read_config(CONFIG_PATH)
+config = ReloadableConfig(CONFIG_PATH, data)
 
-COMMUNITY_MAP = data['community_map']
 LEMMY_BASE_URI = data['lemmy_base_uri']
-HEADER_POSITION = data['header_position']
 MAX_POST_AGE = data['max_post_age']
 REQUEST_INTERVAL = data['request_interval']
+REQUEST_BURST = data.get('request_burst', 1)
+FETCH_WORKERS = data.get('fetch_workers', 1)
+READER_BACKEND = data.get('reader_backend', 'html')
+FEED_GROUP_SIZE = data.get('feed_group_size', 10)
+MORE_COMMENTS_REQUESTS = data.get('more_comments_requests', 10)
+MORE_COMMENTS_BATCH_SIZE = data.get('more_comments_batch_size', 100)
+MORE_COMMENTS_DEPTH = data.get('more_comments_depth', 3)
+COMMENT_WORKERS = data.get('comment_workers', 1)
+WRITE_BATCH_SIZE = data.get('write_batch_size', 100)
+WRITE_BATCH_INTERVAL = data.get('write_batch_interval', 1000)
+WRITE_JOURNAL = data.get('write_journal', './data/write_journal.jsonl')
+ID_CACHE_SIZE = data.get('id_cache_size', 10000)
+COMMUNITY_CACHE_TTL = data.get('community_cache_ttl', 86400)
+LEMMY_SESSION_TTL = data.get('lemmy_session_ttl', 86400)
+RECONCILE_PAGES = data.get('reconcile_pages', 5)
+LEMMY_MAX_WRITE_RATE = data.get('lemmy_max_write_rate', 0)
+LEMMY_WRITE_RETRIES = data.get('lemmy_write_retries', 3)
 SCRAPE_INTERVAL = data['scrape_interval']
-USER_AGENT = data['user_agent']
\ No newline at end of file
+MIN_UPDATE_INTERVAL = data.get('min_update_interval', SCRAPE_INTERVAL // 4)
+MAX_UPDATE_INTERVAL = data.get('max_update_interval', MAX_POST_AGE)
+UPDATE_BATCH_SIZE = data.get('update_batch_size', 10)
+PRUNE_INTERVAL = data.get('prune_interval', SCRAPE_INTERVAL)
+LEASE_DURATION = data.get('lease_duration', 900)
+USER_AGENT = data['user_agent']
+VACUUM_THRESHOLD = data.get('vacuum_threshold', 0.1)
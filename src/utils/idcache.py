@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+
+class IdCache:
+    """Size-bounded LRU map of Reddit comment IDs to the IDs of their copies on Lemmy
+
+    Parents of new comments are usually posted in an earlier round, so looking them up here saves a database query per
+    comment. Every entry remembers the Lemmy post it belongs to, so entries of removed posts can be dropped.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = max(size, 1)
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[int, int]]' = OrderedDict()  # Reddit ID -> (Lemmy ID, Lemmy post ID)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, reddit_id: str) -> Optional[int]:
+        """Look up the Lemmy ID of a comment, counting the hit or miss"""
+        with self._lock:
+            entry = self._entries.get(reddit_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(reddit_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, reddit_id: str, lemmy_id: int, post_id: int):
+        """Remember the Lemmy ID of a comment, evicting the least recently used entries when full"""
+        with self._lock:
+            self._entries[reddit_id] = (lemmy_id, post_id)
+            self._entries.move_to_end(reddit_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def warm(self, post_id: int, mappings: Iterable[Tuple[str, int]]):
+        """Load the (Reddit ID, Lemmy ID) pairs of all stored comments on a post"""
+        for reddit_id, lemmy_id in mappings:
+            self.put(reddit_id, lemmy_id, post_id)
+
+    def discard_posts(self, post_ids: Iterable[int]):
+        """Forget the comments of posts that were removed from the database"""
+        post_ids = set(post_ids)
+        with self._lock:
+            for reddit_id in [key for key, (_, post_id) in self._entries.items() if post_id in post_ids]:
+                del self._entries[reddit_id]
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f'{len(self._entries)} entries, {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate)'
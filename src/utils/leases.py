@@ -0,0 +1,80 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as DbSession
+
+from models.models import Lease
+from utils.metrics import metrics, DB_COMMIT, ERRORS
+
+
+class Leases:
+    """Claims on work in the database, so several workers can share it without doing the same work twice
+
+    A worker may only read a feed or update a post while it holds the lease on it. Leases expire, so the work of a
+    worker that died is taken over by the others once its leases run out. Claims are committed right away, and are
+    atomic on SQLite and PostgreSQL: of workers claiming the same lease at the same time, only one gets it.
+    """
+
+    def __init__(self, db: DbSession, owner: str):
+        self._db = db
+        self.owner = owner  # Identifies this worker
+        self._logger: logging.Logger = logging.getLogger(__name__)
+
+    def claim(self, resource: str, duration: int) -> bool:
+        """Take or extend the lease on a resource for duration seconds. Returns False if another worker holds it"""
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=duration)
+        try:
+            # Extend our own lease, or take over an expired one
+            claimed = self._db.execute(
+                update(Lease)
+                .where(Lease.resource == resource, or_(Lease.owner == self.owner, Lease.expires_at <= now))
+                .values(owner=self.owner, expires_at=expires_at)
+            ).rowcount == 1
+            if not claimed:
+                claimed = self._db.execute(
+                    self._insert_new().values(resource=resource, owner=self.owner, expires_at=expires_at)
+                ).rowcount == 1
+            with metrics.time(DB_COMMIT, operation='lease'):
+                self._db.commit()
+        except IntegrityError:
+            # Another worker inserted the lease first
+            self._db.rollback()
+            return False
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't claim {resource}: {str(e)}")
+            return False
+        return claimed
+
+    def release(self, resource: str):
+        """Give up a lease, so other workers can take the resource right away"""
+        self._release(Lease.resource == resource)
+
+    def release_all(self):
+        """Give up all leases of this worker, like when it shuts down"""
+        self._release(Lease.owner == self.owner)
+
+    def _release(self, condition):
+        try:
+            self._db.execute(delete(Lease).where(condition, Lease.owner == self.owner))
+            with metrics.time(DB_COMMIT, operation='lease'):
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't release leases: {str(e)}")
+
+    def _insert_new(self):
+        """An insert that does nothing if the lease already exists"""
+        dialect = self._db.get_bind().dialect.name
+        if dialect == 'sqlite':
+            return sqlite.insert(Lease).on_conflict_do_nothing()
+        if dialect == 'postgresql':
+            return postgresql.insert(Lease).on_conflict_do_nothing()
+        # Other databases raise an IntegrityError for the duplicate
+        return insert(Lease)
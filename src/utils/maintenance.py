@@ -0,0 +1,74 @@
+import logging
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+# Negative sizes are in KiB rather than pages
+_CACHE_SIZE = -16000
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+class SqliteMaintenance:
+    """Keeps a SQLite database small and fast without rewriting the whole file every round
+
+    Connections use WAL journaling, so reads don't block on writes, and the database uses incremental auto-vacuum, so
+    free pages can be returned a few at a time. They are only returned once they make up a noticeable part of the file.
+    Databases other than SQLite are left alone.
+    """
+
+    def __init__(self, engine: Engine, vacuum_threshold: float = 0.1):
+        self._engine = engine
+        self.vacuum_threshold = vacuum_threshold  # Share of free pages in the file that triggers a cleanup
+        self.enabled = engine.dialect.name == 'sqlite'
+        self._logger: logging.Logger = logging.getLogger(__name__)
+        if self.enabled:
+            event.listen(engine, 'connect', self._configure_connection)
+
+    @staticmethod
+    def _configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Has to be set before the first table is created, or be followed by a vacuum to take effect
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode = WAL')
+        # A crash may lose the last commits, but can't corrupt the database in WAL mode
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute(f'PRAGMA cache_size = {_CACHE_SIZE}')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.close()
+
+    def prepare(self):
+        """Switch an existing database to incremental auto-vacuum. This vacuums the whole file once"""
+        if not self.enabled:
+            return
+
+        with self._connect() as conn:
+            if conn.execute(text('PRAGMA auto_vacuum')).scalar() == _AUTO_VACUUM_INCREMENTAL:
+                return
+            self._logger.warning('Switching the database to incremental auto-vacuum, this may take a while')
+            conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+            conn.execute(text('VACUUM'))
+
+    def _connect(self):
+        # Vacuuming can't happen inside a transaction
+        return self._engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    def run(self):
+        """Return free pages to the file system and refresh query statistics, if enough pages are free"""
+        if not self.enabled:
+            return
+
+        try:
+            with self._connect() as conn:
+                page_count = conn.execute(text('PRAGMA page_count')).scalar()
+                free_pages = conn.execute(text('PRAGMA freelist_count')).scalar()
+                if not page_count or free_pages / page_count < self.vacuum_threshold:
+                    self._logger.debug(f'Database has {free_pages} free pages out of {page_count}, no cleanup needed')
+                    return
+
+                # The pragma frees one page per step, and sqlite3's execute() only takes a single step
+                conn.connection.executescript('PRAGMA incremental_vacuum; PRAGMA optimize;')
+        except Exception as e:
+            self._logger.error(f"Couldn't clean up the database, will try again next round. {str(e)}")
+            return
+
+        self._logger.info(f'Returned {free_pages} free pages out of {page_count} to the file system')
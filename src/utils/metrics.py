@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Histograms
+REDDIT_FETCH = 'leddit_reddit_fetch_seconds'
+REDDIT_PARSE = 'leddit_reddit_parse_seconds'
+RATE_LIMIT_WAIT = 'leddit_rate_limit_wait_seconds'
+MARKDOWN = 'leddit_markdown_seconds'
+LEMMY_REQUEST = 'leddit_lemmy_request_seconds'
+DB_COMMIT = 'leddit_db_commit_seconds'
+SCHEDULE_LAG = 'leddit_schedule_lag_seconds'
+# Counters
+POSTS_SYNCED = 'leddit_posts_synced_total'
+COMMENTS_SYNCED = 'leddit_comments_synced_total'
+PAGES_UNCHANGED = 'leddit_pages_unchanged_total'
+EDITS_SYNCED = 'leddit_edits_synced_total'
+LEMMY_THROTTLED = 'leddit_lemmy_throttled_total'
+ERRORS = 'leddit_errors_total'
+# Gauges
+LEMMY_WRITE_RATE = 'leddit_lemmy_write_rate'
+
+_DESCRIPTIONS = {
+    REDDIT_FETCH: ('histogram', 'Time spent waiting for responses from Reddit'),
+    REDDIT_PARSE: ('histogram', 'Time spent parsing Reddit pages and feeds, by page type'),
+    RATE_LIMIT_WAIT: ('histogram', 'Time requests to Reddit were held back by the rate limiter'),
+    MARKDOWN: ('histogram', 'Time spent converting a post or comment body to markdown'),
+    LEMMY_REQUEST: ('histogram', 'Time spent waiting for Lemmy to answer, by action'),
+    DB_COMMIT: ('histogram', 'Time spent committing to the local database, by operation'),
+    SCHEDULE_LAG: ('histogram', 'Time work items started after they were due, by kind'),
+    POSTS_SYNCED: ('counter', 'Posts created on Lemmy'),
+    COMMENTS_SYNCED: ('counter', 'Comments created on Lemmy'),
+    PAGES_UNCHANGED: ('counter', 'Post pages and feeds that were skipped because they did not change, by page type'),
+    EDITS_SYNCED: ('counter', 'Posts and comments edited on Lemmy after they were edited on Reddit, by kind'),
+    LEMMY_THROTTLED: ('counter', 'Writes Lemmy turned away or didn\'t finish in time, by status code'),
+    ERRORS: ('counter', 'Errors, by the phase they happened in and their type'),
+    LEMMY_WRITE_RATE: ('gauge', 'Writes per second Lemmy is sent at most, since it last throttled one'),
+}
+_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_name', '_labels', '_start')
+
+    def __init__(self, metrics: 'Metrics', name: str, labels: dict):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.observe(self._name, time.perf_counter() - self._start, **self._labels)
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of this process, in the Prometheus text format
+
+    Everything is a no-op until enable() is called, so the instrumentation doesn't cost anything when no exporter is
+    configured.
+    """
+    _DISABLED_TIMER = nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        # Per-bucket counts including +Inf, then the sum and the count
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        """Set a gauge"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a measurement to a histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(_BUCKETS) + 3)
+            histogram[bisect_left(_BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def time(self, name: str, **labels):
+        """Context manager that adds the time spent in it to a histogram"""
+        if not self.enabled:
+            return self._DISABLED_TIMER
+        return _Timer(self, name, labels)
+
+    def render(self) -> str:
+        """Describe all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            values = {**self._counters, **self._gauges}
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, description) in _DESCRIPTIONS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(_BUCKETS + (float('inf'),), histogram):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram[-2]:g}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    values = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + values + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_stats_file(path: str, interval: float):
+    logger = logging.getLogger(__name__)
+    while True:
+        try:
+            with open(path + '.tmp', 'w') as stats:
+                stats.write(metrics.render())
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.error(f"Couldn't write metrics to {path}: {str(e)}")
+        time.sleep(interval)
+
+
+def start_exporter() -> Optional[str]:
+    """Enable metrics and start exporting them, if METRICS_PORT or METRICS_FILE is set
+
+    METRICS_PORT serves them over HTTP on METRICS_HOST (127.0.0.1 by default). METRICS_FILE writes them to a file every
+    METRICS_INTERVAL seconds (15 by default), for instance for node_exporter's textfile collector.
+    Returns where the metrics can be found.
+    """
+    port = os.getenv('METRICS_PORT')
+    path = os.getenv('METRICS_FILE')
+    if port:
+        server = ThreadingHTTPServer((os.getenv('METRICS_HOST', '127.0.0.1'), int(port)), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        location = f'http://{server.server_address[0]}:{server.server_address[1]}/metrics'
+    elif path:
+        interval = float(os.getenv('METRICS_INTERVAL', 15))
+        threading.Thread(target=_write_stats_file, args=(path, interval), name='metrics-file', daemon=True).start()
+        location = path
+    else:
+        return None
+
+    metrics.enable()
+    return location
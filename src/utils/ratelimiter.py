@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+
+class TokenBucket:
+    """Thread-safe token bucket, shared by everything that sends requests to the same service
+
+    Tokens are handed out in order of arrival, so concurrent callers queue up behind each other instead of waking up at
+    the same time and all but one going back to sleep.
+    """
+
+    def __init__(self, interval: float, burst: int = 1):
+        self.interval = interval  # Seconds between two tokens
+        self.burst = max(burst, 1)  # Tokens that can be saved up while idle
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, waiting until it becomes available. Returns the time spent waiting"""
+        if self.interval <= 0:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+            self._updated = now
+            # Reserve a token, possibly one that still has to be generated
+            self._tokens -= 1
+            wait = -self._tokens * self.interval if self._tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """Token bucket whose rate follows what the service can take: additive increase, multiplicative decrease
+
+    While requests go through, the rate rises by step every second, up to max_rate. A throttled request cuts the rate
+    by factor, down to min_rate, and holds back all requests until the service is ready for them again. Requests that
+    were already underway when it happened don't cut it again. Without a max_rate, requests aren't limited until the
+    first one is throttled. The rate is then cut from the rate the last requests were sent at.
+    """
+
+    def __init__(self, max_rate: float = 0, min_rate: float = 1 / 60, step: float = 0.5, factor: float = 0.5):
+        super().__init__(1 / max_rate if max_rate > 0 else 0)
+        self.max_rate = max_rate  # Requests per second, 0 for no limit
+        self.min_rate = min_rate
+        self.step = step
+        self.factor = factor
+        self._held_until = 0.0
+        self._raised = time.monotonic()
+        self._sent = deque(maxlen=20)  # When the last requests were let through, to measure their rate without a limit
+
+    @property
+    def rate(self) -> float:
+        """Requests per second that are allowed now, 0 if they aren't limited"""
+        return 1 / self.interval if self.interval > 0 else 0.0
+
+    def acquire(self) -> float:
+        with self._lock:
+            hold = max(self._held_until - time.monotonic(), 0.0)
+        if hold:
+            time.sleep(hold)
+        wait = hold + super().acquire()
+        with self._lock:
+            self._sent.append(time.monotonic())
+        return wait
+
+    def succeeded(self) -> float:
+        """Raise the rate after a request went through. Returns the new rate"""
+        with self._lock:
+            now = time.monotonic()
+            if self.interval > 0:
+                rate = 1 / self.interval + self.step * (now - self._raised)
+                self.interval = 1 / (min(rate, self.max_rate) if self.max_rate > 0 else rate)
+            self._raised = now
+            return self.rate
+
+    def throttled(self, retry_after: Optional[float] = None) -> float:
+        """Cut the rate after a request was throttled, and hold back requests for retry_after seconds
+
+        Without retry_after, requests are held back for the new interval. Returns the new rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._held_until:
+                rate = self.rate or self._sent_rate() or 1.0
+                self.interval = 1 / max(rate * self.factor, self.min_rate)
+            self._raised = now
+            self._held_until = max(self._held_until, now + (self.interval if retry_after is None else retry_after))
+            return self.rate
+
+    def _sent_rate(self) -> Optional[float]:
+        """Rate at which the last requests were let through, if enough of them were"""
+        if len(self._sent) < 2 or self._sent[-1] <= self._sent[0]:
+            return None
+        return (len(self._sent) - 1) / (self._sent[-1] - self._sent[0])
@@ -0,0 +1,110 @@
+import itertools
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from typing import Callable, List, Optional
+
+from utils.metrics import metrics, ERRORS, SCHEDULE_LAG
+
+# Lower runs first when several work items are due
+PRIORITY_FEED = 0
+PRIORITY_POSTS = 1
+PRIORITY_PRUNE = 2
+
+
+@dataclass
+class WorkItem:
+    """Something the bot has to do at some point, like reading a feed
+
+    The action returns when it wants to run again, or None if it's done for good.
+    """
+    kind: str  # What sort of work this is, for logs and metrics
+    name: str
+    priority: int
+    deadline: datetime
+    action: Callable[[], Optional[datetime]] = field(repr=False)
+
+
+class Scheduler:
+    """Runs work items one at a time, each once its deadline has passed
+
+    Of the items that are due, the one with the highest priority goes first, then the one that has waited longest. A
+    new post on Reddit therefore doesn't have to wait for all due posts to be updated before its feed is read. When
+    nothing is due, the scheduler sleeps until the next deadline. Requests to Reddit are still paced by the reader's
+    rate limiter, so the scheduler only decides what gets the next requests.
+
+    Before it picks the next item, the scheduler calls before_next, which may add items, like when the config changed.
+    """
+    # Delay before retrying an item whose action raised an exception
+    RETRY_DELAY = timedelta(seconds=60)
+
+    def __init__(self, before_next: Optional[Callable[[], None]] = None):
+        self._before_next = before_next
+        self._pending: List[tuple] = []  # By deadline
+        self._ready: List[tuple] = []  # By priority, then deadline
+        self._sequence = itertools.count()  # Keeps items with equal keys in the order they were added
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._logger: logging.Logger = logging.getLogger(__name__)
+
+    def add(self, item: WorkItem):
+        heappush(self._pending, (item.deadline, next(self._sequence), item))
+
+    def stop(self):
+        """Stop once the current work item is done. Safe to call from a signal handler"""
+        self._stopping.set()
+        self._wakeup.set()
+
+    def wake(self):
+        """Pick the next item now, instead of sleeping until the next deadline. Safe to call from a signal handler"""
+        self._wakeup.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def next_item(self, now: datetime) -> Optional[WorkItem]:
+        """Take the work item that should run now, if any is due"""
+        while self._pending and self._pending[0][0] <= now:
+            _, sequence, item = heappop(self._pending)
+            heappush(self._ready, (item.priority, item.deadline, sequence, item))
+        return heappop(self._ready)[-1] if self._ready else None
+
+    def run_item(self, item: WorkItem, now: datetime):
+        """Run a work item and schedule its next run"""
+        metrics.observe(SCHEDULE_LAG, (now - item.deadline).total_seconds(), kind=item.kind)
+        self._logger.debug(f'Running {item.kind} {item.name}, due at {item.deadline}')
+        try:
+            deadline = item.action()
+        except Exception as e:
+            metrics.inc(ERRORS, phase=item.kind, type=type(e).__name__)
+            self._logger.exception(f'{item.kind} {item.name} failed, retrying in {self.RETRY_DELAY}: {str(e)}')
+            deadline = datetime.utcnow() + self.RETRY_DELAY
+        if deadline is not None:
+            item.deadline = deadline
+            self.add(item)
+
+    def run(self):
+        """Keep running work items until stop() is called"""
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            if self._before_next is not None:
+                try:
+                    self._before_next()
+                except Exception as e:
+                    metrics.inc(ERRORS, phase='schedule', type=type(e).__name__)
+                    self._logger.exception(f'Preparing the next work item failed: {str(e)}')
+            now = datetime.utcnow()
+            item = self.next_item(now)
+            if item is not None:
+                self.run_item(item, now)
+            elif self._stopping.is_set():
+                # stop() came in after the wakeup was cleared, so waiting would sleep until the next deadline
+                continue
+            elif self._pending:
+                self._wakeup.wait((self._pending[0][0] - now).total_seconds())
+            else:
+                self._logger.warning('Nothing left to do')
+                return
@@ -1,201 +1,558 @@
 import logging
+import os
 import re
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from heapq import heappush, heappop
 from operator import attrgetter
-from typing import Type, List, Optional
+from typing import Type, Dict, List, Optional, Iterable, Iterator, Tuple, Set
 
-from requests import HTTPError
-from sqlalchemy import and_
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session as DbSession
 
 from pythorhead import Lemmy
-from models.models import PostDTO, Post, CommentDTO, Comment
+from pythorhead.types import CommentSortType, ListingType, SortType
+from models.models import PostDTO, Post, CommentDTO, Comment, Community, FeedDTO, FeedMark, SORT_NEW, BODY_HASH_PREFIX
 from reddit.reader import RedditReader
-from utils.config import COMMUNITY_MAP, HEADER_POSITION, MAX_POST_AGE, LEMMY_BASE_URI
+from utils.batcher import WriteBatcher
+from utils.idcache import IdCache
+from utils.leases import Leases
+from utils.ratelimiter import AdaptiveTokenBucket
+from utils.throttle import LemmyThrottle
+from utils.metrics import metrics, COMMENTS_SYNCED, DB_COMMIT, EDITS_SYNCED, ERRORS, LEMMY_REQUEST, PAGES_UNCHANGED, \
+    POSTS_SYNCED
+from utils.config import config, MAX_POST_AGE, LEMMY_BASE_URI, FETCH_WORKERS, \
+    COMMENT_WORKERS, MIN_UPDATE_INTERVAL, MAX_UPDATE_INTERVAL, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL, WRITE_JOURNAL, \
+    ID_CACHE_SIZE, FEED_GROUP_SIZE, COMMUNITY_CACHE_TTL, LEMMY_SESSION_TTL, UPDATE_BATCH_SIZE, SCRAPE_INTERVAL, \
+    LEASE_DURATION, RECONCILE_PAGES, LEMMY_MAX_WRITE_RATE, LEMMY_WRITE_RETRIES
 
 _VALID_TITLE = re.compile(r".*\S{3,}.*")
+# Stay well below SQLite's limit on the number of parameters in a single query
+_QUERY_CHUNK_SIZE = 500
+# Lemmy lists at most this many posts or comments at a time
+_LEMMY_PAGE_SIZE = 50
+# The header prepare_comment() gives every comment, with its Reddit ID
+_COMMENT_MARKER = re.compile(r'\*\*.+?\*\* at .+? ID: `(\w+)`')
+_SUBREDDIT_LINK = re.compile(r'/r/([^/]+)/')
+# Owner of the leases of a worker that wasn't given an ID, which is fine as long as it's the only one
+DEFAULT_WORKER_ID = 'default'
 class Syncer:
 
-    def __init__(self, db: DbSession, reddit_reader: RedditReader, username: str, password: str):
+    def __init__(self, db: DbSession, reddit_reader: RedditReader, username: str, password: str,
+                 worker_id: Optional[str] = None):
         
         self._db: DbSession = db
         self._reddit_reader: RedditReader = reddit_reader
         self._lemmy = Lemmy(LEMMY_BASE_URI)
+        # Writes are paced to what the instance can take. The limiter is shared by the threads posting comments
+        self._lemmy_throttle = LemmyThrottle(self._lemmy, AdaptiveTokenBucket(LEMMY_MAX_WRITE_RATE),
+                                             LEMMY_WRITE_RETRIES)
         self._logger: logging.Logger = logging.getLogger(__name__)
         self._username = username
         self._password = password
+        # The login is reused across rounds, until it gets old or a write fails
+        self._session_expires: Optional[datetime] = None
+        # Reddit pages are fetched and parsed in the background, while the database and Lemmy are only touched from the
+        # calling thread. The reader's rate limiter is shared by all fetchers.
+        self._fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='reddit-fetch')
+        # Sibling comments don't depend on each other, so they can be posted to Lemmy at the same time
+        self._comment_pool = ThreadPoolExecutor(max_workers=COMMENT_WORKERS, thread_name_prefix='lemmy-comment')
+        # New posts and comments are saved in bulk. Rows that didn't make it to the database last time are saved first.
+        # Workers sharing a data directory each keep their own journal
+        journal = WRITE_JOURNAL
+        if worker_id:
+            root, extension = os.path.splitext(WRITE_JOURNAL)
+            journal = f'{root}.{worker_id}{extension}'
+        self._writes = WriteBatcher(db, journal, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL)
+        self._writes.replay()
+        # Lemmy IDs of comments that new replies may refer to, kept across rounds
+        self._id_cache = IdCache(ID_CACHE_SIZE)
+        # Feeds and posts this worker is working on, so other workers sharing the database skip them
+        self._leases = Leases(db, worker_id or DEFAULT_WORKER_ID)
+        # What was seen of the feeds this worker reads, by feed, so unchanged feeds cost no queries
+        self._feeds: Dict[str, FeedDTO] = {}
+        # When the leases of this worker on the feeds it reads run out
+        self._feed_leases: Dict[str, datetime] = {}
 
     def scrape_new_posts(self):
-        for com in COMMUNITY_MAP:
-            subreddit = com['subreddit']
-            community = com['community']
-            sort = com['sort']
-            post_header = com['post_header']
-
-            self._logger.info(f'Getting community ID: {community}')
-            community_id = self._lemmy.discover_community(community)
-
-            self._logger.info(f'Scraping subreddit: {subreddit}')
-            try:
-                posts = self._reddit_reader.get_subreddit_topics(subreddit, mode=sort)
-            except BaseException as e:
-                self._logger.error(f"Error trying to retrieve topics: {str(e)}")
+        for group in self.feed_groups(config.community_map):
+            if not self.scrape_feed(group):
                 return
 
-            posts = self.filter_posted(posts)
-
-            # Handle oldest entries first.
-            posts = sorted(posts, key=attrgetter('updated'))
-
-            try:
-                self._lemmy.log_in(self._username, self._password)
+    def scrape_feed(self, group: List[dict]) -> bool:
+        """Clone new posts of a group of communities from their combined feed. Returns False if something failed"""
+        subreddits = [com['subreddit'] for com in group]
+        sort = group[0]['sort']
+        name = self.feed_name(group)
+
+        # The worker that reads a feed keeps it, as long as it keeps reading it in time. The lease lasts two polls, and
+        # is only renewed when it wouldn't outlast the next one by half of lease_duration, so every other poll writes
+        now = datetime.utcnow()
+        expires_at = self._feed_leases.get(name)
+        if expires_at is None or expires_at - now < timedelta(seconds=SCRAPE_INTERVAL + LEASE_DURATION / 2):
+            duration = 2 * SCRAPE_INTERVAL + LEASE_DURATION
+            if not self._leases.claim(f'feed:{name}', duration):
+                self._logger.debug(f'Another worker reads the feed of {"+".join(subreddits)}')
+                # Its marks move on in the meantime
+                self._feeds.pop(name, None)
+                self._feed_leases.pop(name, None)
+                return True
+            self._feed_leases[name] = now + timedelta(seconds=duration)
+        feed = self._feeds.get(name)
+        if feed is None:
+            feed = self._feeds[name] = self.load_feed(subreddits, sort)
+
+        self._logger.info(f'Scraping subreddit: {"+".join(subreddits)}')
+        try:
+            if len(subreddits) == 1:
+                posts = self._reddit_reader.get_subreddit_topics(subreddits[0], mode=sort, feed=feed)
+                topics = None if posts is None else {subreddits[0]: posts}
+            else:
+                topics = self._reddit_reader.get_grouped_topics(subreddits, mode=sort, feed=feed)
+        except BaseException as e:
+            metrics.inc(ERRORS, phase='reddit_feed', type=type(e).__name__)
+            self._logger.error(f"Error trying to retrieve topics: {str(e)}")
+            return False
+
+        if topics is None:
+            self._logger.debug(f'Feed of {"+".join(subreddits)} is unchanged')
+            metrics.inc(PAGES_UNCHANGED, page='feed')
+            return True
+        for com in group:
+            if not self.scrape_community(com, topics[com['subreddit']], feed):
+                return False
+        return True
+
+    def forget_feed(self, name: str):
+        """Stop reading a feed, like when its communities were changed in the config"""
+        self._feeds.pop(name, None)
+        self._feed_leases.pop(name, None)
+        self._leases.release(f'feed:{name}')
 
-            except HTTPError as e:
-                self._logger.error(
-                    f"Couldn\'t log in to account {self._username} on {LEMMY_BASE_URI}."
-                )
-                return
+    @staticmethod
+    def feed_name(group: List[dict]) -> str:
+        """Name of the combined feed of a group of communities"""
+        return f'{group[0]["sort"]}:{"+".join(com["subreddit"] for com in group)}'
 
-            for post in posts:
+    @staticmethod
+    def feed_groups(community_map: List[dict]) -> List[List[dict]]:
+        """Split the community map in groups of at most FEED_GROUP_SIZE communities that share a sort mode
+
+        Every group's subreddits are read from one combined feed. Groups keep the order of the community map.
+        """
+        groups = []
+        open_groups = {}
+        for com in community_map:
+            group = open_groups.get(com['sort'])
+            if group is None or len(group) >= max(FEED_GROUP_SIZE, 1):
+                group = open_groups[com['sort']] = []
+                groups.append(group)
+            group.append(com)
+        return groups
+
+    def scrape_community(self, com: dict, posts: List[PostDTO], feed: Optional[FeedDTO] = None) -> bool:
+        """Clone new posts from a subreddit's feed to its community. Returns False if the scrape should stop
+
+        With the feed they were read from, the subreddit's mark is moved past the posts that are synced.
+        """
+        subreddit = com['subreddit']
+        community = com['community']
+        post_header = com['post_header']
+
+        # Handle oldest entries first.
+        posts = sorted(posts, key=attrgetter('updated'))
+        unsynced = {post.reddit_link for post in self.filter_posted(posts)}
+        try:
+            if not unsynced:
+                return True
+
+            if not self.log_in():
+                return False
+            community_id = self.get_community_id(community)
+            if community_id is None:
+                self._logger.error(f"Couldn't find community {community} on {LEMMY_BASE_URI}, skipping /r/{subreddit}")
+                return True
+
+            new_posts = [post for post in posts if post.reddit_link in unsynced]
+            for post, details in self._prefetch_post_details(new_posts):
                 self._logger.info(post)
                 try:
-                    post, comments = self._reddit_reader.get_post_details(post)
+                    post, comments = details.result()
                 except BaseException as e:
+                    metrics.inc(ERRORS, phase='reddit_post', type=type(e).__name__)
                     self._logger.error(f"Error trying to retrieve post details, try again in a bit; {str(e)}")
-                    return
+                    return False
                 post = self.clone_to_lemmy(post, subreddit, community_id, post_header)
-                
-                self.clone_comments_to_lemmy(post, comments)
+                if post is None:
+                    continue
+                unsynced.discard(post.reddit_link)
+
+                if self.clone_comments_to_lemmy(post, comments):
+                    self.save_fingerprint(post)
+            return True
+        finally:
+            # Rows that are still queued, like those of a flush that failed, don't wait for the next round
+            self._writes.flush()
+            if feed is not None:
+                self.advance_mark(com, feed, posts, unsynced)
+
+    def load_feed(self, subreddits: List[str], sort: str) -> FeedDTO:
+        """Start reading a feed at the marks of its subreddits that are saved in the database"""
+        feed = FeedDTO()
+        if sort != SORT_NEW:
+            # Other feeds aren't sorted by age, so they're always read completely
+            return feed
+        try:
+            for mark in self._db.query(FeedMark).filter(FeedMark.sort == sort, FeedMark.subreddit.in_(subreddits)):
+                # Saved without the timezone of Reddit's timestamps, which is UTC
+                updated = mark.updated if mark.updated.tzinfo else mark.updated.replace(tzinfo=timezone.utc)
+                feed.marks[mark.subreddit] = (updated, mark.reddit_link)
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't load the marks of {'+'.join(subreddits)}, reading the whole feed. {str(e)}")
+        return feed
+
+    def advance_mark(self, com: dict, feed: FeedDTO, posts: List[PostDTO], unsynced: Set[str]):
+        """Move the mark of a subreddit to the newest of its posts that were synced before the first that wasn't
+
+        The posts are sorted oldest first. If some weren't synced, the whole feed is read again next time, so they
+        are tried again.
+        """
+        if unsynced:
+            feed.etag = feed.last_modified = feed.fingerprint = None
+        if com['sort'] != SORT_NEW:
+            return
 
-    def update_comments(self):
-        """Remove old posts and update comments of posts"""
+        newest = None
+        for post in posts:
+            if post.reddit_link in unsynced:
+                break
+            newest = post
+        if newest is None:
+            return
+
+        feed.marks[com['subreddit']] = (newest.updated, newest.reddit_link)
         try:
-            self._lemmy.log_in(self._username, self._password)
+            self._db.merge(FeedMark(subreddit=com['subreddit'], sort=SORT_NEW, updated=newest.updated,
+                                    reddit_link=newest.reddit_link))
+            with metrics.time(DB_COMMIT, operation='feed_mark'):
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't save the mark of /r/{com['subreddit']} to local database. {str(e)}")
 
-        except HTTPError as e:
-            self._logger.error(
-                f"Couldn\'t log in to account {self._username} on {LEMMY_BASE_URI}."
-            )
+    def update_comments(self):
+        """Remove old posts and update comments of posts that are due"""
+        if not self.log_in():
             return
 
         # Remove aged posts from the database
         self.clear_aged()
-        db_post_list = self._db.query(Post).filter(Post.enabled.is_(True)).all()
-
-        for db_post in db_post_list:
-            self._logger.info(f'Updating post with ID {db_post.id}')
-            post = PostDTO(
+        # In batches, so other workers can take their share of the due posts
+        while self.update_due_posts(UPDATE_BATCH_SIZE) >= UPDATE_BATCH_SIZE:
+            pass
+
+    def update_due_posts(self, limit: Optional[int] = None) -> int:
+        """Update comments of the posts that have been due longest, at most limit of them. Returns how many were updated
+
+        Posts that another worker is updating are skipped.
+        """
+        if not self.log_in():
+            return 0
+
+        due = self._db.query(Post.id).filter(
+            Post.enabled.is_(True),
+            Post.next_update_at <= datetime.utcnow()
+        ).order_by(Post.next_update_at).all()
+        claimed = []
+        for post_id, in due:
+            if limit and len(claimed) >= limit:
+                break
+            if self._leases.claim(f'post:{post_id}', LEASE_DURATION):
+                claimed.append(post_id)
+
+        # Another worker may have updated a post between looking it up and claiming it
+        db_post_list = self._db.query(Post).filter(
+            Post.id.in_(claimed),
+            Post.next_update_at <= datetime.utcnow()
+        ).order_by(Post.next_update_at).all()
+        for post_id in set(claimed) - {db_post.id for db_post in db_post_list}:
+            self._leases.release(f'post:{post_id}')
+        db_posts = {db_post.id: db_post for db_post in db_post_list}
+        posts = [
+            PostDTO(
                 reddit_link=db_post.reddit_link,
                 title='Unused',
                 created=db_post.created,
                 updated=db_post.updated,
                 author=db_post.author,
-                lemmy_id=db_post.id)
-            try:
-                post, comments = self._reddit_reader.get_post_details(post)
-            except BaseException as e:
-                self._logger.error(f"Error trying to retrieve updated comments for post {db_post.reddit_link}, try again in a bit; {str(e)}")
+                lemmy_id=db_post.id,
+                fingerprint=db_post.fingerprint,
+                etag=db_post.etag,
+                last_modified=db_post.last_modified)
+            for db_post in db_post_list
+        ]
+
+        unchanged = 0
+        for post, details in self._prefetch_post_details(posts):
+            # The batch may have taken longer than its leases, so the lease is renewed before the post is touched
+            if not self._leases.claim(f'post:{post.lemmy_id}', LEASE_DURATION):
+                self._logger.info(f'Another worker took over post with ID {post.lemmy_id}')
                 continue
+            try:
+                if self._db.query(Post.id).filter(Post.id == post.lemmy_id,
+                                                  Post.next_update_at <= datetime.utcnow()).first() is None:
+                    self._logger.info(f'Post with ID {post.lemmy_id} was updated by another worker')
+                    continue
+                unchanged += not self._update_post(post, details, db_posts[post.lemmy_id])
+            finally:
+                self._leases.release(f'post:{post.lemmy_id}')
+
+        self._writes.flush()
+        self._logger.info(f'Checked {len(posts)} due posts, {unchanged} of which were skipped as unchanged')
+        self._logger.info(f'Parent ID cache: {self._id_cache.stats()}')
+        return len(posts)
+
+    def _update_post(self, post: PostDTO, details: Future, db_post: Post) -> bool:
+        """Sync new comments of a post and plan its next update. Returns False if its page was unchanged"""
+        self._logger.info(f'Updating post with ID {post.lemmy_id}')
+        try:
+            post, comments = details.result()
+        except BaseException as e:
+            metrics.inc(ERRORS, phase='reddit_post', type=type(e).__name__)
+            self._logger.error(f"Error trying to retrieve updated comments for post {post.reddit_link}, try again in a bit; {str(e)}")
+            # Back off, instead of retrying it right away
+            self.reschedule(db_post, new_comments=False)
+            with metrics.time(DB_COMMIT, operation='schedule'):
+                self._db.commit()
+            return True
+
+        if comments is None:
+            self._logger.debug(f'Post with ID {post.lemmy_id} is unchanged')
+            metrics.inc(PAGES_UNCHANGED, page='post')
+            self.reschedule(db_post, new_comments=False)
+            if (post.etag, post.last_modified) != (db_post.etag, db_post.last_modified):
+                self.save_fingerprint(post)
+            else:
+                with metrics.time(DB_COMMIT, operation='schedule'):
+                    self._db.commit()
+            return False
+
+        stored = self.stored_comments(comments)
+        edits_synced = self.sync_edits(post, db_post, comments, stored)
+        filtered_comments = [comment for comment in comments if comment.id not in stored]
+        cloned = self.clone_comments_to_lemmy(post, filtered_comments)
+        # Only changed now, so the update doesn't keep a write transaction open while the comments are posted
+        self.reschedule(db_post, new_comments=bool(filtered_comments))
+        if cloned and edits_synced:
+            self.save_fingerprint(post)
+        else:
+            with metrics.time(DB_COMMIT, operation='schedule'):
+                self._db.commit()
+        return True
 
-            filtered_comments = self.filter_posted_comments(comments)
-            self.clone_comments_to_lemmy(post, filtered_comments)
+    def next_update_due(self) -> Optional[datetime]:
+        """When the next post is due for an update, or None if there are no posts to update"""
+        return self._db.query(func.min(Post.next_update_at)).filter(Post.enabled.is_(True)).scalar()
+
+    @staticmethod
+    def reschedule(db_post: Post, new_comments: bool):
+        """Plan the next update of a post, based on whether it got new comments since the last one
+
+        The interval is halved when new comments came in and doubled when they didn't, within the configured bounds. A
+        post is never scheduled after it ages out. Once it has had its last update, it isn't due anymore, and stays in
+        the database only until it's pruned.
+        """
+        interval = db_post.update_interval or MIN_UPDATE_INTERVAL
+        interval = interval // 2 if new_comments else interval * 2
+        db_post.update_interval = max(MIN_UPDATE_INTERVAL, min(interval, MAX_UPDATE_INTERVAL))
+        now = datetime.utcnow()
+        aged_out = db_post.created + timedelta(seconds=MAX_POST_AGE)
+        db_post.next_update_at = min(now + timedelta(seconds=db_post.update_interval), aged_out) \
+            if now < aged_out else None
+
+    def _prefetch_post_details(self, posts: Iterable[PostDTO]) -> Iterator[Tuple[PostDTO, Future]]:
+        """Retrieve the details of posts in the background, yielding them in the given order
+
+        Only a few pages are fetched ahead of the consumer, so parsed pages don't pile up while Lemmy catches up.
+        Fetches that haven't started yet are cancelled when the consumer stops early.
+        """
+        lookahead = 2 * FETCH_WORKERS
+        pending = deque()
+        try:
+            for post in posts:
+                pending.append((post, self._fetch_pool.submit(self._reddit_reader.get_post_details, post)))
+                if len(pending) >= lookahead:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            for _, details in pending:
+                details.cancel()
+
+    def release_leases(self):
+        """Let other workers take over this worker's feeds and posts right away, like when it shuts down"""
+        self._feed_leases.clear()
+        self._leases.release_all()
+
+    def log_in(self) -> bool:
+        """Log in to Lemmy, unless the last login is recent enough to be reused"""
+        now = datetime.utcnow()
+        if self._session_expires is not None and now < self._session_expires:
+            return True
+
+        if not self._lemmy.log_in(self._username, self._password):
+            self._logger.error(
+                f"Couldn\'t log in to account {self._username} on {LEMMY_BASE_URI}."
+            )
+            return False
+        self._session_expires = now + timedelta(seconds=LEMMY_SESSION_TTL)
+        return True
+
+    def end_session(self):
+        """Log in again before the next round, in case a write failed because the login was no longer valid
+
+        pythorhead doesn't tell why a request failed, so any failed write ends the session.
+        """
+        self._session_expires = None
+
+    def get_community_id(self, name: str) -> Optional[int]:
+        """Find the Lemmy ID of a community
+
+        IDs are saved in the database, and only looked up on Lemmy again when they're older than COMMUNITY_CACHE_TTL.
+        If that lookup fails, the saved ID is used for now.
+        """
+        community = self._db.get(Community, name)
+        now = datetime.utcnow()
+        if community is not None and now - community.resolved_at < timedelta(seconds=COMMUNITY_CACHE_TTL):
+            return community.id
+
+        self._logger.info(f'Getting community ID: {name}')
+        response = self._lemmy.community.get(name=name)
+        if response is None:
+            if community is None:
+                return None
+            self._logger.warning(f"Couldn't refresh the ID of community {name}, using #{community.id} for now")
+            return community.id
+
+        community_id = response['community_view']['community']['id']
+        try:
+            if community is None:
+                self._db.add(Community(name=name, id=community_id, resolved_at=now))
+            else:
+                community.id = community_id
+                community.resolved_at = now
+            with metrics.time(DB_COMMIT, operation='community'):
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't save the ID of community {name} to local database. {str(e)}")
+        return community_id
+
+    def save_fingerprint(self, post: PostDTO):
+        """Remember what the post's page looked like, so it isn't parsed again until it changes
+
+        Only call this once everything on the page has been synced, otherwise missed comments will not be retried.
+        """
+        try:
+            self._db.query(Post).filter(Post.id == post.lemmy_id).update({
+                Post.fingerprint: post.fingerprint,
+                Post.etag: post.etag,
+                Post.last_modified: post.last_modified,
+            })
+            with metrics.time(DB_COMMIT, operation='fingerprint'):
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't save the fingerprint of {post.reddit_link} to local database. {str(e)}")
 
     def filter_posted(self, posts: List[PostDTO]) -> List[PostDTO]:
         """Filter out any posts that have already been synced to Lemmy"""
-        reddit_links = [post.reddit_link for post in posts]
-        existing_links_raw = self._db.query(Post.reddit_link).filter(Post.reddit_link.in_(reddit_links)).all()
-        existing_links = [link[0] for link in existing_links_raw]
-
-        # filtered_posts = [post for post in posts if post.reddit_link not in existing_links]
-        filtered_posts = []
-        for post in posts:
-            if post.reddit_link not in existing_links:
-                filtered_posts.append(post)
-        return filtered_posts
+        existing_links = self._find_existing(Post.reddit_link, [post.reddit_link for post in posts])
+        return [post for post in posts if post.reddit_link not in existing_links]
     
-    def filter_posted_comments(self, comments: List[CommentDTO]) -> List[CommentDTO]:
-        comment_ids = [comment.id for comment in comments]
-        existing_comments_raw = self._db.query(Comment.reddit_id).filter(Comment.reddit_id.in_(comment_ids)).all()
-        existing_comments = [comment[0] for comment in existing_comments_raw]
-        
-        filtered_comments = []
-        for comment in comments:
-           if comment.id not in existing_comments:
-              filtered_comments.append(comment)
-        return filtered_comments
+    def stored_comments(self, comments: List[CommentDTO]) -> Dict[str, Tuple[int, Optional[str]]]:
+        """Look up the Lemmy ID and body hash of the comments that have already been synced, by their Reddit ID"""
+        stored = {}
+        reddit_ids = [comment.id for comment in comments]
+        for start in range(0, len(reddit_ids), _QUERY_CHUNK_SIZE):
+            chunk = reddit_ids[start:start + _QUERY_CHUNK_SIZE]
+            query = self._db.query(Comment.reddit_id, Comment.id, Comment.body_hash) \
+                .filter(Comment.reddit_id.in_(chunk))
+            stored.update((reddit_id, (comment_id, hashed)) for reddit_id, comment_id, hashed in query)
+        return stored
+
+    def _find_existing(self, column, values: List[str]) -> Set[str]:
+        """Look up which of the values are stored in an indexed column, a chunk at a time"""
+        existing = set()
+        for start in range(0, len(values), _QUERY_CHUNK_SIZE):
+            chunk = values[start:start + _QUERY_CHUNK_SIZE]
+            existing.update(value for value, in self._db.query(column).filter(column.in_(chunk)))
+        return existing
     
     def clear_aged(self):
         """Remove any posts and their comments that are older than the maximum update age from the database"""
-        aged_posts = self._db.query(Post).filter(Post.enabled.is_(True), and_(Post.created <= datetime.utcnow() - timedelta(seconds=MAX_POST_AGE))).all()
+        aged_posts = select(Post.id).where(
+            Post.enabled.is_(True),
+            Post.created <= datetime.utcnow() - timedelta(seconds=MAX_POST_AGE)
+        )
 
-        for aged_post in aged_posts:
-            try:
-                aged_comments = self._db.query(Comment).filter(Comment.post_id == aged_post.id)
-                for comment in aged_comments:
-                    self._db.delete(comment)
-                    self._db.commit()
-                
-                self._db.delete(aged_post)
+        try:
+            aged_ids = self._db.scalars(aged_posts).all()
+            comment_count = self._db.query(Comment).filter(Comment.post_id.in_(aged_posts)) \
+                .delete(synchronize_session=False)
+            post_count = self._db.query(Post).filter(Post.id.in_(aged_posts)).delete(synchronize_session=False)
+            with metrics.time(DB_COMMIT, operation='prune'):
                 self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't delete aged posts from the local database. {str(e)}")
+            return
 
-                self._logger.info(
-                    f"Deleted post {aged_post.id} and its comments from the database."
-                )
-            except Exception as e:
-                self._logger.error(
-                    f"Couldn't delete {aged_post.reddit_link} from the local database. {str(e)}"
-                )
-
-    def clone_to_lemmy(self, post: PostDTO, subreddit: str, community_id: int, post_header: str) -> PostDTO: # Returns PostDTO with Lemmy post ID
+        self._id_cache.discard_posts(aged_ids)
+        if post_count:
+            self._logger.info(f"Deleted {post_count} aged posts and their {comment_count} comments from the database.")
 
+    def clone_to_lemmy(self, post: PostDTO, subreddit: str, community_id: int, post_header: str) -> Optional[PostDTO]:
+        """Post to Lemmy and save the post to the database. Returns the post with its Lemmy ID, or None if it failed"""
         post = self.prepare_post(post, subreddit, post_header)
         self._logger.info(
             f"Attempting to post {post.reddit_link}..."
         )
         try:
-            lemmy_post = self._lemmy.post.create(
-                community_id=community_id,
-                name=post.title,
-                url=post.external_link,
-                body=post.body,
-                nsfw=post.nsfw
-            )
-
-        except HTTPError as e:
-            if e.response.status_code == 504 or e.response.status_code == 502:
-                # ron_burgundy_-_I_dont_believe_you.gif
-                self._logger.warning(f'Timeout when trying to post {post.reddit_link}: {str(e)}\nSuuuure...')
-                # TODO: check if post was actually placed through a search.
-                #  If not, return, so it gets picked up next time
-                previous_id = self._db.query(Post.id).order_by(Post.id.desc()).first()
-                lemmy_post = {'post_view': {'post': {'ap_id': f'{LEMMY_BASE_URI}/post/{previous_id + 1}', 'id': {previous_id + 1}}}}  # hack
-            else:
-                self._logger.error(
-                    f"HTTPError trying to post {post.reddit_link}: {str(e)}: {str(e.response.content)}"
+            with metrics.time(LEMMY_REQUEST, action='post'):
+                lemmy_post = self._lemmy.post.create(
+                    community_id=community_id,
+                    name=post.title,
+                    url=post.external_link,
+                    body=post.body,
+                    nsfw=post.nsfw
                 )
-                return
-
         except Exception as e:
+            metrics.inc(ERRORS, phase='lemmy_post', type=type(e).__name__)
             self._logger.error(
-                # f"Something went horribly wrong when posting {post.reddit_link}: {str(e)}: {str(e.response.content)}"
                 f"Something went horribly wrong when posting {post.reddit_link}: {str(e)}"
             )
-            return
-        
-        try:
-            lemmy_link = lemmy_post['post_view']['post']['ap_id']
-            post.lemmy_id = lemmy_post['post_view']['post']['id']
-
-        except Exception as e: # hack
-            previous = self._db.query(Post.id).order_by(Post.id.desc()).first()
-            post.lemmy_id = previous[0] + 1
-            
-            lemmy_link = f'{LEMMY_BASE_URI}/post/{previous[0] + 1}'
-            self._logger.error(
-                f"""Leddit hit a HTTP Error when posting comment {post.reddit_link} and didn't receive a response: {str(e)}\n
-                However, it has likely been posted to Lemmy. Please do a check!\n
-                This post will be committed to the database."""
-            )
+            return None
+
+        if lemmy_post is None:
+            # pythorhead doesn't tell why. Behind a proxy that gave up waiting, the post may have been made anyway.
+            metrics.inc(ERRORS, phase='lemmy_post', type='NoResponse')
+            self.end_session()
+            lemmy_post = self.find_lemmy_post(post, community_id)
+            if lemmy_post is None:
+                self._logger.error(f"Couldn't post {post.reddit_link}, trying again next round")
+                return None
+            self._logger.warning(f'Posting {post.reddit_link} got no answer, but it is on Lemmy as #{lemmy_post["id"]}')
+        else:
+            lemmy_post = lemmy_post['post_view']['post']
+        post.lemmy_id = lemmy_post['id']
 
         # Save post to database
         try:
@@ -203,100 +560,281 @@ class Syncer:
                 id=post.lemmy_id,
                 community_id=community_id,
                 reddit_link=post.reddit_link,
-                lemmy_link=lemmy_link,
+                lemmy_link=lemmy_post['ap_id'],
                 created=post.created,
                 updated=datetime.utcnow(),
                 author=post.author,
-                enabled=1
+                enabled=1,
+                next_update_at=datetime.utcnow() + timedelta(seconds=MIN_UPDATE_INTERVAL),
+                update_interval=MIN_UPDATE_INTERVAL,
+                body_hash=post.body_hash
             )
-            self._db.add(db_post)
-            self._db.commit()
+            self._writes.add(db_post)
+            metrics.inc(POSTS_SYNCED)
         except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
             self._logger.error(
                 f"Couldn't save {post.reddit_link} to local database. Please remove the existing post from Lemmy (or it will be duplicated next round). {str(e)}"
             )
 
         return post
 
-    def clone_comments_to_lemmy(self, post: PostDTO, comments: List[CommentDTO]):
-
+    def find_lemmy_post(self, post: PostDTO, community_id: int) -> Optional[dict]:
+        """Look for a post among the newest posts of its community on Lemmy, by the link to the original in its body"""
+        markers = self.post_markers(post.reddit_link)
+        for page in range(1, RECONCILE_PAGES + 1):
+            with metrics.time(LEMMY_REQUEST, action='list_posts'):
+                post_views = self._lemmy.post.list(community_id=community_id, sort=SortType.New,
+                                                   limit=_LEMMY_PAGE_SIZE, page=page)
+            for post_view in post_views:
+                if any(marker in (post_view['post'].get('body') or '') for marker in markers):
+                    return post_view['post']
+            if len(post_views) < _LEMMY_PAGE_SIZE:
+                break
+        return None
+
+    def clone_comments_to_lemmy(self, post: PostDTO, comments: List[CommentDTO]) -> bool:
+        """Post comments to Lemmy and save them to the database. Returns whether all comments were synced
+
+        Up to COMMENT_WORKERS comments are posted at the same time. Replies are posted as soon as their parent's Lemmy ID
+        is known, and comments are started in the order they were given, so a single worker posts them one by one.
+        Comments that got no answer from Lemmy are looked up on the post in one go, once nothing else can be posted.
+        """
+        synced = True
         comments_map = {}
-        previous = self._db.query(Comment.id).order_by(Comment.id.desc()).first()
-        try:
-            id_counter = previous[0]
-        except TypeError:
-            id_counter = 1 # hack of a hack
+        warmed = False
 
-        for comment in comments:
-            comment = self.prepare_comment(post.reddit_link, post.author, comment)
-            try:
-                parent_lemmy = None if comment.parent == comment.post_id else comments_map[comment.parent]
+        batch = {comment.id for comment in comments}
+        waiting = {}  # Replies to comments in this batch, by the Reddit ID of their parent
+        ready = []  # Heap of comments that can be posted, by their position in the batch
 
-            # Search comment database if parent comment has already been posted in a previous round
-            except KeyError:
-                result = self._db.query(Comment).filter(Comment.reddit_id == comment.parent).first()
-                parent_lemmy = result.id
+        for position, comment in enumerate(comments):
+            comment = self.prepare_comment(post.reddit_link, post.author, comment)
+            if comment.parent == comment.post_id:
+                heappush(ready, (position, comment, None))
+            elif comment.parent in comments_map:
+                heappush(ready, (position, comment, comments_map[comment.parent]))
+            elif comment.parent in batch:
+                waiting.setdefault(comment.parent, []).append((position, comment))
+            else:
+                # The parent has been posted in a previous round. Load the IDs of all comments on the post the first
+                # time one isn't cached, rather than querying them one by one.
+                parent_lemmy = self._id_cache.get(comment.parent)
+                if parent_lemmy is None and not warmed:
+                    self.warm_id_cache(post)
+                    warmed = True
+                    parent_lemmy = self._id_cache.get(comment.parent)
+                if parent_lemmy is None:
+                    # Only when the cache is too small to hold all comments on the post
+                    parent_lemmy = self._db.query(Comment.id).filter(Comment.reddit_id == comment.parent) \
+                        .limit(1).scalar()
+                if parent_lemmy is None:
+                    self._logger.error(f"Couldn't find parent {comment.parent} of {comment.id}, skipping it")
+                    synced = False
+                    continue
                 comments_map[comment.parent] = parent_lemmy
-
-            self._logger.info(
-                f"Attempting to post {comment.id}..."
-            )
-            try:
-                lemmy_comment = self._lemmy.comment.create(
+                heappush(ready, (position, comment, parent_lemmy))
+
+        in_flight = {}
+        unanswered = {}  # Comments that may have been posted even though Lemmy didn't say so, by their Reddit ID
+        while ready or in_flight or unanswered:
+            posted = []  # Comments and their Lemmy IDs
+            if not ready and not in_flight:
+                found = self.find_lemmy_comments(post, set(unanswered))
+                for reddit_id, lemmy_comment_id in found.items():
+                    self._logger.warning(f'Posting {reddit_id} got no answer, but it is on Lemmy as '
+                                         f'#{lemmy_comment_id}')
+                    posted.append((unanswered.pop(reddit_id), lemmy_comment_id))
+                for comment in unanswered.values():
+                    self._logger.error(f"Couldn't post {comment.id}, trying again next round")
+                    synced = False
+                unanswered.clear()
+
+            while ready and len(in_flight) < COMMENT_WORKERS:
+                position, comment, parent_lemmy = heappop(ready)
+                self._logger.info(
+                    f"Attempting to post {comment.id}..."
+                )
+                lemmy_comment = self._comment_pool.submit(
+                    self._create_comment,
                     content=comment.body,
                     post_id=post.lemmy_id,
                     parent_id=parent_lemmy
                 )
+                in_flight[lemmy_comment] = (position, comment)
 
-            except HTTPError as e:
-                if e.response.status_code == 504 or e.response.status_code == 502:
-                    # ron_burgundy_-_I_dont_believe_you.gif
-                    self._logger.warning(f'Timeout or Bad Gateway when trying to post {post.reddit_link}: {str(e)}\nSuuuure...')
-                    # TODO: Refactor duplicates
-                    lemmy_comment = {'comment_view': {'comment': {'id': {id_counter + 1}}}}  # hack
-                else:
+            done = wait(in_flight, return_when=FIRST_COMPLETED).done if in_flight else set()
+            for future in sorted(done, key=lambda f: in_flight[f][0]):
+                position, comment = in_flight.pop(future)
+                try:
+                    lemmy_comment = future.result()
+                except Exception as e:
+                    metrics.inc(ERRORS, phase='lemmy_comment', type=type(e).__name__)
                     self._logger.error(
-                        f"HTTPError trying to post {comment.id}: {str(e)}: {str(e.response.content)}"
+                        f"Something went horribly wrong when posting {comment.id}: {str(e)}"
                     )
+                    synced = False
                     continue
 
-            except Exception as e:
-                self._logger.error(
-                    f"Something went horribly wrong when posting {comment.id}: {str(e)}"
-                )
-                continue
+                if lemmy_comment is None:
+                    metrics.inc(ERRORS, phase='lemmy_comment', type='NoResponse')
+                    unanswered[comment.id] = comment
+                    continue
+                posted.append((comment, lemmy_comment['comment_view']['comment']['id']))
 
-            try:
-                lemmy_comment_id = lemmy_comment['comment_view']['comment']['id']
+            for comment, lemmy_comment_id in posted:
                 # Dictionary to map Reddit ID to Lemmy ID
                 comments_map[comment.id] = lemmy_comment_id
-            
-            except Exception as e: # hack
-                id_counter += 1
-                comments_map[comment.id] = id_counter
-                lemmy_comment_id = id_counter
-                self._logger.error(
-                    f"""Leddit hit a HTTP Error when posting comment {comment.id} and didn't receive a response: {str(e)}\n
-                    However, it has likely been posted to Lemmy. Please do a check!\n
-                    This comment will be committed to the database."""
-                )
+                self._id_cache.put(comment.id, lemmy_comment_id, post.lemmy_id)
 
-            # Save comment to database
-            try:
-                db_comment = Comment(
-                    id=lemmy_comment_id,
-                    reddit_id=comment.id,
-                    created=comment.created,
-                    post_id=post.lemmy_id
-                )
-                self._db.add(db_comment)
-                self._db.commit()
+                # Replies can be posted now that the parent's Lemmy ID is known
+                for reply_position, reply in waiting.pop(comment.id, []):
+                    heappush(ready, (reply_position, reply, lemmy_comment_id))
 
-                id_counter = lemmy_comment_id
+                # Save comment to database
+                try:
+                    db_comment = Comment(
+                        id=lemmy_comment_id,
+                        reddit_id=comment.id,
+                        created=comment.created,
+                        post_id=post.lemmy_id,
+                        body_hash=comment.body_hash
+                    )
+                    self._writes.add(db_comment)
+                    metrics.inc(COMMENTS_SYNCED)
+                except Exception as e:
+                    metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+                    self._logger.error(f"Couldn't save {comment.id} to local database. Please remove the existing comment from Lemmy (or it will be duplicated next round). {str(e)}")
+                    synced = False
+
+        for parent, replies in waiting.items():
+            self._logger.error(
+                f"Couldn't post {parent}, skipping its replies {', '.join(reply.id for _, reply in replies)}"
+            )
+            synced = False
+
+        return self._writes.flush() and synced
+
+    def find_lemmy_comments(self, post: PostDTO, reddit_ids: Set[str]) -> Dict[str, int]:
+        """Look for comments among the newest comments of a post on Lemmy, by the Reddit ID in their header
+
+        Returns the Lemmy IDs of the comments that were found, by their Reddit ID.
+        """
+        found = {}
+        for page in range(1, RECONCILE_PAGES + 1):
+            if len(found) == len(reddit_ids):
+                break
+            with metrics.time(LEMMY_REQUEST, action='list_comments'):
+                comment_views = self._lemmy.comment.list(post_id=post.lemmy_id, sort=CommentSortType.New,
+                                                         type_=ListingType.All, limit=_LEMMY_PAGE_SIZE, page=page)
+            for comment_view in comment_views:
+                marker = _COMMENT_MARKER.match(comment_view['comment']['content'])
+                if marker and marker.group(1) in reddit_ids:
+                    found.setdefault(marker.group(1), comment_view['comment']['id'])
+            if len(comment_views) < _LEMMY_PAGE_SIZE:
+                break
+        return found
+
+    def _create_comment(self, **kwargs) -> Optional[dict]:
+        with metrics.time(LEMMY_REQUEST, action='comment'):
+            lemmy_comment = self._lemmy.comment.create(**kwargs)
+        if lemmy_comment is None:
+            self.end_session()
+        return lemmy_comment
+
+    def sync_edits(self, post: PostDTO, db_post: Post, comments: List[CommentDTO],
+                   stored: Dict[str, Tuple[int, Optional[str]]]) -> bool:
+        """Edit the post and the comments on Lemmy whose body changed on Reddit since they were synced
+
+        Bodies are compared by the hashes the reader took while parsing them. Posts and comments that were synced before
+        bodies were hashed, or whose hash was taken of the markdown by an older version, only get their hash saved.
+        Returns whether all edits went through.
+        """
+        synced = True
+        post_edited = False
+        if post.body_hash is not None and post.body_hash != db_post.body_hash:
+            if not self._comparable(db_post.body_hash) or self.edit_post(post):
+                db_post.body_hash = post.body_hash
+                post_edited = True
+            else:
+                synced = False
 
-            except Exception as e:
-                print(f"Couldn't save {comment.id} to local database. Please remove the existing comment from Lemmy (or it will be duplicated next round). {str(e)}")
+        hashes = []
+        for comment in comments:
+            comment_id, stored_hash = stored.get(comment.id, (None, None))
+            if comment_id is None or comment.body_hash is None or comment.body_hash == stored_hash:
                 continue
+            if self._comparable(stored_hash) and not self.edit_comment(post, comment_id, comment):
+                synced = False
+                continue
+            hashes.append({'id': comment_id, 'body_hash': comment.body_hash})
+        if not hashes and not post_edited:
+            return synced
+
+        try:
+            if hashes:
+                self._db.execute(update(Comment), hashes)
+            with metrics.time(DB_COMMIT, operation='edit'):
+                self._db.commit()
+        except Exception as e:
+            metrics.inc(ERRORS, phase='database', type=type(e).__name__)
+            self._db.rollback()
+            self._logger.error(f"Couldn't save the body hashes of {post.reddit_link} to local database. {str(e)}")
+            return False
+        return synced
+
+    @staticmethod
+    def _comparable(stored_hash: Optional[str]) -> bool:
+        """Whether a stored body hash was taken the way the readers take them, so a different one means an edit"""
+        return stored_hash is not None and stored_hash.startswith(BODY_HASH_PREFIX)
+
+    def edit_post(self, post: PostDTO) -> bool:
+        """Replace the body of a post on Lemmy with its new body on Reddit. Returns False if that failed"""
+        subreddit = _SUBREDDIT_LINK.search(post.reddit_link)
+        com = next((com for com in config.community_map
+                    if subreddit and com['subreddit'].lower() == subreddit.group(1).lower()), None)
+        if com is None:
+            self._logger.warning(f"{post.reddit_link} was edited, but its subreddit isn't in the community map anymore")
+            return True
+
+        post = self.prepare_post(post, com['subreddit'], com['post_header'])
+        self._logger.info(f'Editing post #{post.lemmy_id} to match {post.reddit_link}')
+        with metrics.time(LEMMY_REQUEST, action='edit_post'):
+            edited = self._lemmy.post.edit(post.lemmy_id, body=post.body)
+        if edited is None:
+            metrics.inc(ERRORS, phase='lemmy_edit', type='NoResponse')
+            self.end_session()
+            self._logger.error(f"Couldn't edit post #{post.lemmy_id}, trying again next round")
+            return False
+        metrics.inc(EDITS_SYNCED, kind='post')
+        return True
+
+    def edit_comment(self, post: PostDTO, comment_id: int, comment: CommentDTO) -> bool:
+        """Replace the body of a comment on Lemmy with its new body on Reddit. Returns False if that failed"""
+        comment = self.prepare_comment(post.reddit_link, post.author, comment)
+        self._logger.info(f'Editing comment #{comment_id} to match {comment.id}')
+        with metrics.time(LEMMY_REQUEST, action='edit_comment'):
+            edited = self._lemmy.comment.edit(comment_id, content=comment.body)
+        if edited is None:
+            metrics.inc(ERRORS, phase='lemmy_edit', type='NoResponse')
+            self.end_session()
+            self._logger.error(f"Couldn't edit comment #{comment_id}, trying again next round")
+            return False
+        metrics.inc(EDITS_SYNCED, kind='comment')
+        return True
+
+    def warm_id_cache(self, post: PostDTO):
+        """Cache the Lemmy IDs of all comments on a post that are already in the database"""
+        self._id_cache.warm(
+            post.lemmy_id,
+            self._db.query(Comment.reddit_id, Comment.id).filter(Comment.post_id == post.lemmy_id)
+        )
+
+    @staticmethod
+    def post_markers(reddit_link: str) -> Tuple[str, str]:
+        """Text that prepare_post() puts in the body of a post, of which at least one survives cutting it off"""
+        return (f"[The original]({reddit_link.replace('https://www.', 'https://old.')})",
+                'Content cut off. Read original on ' + reddit_link)
 
     @staticmethod
     def prepare_post(post: PostDTO, subreddit: str, post_header: str) -> PostDTO:
@@ -317,7 +855,7 @@ class Syncer:
             post.external_link = 'https://old.reddit.com' + post.external_link
 
 
-        if HEADER_POSITION == 'bottom':
+        if config.header_position == 'bottom':
             post.body = (post.body + '\n***\n' if post.body else '') + prefix
         else:
             post.body = prefix + ('\n***\n' + post.body if post.body else '')
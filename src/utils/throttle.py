@@ -0,0 +1,112 @@
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from importlib.metadata import version
+from typing import Optional
+
+import requests
+from pythorhead import Lemmy
+from pythorhead.requestor import Request
+
+from utils.metrics import metrics, LEMMY_THROTTLED, LEMMY_WRITE_RATE
+from utils.ratelimiter import AdaptiveTokenBucket
+
+# Answers of a Lemmy instance, or the proxy in front of it, that can't keep up or enforces its rate limits
+_THROTTLED = (429, 502, 503, 504)
+# Of those, the answers to requests that were turned away before Lemmy handled them
+_REJECTED = (429, 503)
+# Longest time a Retry-After header may hold back writes, so the bot doesn't stall on a bogus one
+_MAX_RETRY_AFTER = 300
+# The version of pythorhead whose internals the throttle hooks into, as pinned in requirements.txt
+_PYTHORHEAD_VERSION = '0.10.0'
+# What pythorhead sends with its own requests
+_HEADERS = {
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1',
+    'Sec-GPC': '1',
+    'User-Agent': 'pythorhead/0.5',
+}
+
+
+class LemmyThrottle:
+    """Paces writes to Lemmy to what it can take, and sends them again when it turns them away
+
+    pythorhead doesn't tell why a request failed, so writes to the Lemmy instance are sent from here instead. Answers
+    that Lemmy is throttling or overloaded cut the write rate of the limiter, and hold back writes for as long as a
+    Retry-After header asks. Writes that were turned away before Lemmy handled them are sent again, as are edits,
+    which can safely be made twice. New posts and comments that timed out are left to the syncer, which looks them up
+    on Lemmy before trying again. Reads go through pythorhead as before.
+
+    pythorhead has no hook for this, so the throttle takes over the api() method of its private requestor. Another
+    version of pythorhead may work differently, so one that doesn't look as expected is refused instead of bypassed.
+    """
+
+    def __init__(self, lemmy: Lemmy, limiter: AdaptiveTokenBucket, retries: int):
+        self._logger: logging.Logger = logging.getLogger(__name__)
+        requestor = getattr(lemmy, '_requestor', None)
+        auth = getattr(requestor, '_auth', None)
+        if not callable(getattr(requestor, 'api', None)) or not all(hasattr(auth, key) for key in ('token', 'api_url')):
+            raise TypeError(f'pythorhead {version("pythorhead")} works differently than {_PYTHORHEAD_VERSION}, so '
+                            f'writes to Lemmy could not be throttled')
+        if version('pythorhead') != _PYTHORHEAD_VERSION:
+            self._logger.warning(f'Throttling writes to Lemmy was made for pythorhead {_PYTHORHEAD_VERSION}, not '
+                                 f'{version("pythorhead")}')
+        self._requestor = requestor
+        self._read = self._requestor.api
+        self._requestor.api = self.api
+        self._limiter = limiter
+        self._retries = retries  # Times a write is sent again
+        self._session = requests.Session()
+
+    def api(self, method: Request, endpoint: str, **kwargs) -> Optional[dict]:
+        """Send a request like pythorhead does. Returns the answer, or None if the request failed"""
+        if method is Request.GET:
+            return self._read(method, endpoint, **kwargs)
+
+        auth = self._requestor._auth
+        if auth.token:
+            for data in (kwargs.get('json'), kwargs.get('params')):
+                if data is not None:
+                    data['auth'] = auth.token
+        for attempt in range(self._retries + 1):
+            self._limiter.acquire()
+            try:
+                response = self._session.request(method.value, f'{auth.api_url}{endpoint}', headers=_HEADERS,
+                                                 **kwargs)
+            except requests.RequestException as e:
+                self._logger.error(f'Error encountered while {method.value} {endpoint}: {str(e)}')
+                return None
+            if response.status_code not in _THROTTLED:
+                metrics.set(LEMMY_WRITE_RATE, self._limiter.succeeded())
+                break
+
+            metrics.inc(LEMMY_THROTTLED, status=str(response.status_code))
+            rate = self._limiter.throttled(self.retry_after(response))
+            metrics.set(LEMMY_WRITE_RATE, rate)
+            retry = attempt < self._retries and (response.status_code in _REJECTED or method is Request.PUT)
+            self._logger.warning(f'Lemmy answered {method.value} {endpoint} with {response.status_code}, slowing down '
+                                 f'to {rate:.2f} writes per second{", trying again" if retry else ""}')
+            if not retry:
+                break
+
+        if not response.ok:
+            self._logger.error(f'Error encountered while {method.value} {endpoint}: {response.text}')
+            return None
+        return response.json()
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> Optional[float]:
+        """The seconds a response asks to wait before trying again, if it says so"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0.0), _MAX_RETRY_AFTER)
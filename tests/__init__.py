@@ -6,12 +6,14 @@ from datetime import datetime
 PROJECT_PATH = os.getcwd()
 SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
 sys.path.append(SOURCE_PATH)
+os.environ.setdefault('CONFIG_PATH', os.path.join(PROJECT_PATH, 'config.yaml'))
 
-from models.models import Community, PostDTO
+from models.models import PostDTO, SORT_NEW
 
 utc_now = datetime.utcnow()
 
-TEST_COMMUNITY = Community(id=1, ident="test_subreddit", lemmy_id=665, nsfw=False, sorting='new', enabled=True)
+TEST_COMMUNITY = {'subreddit': 'test_subreddit', 'community': 'test_community', 'sort': SORT_NEW,
+                  'post_header': '##### Test header'}
 TEST_POSTS = [
     PostDTO(reddit_link='https://red.dit/1', title="post 1", author='/u/user1', created=utc_now, updated=utc_now,
             body="Lorem Ipsum is simply dummy text of the printing and typesetting industry. Lorem Ipsum has been the" + " industry's standard dummy text ever since the 1500s, when an unknown printer took a galley of type" + " and scrambled it to make a type specimen book. It has survived not only five centuries, but also t" + "he leap into electronic typesetting, remaining essentially unchanged. It was popularised in the 196" + "0s with the release of Letraset sheets containing Lorem Ipsum passages, and more recently with desk" + "top publishing software like Aldus PageMaker including versions of Lorem Ipsum."),
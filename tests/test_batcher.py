@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.models import Base, Comment, Post
+from utils.batcher import WriteBatcher
+
+
+class WriteBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal_path = os.path.join(directory.name, 'journal.jsonl')
+
+        self.subject = WriteBatcher(self.db, self.journal_path, batch_size=3, batch_interval=60000)
+
+    def _post(self) -> Post:
+        return Post(id=1, community_id=2, reddit_link='https://red.dit/1', lemmy_link='https://lem.my/post/1',
+                    created=datetime(2023, 6, 17, 19, 22), updated=datetime(2023, 6, 17, 20), author='/u/user1',
+                    enabled=1)
+
+    def _comment(self, comment_id: int) -> Comment:
+        return Comment(id=comment_id, reddit_id=f'c{comment_id}', created=datetime(2023, 6, 17, 21), post_id=1)
+
+    def _journal(self) -> str:
+        with open(self.journal_path) as journal:
+            return journal.read()
+
+    def test_rows_are_journaled_until_flushed(self):
+        self.subject.add(self._post())
+        self.subject.add(self._comment(10))
+
+        self.assertEqual(0, self.db.query(Comment).count())
+        self.assertEqual(2, len(self._journal().splitlines()))
+
+        self.assertTrue(self.subject.flush())
+
+        self.assertEqual(1, self.db.query(Post).count())
+        self.assertEqual(['c10'], [comment.reddit_id for comment in self.db.query(Comment)])
+        self.assertEqual('', self._journal())
+
+    def test_full_batch_is_flushed(self):
+        for comment_id in (10, 11, 12):
+            self.subject.add(self._comment(comment_id))
+
+        self.assertEqual(3, self.db.query(Comment).count())
+        self.assertEqual('', self._journal())
+
+    def test_journal_is_synced_once_per_batch(self):
+        with mock.patch.object(os, 'fsync') as fsync:
+            for comment_id in (10, 11, 12):
+                self.subject.add(self._comment(comment_id))
+
+        fsync.assert_called_once()
+
+    def test_old_batch_is_flushed(self):
+        self.subject.batch_interval = 0
+
+        self.subject.add(self._comment(10))
+
+        self.assertEqual(1, self.db.query(Comment).count())
+
+    def test_replay_saves_rows_lost_in_a_crash(self):
+        self.subject.add(self._post())
+        self.subject.add(self._comment(10))
+
+        restarted = WriteBatcher(self.db, self.journal_path)
+        restarted.replay()
+
+        comment = self.db.query(Comment).one()
+        self.assertEqual('c10', comment.reddit_id)
+        self.assertEqual(datetime(2023, 6, 17, 21), comment.created)
+        self.assertEqual(datetime(2023, 6, 17, 19, 22), self.db.query(Post).one().created)
+        self.assertEqual('', self._journal())
+
+    def test_replay_ignores_rows_that_were_saved(self):
+        self.subject.add(self._comment(10))
+        self.db.add(self._comment(10))
+        self.db.commit()
+        with open(self.journal_path, 'a') as journal:
+            journal.write('{"table": "comm')
+
+        restarted = WriteBatcher(self.db, self.journal_path)
+        restarted.replay()
+
+        self.assertEqual(1, self.db.query(Comment).count())
+
+    def test_replay_sets_aside_entries_that_cant_be_recovered(self):
+        self.subject.add(self._post())
+        self.subject.add(self._comment(10))
+        with open(self.journal_path, 'a') as journal:
+            journal.write('{"table": "votes", "row": {"id": 1}}\n')
+            journal.write('{"table": "comments", "row": {"id": 11, "reddit_id": "c11", "created": "yesterday"}}\n')
+            # Violates NOT NULL, so it can't be inserted
+            journal.write('{"table": "comments", "row": {"id": 12, "reddit_id": "c12", "post_id": 1}}\n')
+            journal.write('{"table": "comm')
+
+        restarted = WriteBatcher(self.db, self.journal_path)
+        restarted._logger = mock.Mock()
+        restarted.replay()
+
+        self.assertEqual(['c10'], [comment.reddit_id for comment in self.db.query(Comment)])
+        self.assertEqual(1, self.db.query(Post).count())
+        self.assertEqual('', self._journal())
+        with open(self.journal_path + '.rejected') as rejected:
+            self.assertEqual({'votes', 'c11', 'c12', 'comm'},
+                             {next(word for word in ('votes', 'c11', 'c12', 'comm') if word in line)
+                              for line in rejected})
+        self.assertEqual(4, restarted._logger.error.call_count)
+
+    def test_failed_flush_keeps_rows(self):
+        self.subject.add(self._comment(10))
+        self.db.execute = mock.Mock(side_effect=RuntimeError('disk I/O error'))
+
+        self.assertFalse(self.subject.flush())
+
+        self.assertEqual(1, len(self._journal().splitlines()))
+        del self.db.execute
+        self.assertTrue(self.subject.flush())
+        self.assertEqual(1, self.db.query(Comment).count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import yaml
+
+from utils.config import ConfigError, ReloadableConfig, read_config
+
+_COMMUNITY = {'subreddit': 'sweden', 'community': 'sweden', 'post_header': '##### Header'}
+_CONFIG = {'lemmy_base_uri': 'https://lem.my', 'max_post_age': 86400, 'request_interval': 3,
+           'scrape_interval': 3600, 'user_agent': 'Leddit', 'community_map': [_COMMUNITY]}
+
+
+class ConfigTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'config.yaml')
+        self._write(_CONFIG)
+        self.subject = ReloadableConfig(self.path, read_config(self.path))
+        self.subject._logger = MagicMock()
+
+    def _write(self, data, text: str = None):
+        with open(self.path, 'w') as file:
+            file.write(text if text is not None else yaml.safe_dump(data))
+        # Make sure the change is seen, however coarse the file system's timestamps are
+        mtime = os.stat(self.path).st_mtime_ns + 1_000_000_000
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def test_read_config_fills_in_defaults(self):
+        data = read_config(self.path)
+
+        self.assertEqual('top', data['header_position'])
+        self.assertEqual('new', data['community_map'][0]['sort'])
+
+    def test_read_config_rejects_invalid_settings(self):
+        for data in [dict(_CONFIG, community_map=[{'subreddit': 'sweden'}]),
+                     dict(_CONFIG, community_map=[dict(_COMMUNITY, sort='top')]),
+                     dict(_CONFIG, community_map=[_COMMUNITY, dict(_COMMUNITY, subreddit='Sweden')]),
+                     dict(_CONFIG, header_position='middle'),
+                     {key: value for key, value in _CONFIG.items() if key != 'user_agent'},
+                     ['community_map']]:
+            with self.subTest(data=data):
+                self._write(data)
+                self.assertRaises(ConfigError, read_config, self.path)
+
+    def test_unmodified_file_is_not_read_again(self):
+        self.assertFalse(self.subject.reload_if_changed())
+
+    def test_modified_community_map_is_reloaded(self):
+        community = dict(_COMMUNITY, subreddit='askreddit', community='asklemmy', sort='hot')
+        self._write(dict(_CONFIG, community_map=[_COMMUNITY, community]))
+
+        self.assertTrue(self.subject.reload_if_changed())
+
+        self.assertEqual(['sweden', 'askreddit'], [com['subreddit'] for com in self.subject.community_map])
+        self.assertFalse(self.subject.reload_if_changed())
+
+    def test_invalid_file_keeps_current_settings(self):
+        self._write(None, text='community_map: [subreddit: sweden')
+
+        self.assertFalse(self.subject.reload_if_changed())
+
+        self.assertEqual([dict(_COMMUNITY, sort='new')], self.subject.community_map)
+        self.subject._logger.error.assert_called_once()
+        # It isn't read again until it's fixed
+        self.assertFalse(self.subject.reload_if_changed())
+        self.subject._logger.error.assert_called_once()
+
+    def test_requested_reload_reads_unmodified_file(self):
+        with open(self.path, 'w') as file:
+            file.write(yaml.safe_dump(dict(_CONFIG, header_position='bottom')))
+        os.utime(self.path, ns=(self.subject._mtime, self.subject._mtime))
+        self.assertFalse(self.subject.reload_if_changed())
+
+        self.subject.request_reload()
+
+        self.assertTrue(self.subject.reload_if_changed())
+        self.assertEqual('bottom', self.subject.header_position)
+
+    def test_settings_that_need_a_restart_are_not_applied(self):
+        self._write(dict(_CONFIG, scrape_interval=60))
+
+        self.assertFalse(self.subject.reload_if_changed())
+
+        self.assertIn('scrape_interval', self.subject._logger.warning.call_args.args[0])
+        # The others are, and the ones that need a restart are reported until then
+        self._write(dict(_CONFIG, scrape_interval=60, header_position='bottom'))
+        self.assertTrue(self.subject.reload_if_changed())
+        self.assertEqual('bottom', self.subject.header_position)
+        self.assertEqual(2, self.subject._logger.warning.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from utils.idcache import IdCache
+
+
+class IdCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subject = IdCache(size=3)
+
+    def test_counts_hits_and_misses(self):
+        self.subject.put('c1', 10, 1)
+
+        self.assertEqual(10, self.subject.get('c1'))
+        self.assertIsNone(self.subject.get('c2'))
+        self.assertEqual((1, 1), (self.subject.hits, self.subject.misses))
+
+    def test_evicts_least_recently_used(self):
+        self.subject.warm(1, [('c1', 10), ('c2', 11), ('c3', 12)])
+        self.subject.get('c1')
+        self.subject.put('c4', 13, 1)
+
+        self.assertEqual(3, len(self.subject))
+        self.assertIsNone(self.subject.get('c2'))
+        self.assertEqual(10, self.subject.get('c1'))
+        self.assertEqual(13, self.subject.get('c4'))
+
+    def test_discard_posts(self):
+        self.subject.warm(1, [('c1', 10), ('c2', 11)])
+        self.subject.put('c3', 12, 2)
+
+        self.subject.discard_posts([1])
+
+        self.assertIsNone(self.subject.get('c1'))
+        self.assertIsNone(self.subject.get('c2'))
+        self.assertEqual(12, self.subject.get('c3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from unittest.mock import MagicMock
+
+from bs4 import BeautifulSoup
+
+from models.models import CommentDTO, PostDTO
+from reddit.json_reader import RedditJsonReader
+from reddit.reader import RedditReader
+from tests import get_test_data
+
+
+class RedditJsonReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subject = RedditJsonReader()
+        self.subject.logger = mock.Mock()
+        self.subject._request = mock.Mock()
+
+    def _thread_post(self, **kwargs) -> PostDTO:
+        return PostDTO(reddit_link='https://www.reddit.com/r/todayilearned/comments/14bzcv9/til/', title='Unused',
+                       created=datetime(2023, 6, 17), updated=datetime(2023, 6, 17), author='/u/Flares117', **kwargs)
+
+    def _respond(self, thread: str, headers: dict = None):
+        self.subject._request.return_value = MagicMock(status_code=200, text=thread, headers=headers or {})
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_get_post_details(self):
+        self._respond(get_test_data('today_i_learned_thread.json'), {'ETag': '"abc"'})
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://old.reddit.com/r/todayilearned/comments/14bzcv9/til/.json', params={'raw_json': 1},
+            headers={}
+        )
+        self.assertIsNone(post.body)
+        self.assertFalse(post.nsfw)
+        self.assertEqual('https://en.wikipedia.org/wiki/Antilia_(building)', post.external_link)
+        self.assertTrue(post.fingerprint.startswith('9:'))
+        self.assertEqual('"abc"', post.etag)
+        self.assertEqual([
+            CommentDTO(id='jod1a1a', created=datetime(2023, 6, 17, 19, 30, tzinfo=timezone.utc), author='alice',
+                       body='Six hundred servants?\n\n* one\n* two', parent='14bzcv9', post_id='14bzcv9'),
+            CommentDTO(id='jod0x0x', created=datetime(2023, 6, 17, 19, 45, tzinfo=timezone.utc), author='[deleted]',
+                       body='*This comment was deleted before it could be archived.*', parent='14bzcv9',
+                       post_id='14bzcv9'),
+            CommentDTO(id='jod6f6f', created=datetime(2023, 6, 17, 22, 0, tzinfo=timezone.utc), author='erin',
+                       body='Code: `print(1)`\n\n    x = 2', parent='14bzcv9', post_id='14bzcv9'),
+            CommentDTO(id='jod2b2b', created=datetime(2023, 6, 17, 19, 58, 40, tzinfo=timezone.utc), author='Flares117',
+                       body='It was *also* built on **waqf** land.\n\n> Quote from the article', parent='jod1a1a',
+                       post_id='14bzcv9'),
+            CommentDTO(id='jod3c3c', created=datetime(2023, 6, 17, 20, 2, 11, tzinfo=timezone.utc), author='[deleted]',
+                       body='Account deleted, comment kept.', parent='jod1a1a', post_id='14bzcv9'),
+            # Relative links only work on Reddit, so this one is converted from HTML
+            CommentDTO(id='jod4d4d', created=datetime(2023, 6, 17, 20, 41, 2, tzinfo=timezone.utc), author='carol_',
+                       body='Source: [the wiki](https://old.reddit.com/r/todayilearned/wiki/rules) and '
+                            '[Mumbai](https://en.wikipedia.org/wiki/Mumbai).\n\n',
+                       parent='jod2b2b', post_id='14bzcv9'),
+            CommentDTO(id='jod5e5e', created=datetime(2023, 6, 17, 21, 15, tzinfo=timezone.utc), author='dave',
+                       body='Replying to a ghost.', parent='jod0x0x', post_id='14bzcv9'),
+        ], comments)
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_comments_come_in_the_same_order_as_from_html(self):
+        self._respond(get_test_data('today_i_learned_thread.json'))
+        html_comments = RedditReader().get_comment_details(
+            BeautifulSoup(get_test_data('today_i_learned_thread.html'), 'html.parser')
+        )
+
+        _, comments = self.subject.get_post_details(self._thread_post())
+
+        # The HTML page doesn't show the ID of the deleted comment
+        self.assertEqual([comment.id for comment in html_comments],
+                         [comment.id.replace('jod0x0x', 'deleted-14bzcv9-1687031100') for comment in comments])
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_bodies_are_hashed_the_same_as_from_html(self):
+        self._respond(get_test_data('today_i_learned_thread.json'))
+        html_reader = RedditReader()
+        html_reader._request = mock.Mock(return_value=MagicMock(
+            status_code=200, text=get_test_data('today_i_learned_thread.html'), headers={}
+        ))
+
+        html_post, html_comments = html_reader.get_post_details(self._thread_post())
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        # Switching backends mustn't make the syncer edit every comment on Lemmy
+        self.assertEqual(html_post.body_hash, post.body_hash)
+        self.assertEqual([comment.body_hash for comment in html_comments], [comment.body_hash for comment in comments])
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_get_post_details_skips_unchanged_thread(self):
+        thread = get_test_data('today_i_learned_thread.json')
+        self._respond(thread)
+        post, _ = self.subject.get_post_details(self._thread_post())
+        self.subject.get_listing_comments = mock.Mock()
+
+        post, comments = self.subject.get_post_details(self._thread_post(fingerprint=post.fingerprint))
+
+        self.assertIsNone(comments)
+        self.subject.get_listing_comments.assert_not_called()
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_get_post_details_of_self_post(self):
+        thread = json.loads(get_test_data('today_i_learned_thread.json'))
+        post_info = thread[0]['data']['children'][0]['data']
+        post_info.update(is_self=True, over_18=True, url='https://www.reddit.com/r/todayilearned/comments/14bzcv9/til/',
+                         selftext='E = mc^2', selftext_html='<!-- SC_OFF --><div class="md"><p>E = mc<sup>2</sup></p>\n'
+                                                            '</div><!-- SC_ON -->')
+        self._respond(json.dumps(thread))
+
+        post, _ = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual('E = mc2\n\n', post.body)
+        self.assertTrue(post.nsfw)
+        self.assertIsNone(post.external_link)
+
+    def test_get_post_details_loads_hidden_comments(self):
+        more_children = json.loads(get_test_data('today_i_learned_more_children.json'))
+        # Only jod9z9z and jod8y8y are hidden in this thread
+        more_children['json']['data']['things'] = more_children['json']['data']['things'][:3]
+        self.subject._request.side_effect = [
+            MagicMock(status_code=200, text=get_test_data('today_i_learned_thread.json'), headers={}),
+            MagicMock(status_code=200, text=json.dumps(more_children)),
+            MagicMock(status_code=200, text=get_test_data('today_i_learned_deep_thread.json')),
+        ]
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual([
+            ('jod1a1a', '14bzcv9'), ('jod0x0x', '14bzcv9'), ('jod6f6f', '14bzcv9'), ('jod2b2b', 'jod1a1a'),
+            ('jod3c3c', 'jod1a1a'), ('jod4d4d', 'jod2b2b'), ('jod5e5e', 'jod0x0x'),
+            ('jod9z9z', 'jod2b2b'), ('jod9y9y', 'jod9z9z'), ('jod8y8y', 'jod2b2b'),
+            ('jod7g7g', 'jod6f6f'), ('jod7h7h', 'jod7g7g'),
+        ], [(comment.id, comment.parent) for comment in comments])
+        self.assertEqual('Continued *here*', comments[10].body)
+        self.assertEqual('jod9z9z,jod8y8y', self.subject._request.call_args_list[1].kwargs['params']['children'])
+        # "Continue this thread" links to the comment it was cut off at
+        self.subject._request.assert_called_with(
+            'GET', 'https://old.reddit.com/r/todayilearned/comments/14bzcv9/til/jod6f6f/.json', params={'raw_json': 1}
+        )
+        self.assertTrue(post.fingerprint.startswith('9:'))
+
+    def test_fingerprint_changes_with_loaded_comments(self):
+        thread = get_test_data('today_i_learned_thread.json')
+        post_info = json.loads(thread)[0]['data']['children'][0]['data']
+
+        self.assertNotEqual(
+            RedditJsonReader.get_thread_fingerprint(post_info, json.loads(thread)[1]),
+            RedditJsonReader.get_thread_fingerprint(post_info, json.loads(thread.replace('"jod9z9z"', '"jod7g7g"'))[1])
+        )
+
+    def test_body_is_only_converted_for_reddit_markdown(self):
+        tests = [
+            ('Plain *markdown* with a [link](https://example.com)', False),
+            ('A snake\\_case word and https://www.reddit.com/r/todayilearned', False),
+            ('E = mc^2', True),
+            ('>!Spoiler!<', True),
+            ('[The rules](/r/todayilearned/wiki/rules)', True),
+            ('Ask r/askreddit or /u/spez', True),
+            ('&#x200B;\n\nEmpty first paragraph', True),
+            ('#Heading', True),
+        ]
+
+        for markdown, converted in tests:
+            with self.subTest(markdown):
+                self.subject._html_node_to_markdown = mock.Mock(return_value='converted')
+                body = self.subject._body(markdown, '<div class="md"><p>html</p></div>')
+                self.assertEqual('converted' if converted else markdown, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
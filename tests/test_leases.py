@@ -0,0 +1,46 @@
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models.models import Base, Lease
+from utils.leases import Leases
+
+
+class LeasesTestCase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db_session = sessionmaker(bind=engine)()
+        self.subject = Leases(self.db_session, 'worker1')
+        self.other = Leases(self.db_session, 'worker2')
+
+    def test_claim_is_exclusive(self):
+        self.assertTrue(self.subject.claim('post:1', 60))
+        self.assertTrue(self.subject.claim('post:1', 60))
+        self.assertFalse(self.other.claim('post:1', 60))
+        self.assertTrue(self.other.claim('post:2', 60))
+
+    def test_expired_lease_is_taken_over(self):
+        self.subject.claim('post:1', 60)
+        self.db_session.get(Lease, 'post:1').expires_at = datetime.utcnow() - timedelta(seconds=1)
+        self.db_session.commit()
+
+        self.assertTrue(self.other.claim('post:1', 60))
+        self.assertEqual('worker2', self.db_session.get(Lease, 'post:1').owner)
+        self.assertFalse(self.subject.claim('post:1', 60))
+
+    def test_release_only_gives_up_own_leases(self):
+        self.subject.claim('post:1', 60)
+        self.subject.claim('post:2', 60)
+        self.other.claim('post:3', 60)
+
+        self.other.release('post:1')
+        self.assertFalse(self.other.claim('post:1', 60))
+        self.subject.release('post:1')
+        self.assertTrue(self.other.claim('post:1', 60))
+
+        self.subject.release_all()
+        self.assertEqual({'post:1': 'worker2', 'post:3': 'worker2'},
+                         {lease.resource: lease.owner for lease in self.db_session.query(Lease)})
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from utils.maintenance import SqliteMaintenance
+
+
+class SqliteMaintenanceTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.engine = create_engine('sqlite:///' + os.path.join(directory.name, 'leddit.sqlite'))
+        self.addCleanup(self.engine.dispose)
+
+        self.subject = SqliteMaintenance(self.engine, vacuum_threshold=0.2)
+        self.subject.prepare()
+        with self.engine.connect() as conn:
+            conn.execute(text('CREATE TABLE rows (id INTEGER PRIMARY KEY, value TEXT)'))
+            conn.execute(text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 2000) "
+                              "INSERT INTO rows (value) SELECT printf('%.500c', 'x') FROM n"))
+            conn.commit()
+
+    def _pragma(self, name: str):
+        with self.engine.connect() as conn:
+            return conn.execute(text(f'PRAGMA {name}')).scalar()
+
+    def _delete_rows(self, above: int):
+        with self.engine.connect() as conn:
+            conn.execute(text(f'DELETE FROM rows WHERE id > {above}'))
+            conn.commit()
+
+    def test_connections_are_configured(self):
+        self.assertEqual('wal', self._pragma('journal_mode'))
+        self.assertEqual(2, self._pragma('auto_vacuum'))
+        self.assertEqual(1, self._pragma('synchronous'))
+
+    def test_run_frees_pages_above_threshold(self):
+        self._delete_rows(above=1000)
+        self.assertGreater(self._pragma('freelist_count'), 0)
+
+        self.subject.run()
+
+        self.assertEqual(0, self._pragma('freelist_count'))
+
+    def test_run_leaves_pages_below_threshold(self):
+        self._delete_rows(above=1900)
+        free_pages = self._pragma('freelist_count')
+        self.assertGreater(free_pages, 0)
+
+        self.subject.run()
+
+        self.assertEqual(free_pages, self._pragma('freelist_count'))
+
+    def test_prepare_converts_existing_database(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as conn:
+            conn.execute(text('CREATE TABLE rows (id INTEGER PRIMARY KEY)'))
+            conn.commit()
+        self.assertEqual(0, self._pragma_of(engine, 'auto_vacuum'))
+
+        maintenance = SqliteMaintenance(engine)
+        maintenance.prepare()
+
+        self.assertEqual(2, self._pragma_of(engine, 'auto_vacuum'))
+
+    @staticmethod
+    def _pragma_of(engine, name: str):
+        with engine.connect() as conn:
+            return conn.execute(text(f'PRAGMA {name}')).scalar()
+
+
+if __name__ == '__main__':
+    unittest.main()
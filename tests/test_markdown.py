@@ -0,0 +1,58 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from bs4 import BeautifulSoup
+
+from reddit.markdown import RedditMarkdownConverter, UnsupportedMarkup
+from reddit.reader import RedditReader
+from tests import get_test_data
+
+# Output of the markdownify-based converter for every body in these pages, see reddit_markdown_golden.json
+GOLDEN_PAGES = ['today_i_learned.html', 'today_i_learned_thread.html', 'reddit_markdown.html']
+
+
+class RedditMarkdownConverterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reader = RedditReader()
+        self.reader.logger = mock.Mock()
+        self.subject = RedditMarkdownConverter('https://old.reddit.com')
+        with open(os.path.join(os.path.dirname(__file__), 'data', 'reddit_markdown_golden.json')) as golden:
+            self.golden = json.load(golden)
+
+    @staticmethod
+    def _bodies(page: str):
+        return BeautifulSoup(get_test_data(page), 'html.parser').select('.md')
+
+    def test_matches_golden_output(self):
+        for page in GOLDEN_PAGES:
+            bodies = self._bodies(page)
+            self.assertEqual(len(self.golden[page]), len(bodies))
+            for index, (body, expected) in enumerate(zip(bodies, self.golden[page])):
+                with self.subTest(page=page, body=index):
+                    self.assertEqual(expected, self.reader._html_node_to_markdown(body))
+
+    def test_reddit_markup_does_not_fall_back(self):
+        with mock.patch('reddit.reader.markdownify', side_effect=AssertionError('Fell back to markdownify')):
+            for page in ['today_i_learned.html', 'today_i_learned_thread.html']:
+                for body in self._bodies(page):
+                    self.reader._html_node_to_markdown(body)
+
+    def test_unsupported_markup_falls_back(self):
+        body = self._bodies('reddit_markdown.html')[-1]
+        self.assertRaises(UnsupportedMarkup, self.subject.convert, body)
+
+        self.assertEqual('Unsupported markup: underlined and `Ctrl`.\n\n', self.reader._html_node_to_markdown(body))
+
+    def test_does_not_modify_tree(self):
+        body = self._bodies('reddit_markdown.html')[1]
+        html = str(body)
+
+        self.subject.convert(body)
+
+        self.assertEqual(html, str(body))
+
+
+if __name__ == '__main__':
+    unittest.main()
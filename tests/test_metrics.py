@@ -0,0 +1,71 @@
+import unittest
+
+from utils.metrics import Metrics, DB_COMMIT, ERRORS, LEMMY_WRITE_RATE, POSTS_SYNCED
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subject = Metrics()
+        self.subject.enable()
+
+    def test_disabled_metrics_are_not_recorded(self):
+        subject = Metrics()
+
+        subject.inc(POSTS_SYNCED)
+        subject.observe(DB_COMMIT, 0.2, operation='prune')
+        with subject.time(DB_COMMIT, operation='prune'):
+            pass
+
+        self.assertNotIn(f'\n{POSTS_SYNCED} ', subject.render())
+        self.assertNotIn(f'\n{DB_COMMIT}_count', subject.render())
+
+    def test_renders_counters_per_label_set(self):
+        self.subject.inc(POSTS_SYNCED)
+        self.subject.inc(POSTS_SYNCED, 2)
+        self.subject.inc(ERRORS, phase='lemmy_post', type='HTTPError')
+
+        lines = self.subject.render().splitlines()
+
+        self.assertIn(f'# TYPE {POSTS_SYNCED} counter', lines)
+        self.assertIn(f'{POSTS_SYNCED} 3', lines)
+        self.assertIn(f'{ERRORS}{{phase="lemmy_post",type="HTTPError"}} 1', lines)
+
+    def test_renders_last_value_of_gauges(self):
+        self.subject.set(LEMMY_WRITE_RATE, 4)
+        self.subject.set(LEMMY_WRITE_RATE, 2.5)
+
+        lines = self.subject.render().splitlines()
+
+        self.assertIn(f'# TYPE {LEMMY_WRITE_RATE} gauge', lines)
+        self.assertIn(f'{LEMMY_WRITE_RATE} 2.5', lines)
+
+    def test_renders_cumulative_histogram_buckets(self):
+        self.subject.observe(DB_COMMIT, 0.003, operation='prune')
+        self.subject.observe(DB_COMMIT, 0.2, operation='prune')
+        self.subject.observe(DB_COMMIT, 60, operation='prune')
+
+        lines = self.subject.render().splitlines()
+
+        self.assertIn(f'# TYPE {DB_COMMIT} histogram', lines)
+        self.assertIn(f'{DB_COMMIT}_bucket{{operation="prune",le="0.001"}} 0', lines)
+        self.assertIn(f'{DB_COMMIT}_bucket{{operation="prune",le="0.005"}} 1', lines)
+        self.assertIn(f'{DB_COMMIT}_bucket{{operation="prune",le="0.25"}} 2', lines)
+        self.assertIn(f'{DB_COMMIT}_bucket{{operation="prune",le="30"}} 2', lines)
+        self.assertIn(f'{DB_COMMIT}_bucket{{operation="prune",le="+Inf"}} 3', lines)
+        self.assertIn(f'{DB_COMMIT}_count{{operation="prune"}} 3', lines)
+
+    def test_time_observes_even_when_raising(self):
+        with self.assertRaises(ValueError):
+            with self.subject.time(DB_COMMIT, operation='insert'):
+                raise ValueError()
+
+        self.assertIn(f'{DB_COMMIT}_count{{operation="insert"}} 1', self.subject.render().splitlines())
+
+    def test_escapes_label_values(self):
+        self.subject.inc(ERRORS, phase='a"b\\c')
+
+        self.assertIn(f'{ERRORS}{{phase="a\\"b\\\\c"}} 1', self.subject.render().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
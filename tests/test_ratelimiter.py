@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+
+from utils.ratelimiter import AdaptiveTokenBucket, TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('utils.ratelimiter.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.monotonic.side_effect = lambda: self.now
+        self.time.sleep.side_effect = self._sleep
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    def test_first_request_is_not_delayed(self):
+        subject = TokenBucket(interval=3)
+
+        self.assertEqual(0.0, subject.acquire())
+        self.time.sleep.assert_not_called()
+
+    def test_requests_are_spaced_by_interval(self):
+        subject = TokenBucket(interval=3)
+
+        waits = [subject.acquire() for _ in range(4)]
+
+        self.assertEqual([0.0, 3.0, 3.0, 3.0], waits)
+        self.assertEqual(1009.0, self.now)
+
+    def test_burst_is_saved_up_while_idle(self):
+        subject = TokenBucket(interval=2, burst=3)
+        subject.acquire()
+        subject.acquire()
+        subject.acquire()
+
+        self.now += 60
+
+        waits = [subject.acquire() for _ in range(4)]
+
+        self.assertEqual([0.0, 0.0, 0.0, 2.0], waits)
+
+    def test_time_spent_elsewhere_counts_towards_the_interval(self):
+        subject = TokenBucket(interval=3)
+        subject.acquire()
+
+        self.now += 2
+
+        self.assertEqual(1.0, subject.acquire())
+
+    def test_zero_interval_disables_limiting(self):
+        subject = TokenBucket(interval=0)
+
+        self.assertEqual([0.0] * 5, [subject.acquire() for _ in range(5)])
+        self.time.sleep.assert_not_called()
+
+    def test_adaptive_rate_is_cut_and_held_back_when_throttled(self):
+        subject = AdaptiveTokenBucket(max_rate=4)
+
+        self.assertEqual(2.0, subject.throttled(retry_after=5))
+        # Others that were underway when it happened don't cut it again
+        self.assertEqual(2.0, subject.throttled())
+
+        self.assertEqual(5.0, subject.acquire())
+        self.assertEqual(0.5, subject.acquire())
+
+    def test_adaptive_rate_rises_while_requests_go_through(self):
+        subject = AdaptiveTokenBucket(max_rate=4, step=0.5)
+        subject.throttled()
+        self.now += 1
+
+        self.assertEqual(2.5, subject.succeeded())
+        self.now += 10
+        self.assertEqual(4.0, subject.succeeded())
+
+    def test_unlimited_adaptive_rate_is_cut_from_the_rate_requests_were_sent_at(self):
+        subject = AdaptiveTokenBucket()
+        for _ in range(11):
+            subject.acquire()
+            self.now += 0.1
+
+        self.assertEqual(0.0, subject.rate)
+        self.assertAlmostEqual(5.0, subject.throttled())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
+import json
 import pprint
 import unittest
+from datetime import datetime, timezone
 from unittest import mock
 from unittest.mock import MagicMock
 
-from models.models import CommunityDTO
+from bs4 import BeautifulSoup
+
+from models.models import CommentDTO, FeedDTO, PostDTO, SORT_HOT
 from reddit.reader import RedditReader
 from tests import get_test_data
 
@@ -24,6 +28,7 @@ class RedditReaderTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+    @unittest.skip('Not part of the Leddit reader')
     def test_get_subreddit_info(self):
         body = get_test_data('today_i_learned.html')
         self.subject.is_sub_nsfw = mock.Mock()
@@ -45,9 +50,11 @@ class RedditReaderTestCase(unittest.TestCase):
         self.subject.is_sub_nsfw.assert_called_once_with('todayilearned')
         self.subject._request.assert_called_once_with('GET', 'https://old.reddit.com/r/todayilearned/')
 
+    @unittest.skip('Not part of the Leddit reader')
     def test_is_sub_nsfw(self):
         self.assertTrue(RedditReader.is_sub_nsfw('gonewildaudio'))
 
+    @unittest.skip('Not part of the Leddit reader')
     def test_get_subreddit_ident(self):
         tests = [
             ['https://www.reddit.com/r/explainlikelimfive', 'explainlikelimfive'],
@@ -61,3 +68,248 @@ class RedditReaderTestCase(unittest.TestCase):
             except ValueError as e:
                 ident = str(e)
             self.assertEqual(expected, ident)
+
+    def test_get_subreddit_topics(self):
+        self.subject._request.return_value = MagicMock(status_code=200, text=get_test_data('today_i_learned.rss'))
+
+        posts = self.subject.get_subreddit_topics('todayilearned')
+
+        self.subject._request.assert_called_once_with('GET', 'https://www.reddit.com/r/todayilearned/new/.rss?sort=new')
+        self.assertEqual(25, len(posts))
+        self.assertEqual('/u/user0', posts[0].author)
+
+    def test_get_grouped_topics(self):
+        # Every other entry comes from another subreddit, which is also written differently in the community map
+        feed = get_test_data('today_i_learned.rss').split('<entry>')
+        for number in range(2, len(feed), 2):
+            feed[number] = feed[number].replace('term="todayilearned"', 'term="AskHistorians"')
+        self.subject._request.return_value = MagicMock(status_code=200, text='<entry>'.join(feed))
+
+        topics = self.subject.get_grouped_topics(['todayilearned', 'askhistorians', 'quiet'], mode=SORT_HOT)
+
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://www.reddit.com/r/todayilearned+askhistorians+quiet/.rss?limit=100'
+        )
+        self.assertEqual(['todayilearned', 'askhistorians', 'quiet'], list(topics))
+        self.assertEqual(13, len(topics['todayilearned']))
+        self.assertEqual(12, len(topics['askhistorians']))
+        self.assertEqual([], topics['quiet'])
+        self.assertEqual('/u/user1', topics['askhistorians'][0].author)
+
+    def test_get_subreddit_topics_stops_at_mark(self):
+        self.subject._request.return_value = MagicMock(status_code=200, text=get_test_data('today_i_learned.rss'),
+                                                       headers={'ETag': '"v1"'})
+        link = 'https://www.reddit.com/r/todayilearned/comments/14c003x/til_the_eiffel_tower_can_be_15_cm/'
+        feed = FeedDTO(marks={'TodayILearned': (datetime(2023, 6, 18, 6, 50, 12, tzinfo=timezone.utc), link)})
+
+        posts = self.subject.get_subreddit_topics('todayilearned', feed=feed)
+
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://www.reddit.com/r/todayilearned/new/.rss?sort=new', headers={}
+        )
+        self.assertEqual(['/u/user0', '/u/user1', '/u/user2'], [post.author for post in posts])
+        self.assertEqual('"v1"', feed.etag)
+        self.assertIsNotNone(feed.fingerprint)
+
+    def test_get_subreddit_topics_unchanged_feed(self):
+        self.subject._request.return_value = MagicMock(status_code=200, text=get_test_data('today_i_learned.rss'),
+                                                       headers={'ETag': '"v1"'})
+        feed = FeedDTO()
+        self.subject.get_subreddit_topics('todayilearned', feed=feed)
+
+        # Reddit didn't honour the validators, but sent the same posts
+        self.assertIsNone(self.subject.get_subreddit_topics('todayilearned', feed=feed))
+        self.subject._request.assert_called_with(
+            'GET', 'https://www.reddit.com/r/todayilearned/new/.rss?sort=new', headers={'If-None-Match': '"v1"'}
+        )
+
+        self.subject._request.return_value = MagicMock(status_code=304)
+        self.assertIsNone(self.subject.get_grouped_topics(['todayilearned', 'askhistorians'], feed=feed))
+
+    def test_get_comment_details(self):
+        soup = BeautifulSoup(get_test_data('today_i_learned_thread.html'), "html.parser")
+
+        comments = self.subject.get_comment_details(soup)
+
+        self.assertEqual([
+            CommentDTO(id='jod1a1a', created=datetime(2023, 6, 17, 19, 30, tzinfo=timezone.utc), author='alice',
+                       body='Six hundred servants?\n\n* one\n* two\n', parent='14bzcv9', post_id='14bzcv9'),
+            CommentDTO(id='deleted-14bzcv9-1687031100', created=datetime(2023, 6, 17, 19, 45, tzinfo=timezone.utc), author='[deleted]',
+                       body='*This comment was deleted before it could be archived.*\n\n', parent='14bzcv9',
+                       post_id='14bzcv9'),
+            CommentDTO(id='jod6f6f', created=datetime(2023, 6, 17, 22, 0, tzinfo=timezone.utc), author='erin',
+                       body='Code: `print(1)`\n\n```\nx = 2\n\n```\n', parent='14bzcv9', post_id='14bzcv9'),
+            CommentDTO(id='jod2b2b', created=datetime(2023, 6, 17, 19, 58, 40, tzinfo=timezone.utc), author='Flares117',
+                       body='It was *also* built on **waqf** land.\n\n> \n> Quote from the article\n> \n> \n> \n\n',
+                       parent='jod1a1a', post_id='14bzcv9'),
+            CommentDTO(id='jod3c3c', created=datetime(2023, 6, 17, 20, 2, 11, tzinfo=timezone.utc), author='[deleted]',
+                       body='Account deleted, comment kept.\n\n', parent='jod1a1a', post_id='14bzcv9'),
+            CommentDTO(id='jod4d4d', created=datetime(2023, 6, 17, 20, 41, 2, tzinfo=timezone.utc), author='carol_',
+                       body='Source: [the wiki](https://old.reddit.com/r/todayilearned/wiki/rules) and '
+                            '[Mumbai](https://en.wikipedia.org/wiki/Mumbai).\n\n',
+                       parent='jod2b2b', post_id='14bzcv9'),
+            CommentDTO(id='jod5e5e', created=datetime(2023, 6, 17, 21, 15, tzinfo=timezone.utc), author='dave',
+                       body='Replying to a ghost.\n\n', parent='14bzcv9', post_id='14bzcv9'),
+        ], comments)
+
+    def test_get_comment_details_parents_come_first(self):
+        soup = BeautifulSoup(get_test_data('today_i_learned_thread.html'), "html.parser")
+
+        comments = self.subject.get_comment_details(soup)
+
+        seen = {'14bzcv9'}
+        for comment in comments:
+            self.assertIn(comment.parent, seen)
+            seen.add(comment.id)
+
+    def _thread_post(self, **kwargs) -> PostDTO:
+        return PostDTO(reddit_link='https://www.reddit.com/r/todayilearned/comments/14bzcv9/til/', title='Unused',
+                       created=datetime(2023, 6, 17), updated=datetime(2023, 6, 17), author='/u/Flares117', **kwargs)
+
+    def _respond(self, thread: str, more_children: str, deep_thread: str):
+        """Answer requests for the thread, the comments behind 'load more comments' and the rest of a deep thread"""
+        things = json.loads(more_children)['json']['data']['things']
+
+        def request(method, url, params=None, headers=None):
+            if url == 'https://old.reddit.com/api/morechildren.json':
+                # Like Reddit, return the requested comments with their replies
+                loaded = set(params['children'].split(','))
+                answer = []
+                for thing in things:
+                    if (thing['kind'] == 't1' and thing['data']['id'] in loaded) or thing['data']['parent_id'][3:] in loaded:
+                        loaded.add(thing['data']['id'])
+                        answer.append(thing)
+                return MagicMock(status_code=200, text=json.dumps({'json': {'errors': [], 'data': {'things': answer}}}))
+            if url.rstrip('/').endswith(('jod7g7g', 'jod6f6f', 'jod6f6f/.json')):
+                return MagicMock(status_code=200, text=deep_thread, headers={})
+            return MagicMock(status_code=200, text=thread, headers={})
+
+        self.subject._request.side_effect = request
+
+    def test_get_post_details_loads_hidden_comments(self):
+        self._respond(get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_more_children.json'),
+                      get_test_data('today_i_learned_deep_thread.html'))
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual([
+            ('jod1a1a', '14bzcv9'), ('deleted-14bzcv9-1687031100', '14bzcv9'), ('jod6f6f', '14bzcv9'), ('jod2b2b', 'jod1a1a'),
+            ('jod3c3c', 'jod1a1a'), ('jod4d4d', 'jod2b2b'), ('jod5e5e', '14bzcv9'),
+            ('jod9z9z', 'jod2b2b'), ('jod9y9y', 'jod9z9z'), ('jod8y8y', 'jod2b2b'),
+            ('jodaaaa', '14bzcv9'), ('jodbbbb', '14bzcv9'), ('jodcccc', '14bzcv9'),
+            ('jod7g7g', 'jod6f6f'), ('jod7h7h', 'jod7g7g'),
+        ], [(comment.id, comment.parent) for comment in comments])
+        self.assertEqual('Very *late*\n\n', comments[12].body)
+        # One batch for all hidden comments, one for what those hid, and one page for the deep thread
+        self.assertEqual(4, self.subject._request.call_count)
+        self.assertEqual({'api_type': 'json', 'link_id': 't3_14bzcv9', 'limit_children': 'false', 'raw_json': 1,
+                          'children': 'jodaaaa,jodbbbb,jodcccc,jod9z9z,jod8y8y'},
+                         self.subject._request.call_args_list[1].kwargs['params'])
+        self.assertEqual('joddddd', self.subject._request.call_args_list[2].kwargs['params']['children'])
+        self.assertIsNotNone(post.fingerprint)
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_BATCH_SIZE', 2)
+    def test_hidden_comments_are_loaded_in_batches(self):
+        self._respond(get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_more_children.json'),
+                      get_test_data('today_i_learned_deep_thread.html'))
+
+        _, comments = self.subject.get_post_details(self._thread_post())
+
+        batches = [call.kwargs['params']['children'] for call in self.subject._request.call_args_list
+                   if call.kwargs.get('params')]
+        self.assertEqual(['jodaaaa,jodbbbb', 'jodcccc,jod9z9z', 'jod8y8y,joddddd'], batches)
+        self.assertEqual(15, len(comments))
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 1)
+    def test_post_is_read_again_while_comments_stay_hidden(self):
+        self._respond(get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_more_children.json'),
+                      get_test_data('today_i_learned_deep_thread.html'))
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual(2, self.subject._request.call_count)
+        self.assertEqual(13, len(comments))
+        self.assertIsNone(post.fingerprint)
+        self.assertIsNone(post.etag)
+
+    def test_post_is_synced_when_hidden_comments_fail_to_load(self):
+        self._respond(get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_more_children.json'),
+                      get_test_data('today_i_learned_deep_thread.html'))
+        respond = self.subject._request.side_effect
+        self.subject._request.side_effect = lambda method, url, **kwargs: \
+            MagicMock(status_code=429, headers={}) if 'morechildren' in url else respond(method, url, **kwargs)
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual(2, self.subject._request.call_count)
+        # The comments on the page are synced, and the post is read again next time for the rest
+        self.assertEqual(7, len(comments))
+        self.assertIsNone(post.fingerprint)
+        self.subject.logger.warning.assert_called_once()
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_DEPTH', 1)
+    def test_hidden_comments_are_only_expanded_up_to_the_depth(self):
+        self._respond(get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_more_children.json'),
+                      get_test_data('today_i_learned_deep_thread.html'))
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual(3, self.subject._request.call_count)
+        self.assertEqual(15, len(comments))
+        self.assertIsNotNone(post.fingerprint)
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_get_post_details_sets_fingerprint(self):
+        body = get_test_data('today_i_learned_thread.html')
+        self.subject._request.return_value = MagicMock(status_code=200, text=body, headers={'ETag': '"abc"'})
+
+        post, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual(7, len(comments))
+        self.assertEqual(RedditReader.get_page_fingerprint(body), post.fingerprint)
+        self.assertTrue(post.fingerprint.startswith('9:'))
+        self.assertEqual('"abc"', post.etag)
+        self.assertIsNone(post.last_modified)
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://old.reddit.com/r/todayilearned/comments/14bzcv9/til/', headers={}
+        )
+
+    def test_get_post_details_skips_unchanged_page(self):
+        body = get_test_data('today_i_learned_thread.html')
+        self.subject._request.return_value = MagicMock(status_code=200, text=body, headers={})
+        self.subject.get_comment_details = mock.Mock()
+
+        post, comments = self.subject.get_post_details(
+            self._thread_post(fingerprint=RedditReader.get_page_fingerprint(body))
+        )
+
+        self.assertIsNone(comments)
+        self.subject.get_comment_details.assert_not_called()
+
+    def test_get_post_details_sends_conditional_headers(self):
+        self.subject._request.return_value = MagicMock(status_code=304)
+
+        post, comments = self.subject.get_post_details(
+            self._thread_post(fingerprint='9:abc', etag='"abc"', last_modified='Sat, 17 Jun 2023 20:00:00 GMT')
+        )
+
+        self.assertIsNone(comments)
+        self.assertEqual('9:abc', post.fingerprint)
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://old.reddit.com/r/todayilearned/comments/14bzcv9/til/',
+            headers={'If-None-Match': '"abc"', 'If-Modified-Since': 'Sat, 17 Jun 2023 20:00:00 GMT'}
+        )
+
+    def test_page_fingerprint_changes_with_new_comments(self):
+        body = get_test_data('today_i_learned_thread.html')
+        new_comment = body.replace('id="thing_t1_jod5e5e"', 'id="thing_t1_jod5e5f"')
+
+        self.assertNotEqual(RedditReader.get_page_fingerprint(body), RedditReader.get_page_fingerprint(new_comment))
+
+    def test_page_fingerprint_changes_with_edited_comments(self):
+        body = get_test_data('today_i_learned_thread.html')
+        edited_comment = body.replace('Six hundred servants?', 'Six hundred servants!')
+        new_score = body.replace('12 points', '13 points')
+
+        self.assertNotEqual(RedditReader.get_page_fingerprint(body), RedditReader.get_page_fingerprint(edited_comment))
+        self.assertEqual(RedditReader.get_page_fingerprint(body), RedditReader.get_page_fingerprint(new_score))
@@ -0,0 +1,120 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from utils.scheduler import Scheduler, WorkItem, PRIORITY_FEED, PRIORITY_POSTS, PRIORITY_PRUNE
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subject = Scheduler()
+        self.subject._logger = mock.Mock()
+        self.now = datetime(2023, 6, 17, 12)
+        self.runs = []
+
+    def _item(self, name: str, priority: int, minutes: float, again: float = None) -> WorkItem:
+        def action():
+            self.runs.append(name)
+            return self.now + timedelta(minutes=again) if again is not None else None
+
+        return WorkItem('test', name, priority, self.now + timedelta(minutes=minutes), action)
+
+    def _run_due(self):
+        while item := self.subject.next_item(self.now):
+            self.subject.run_item(item, self.now)
+
+    def test_due_items_run_by_priority_then_deadline(self):
+        self.subject.add(self._item('prune', PRIORITY_PRUNE, -30))
+        self.subject.add(self._item('old posts', PRIORITY_POSTS, -20))
+        self.subject.add(self._item('new posts', PRIORITY_POSTS, -10))
+        self.subject.add(self._item('feed', PRIORITY_FEED, -1))
+        self.subject.add(self._item('later feed', PRIORITY_FEED, 5))
+
+        self._run_due()
+
+        self.assertEqual(['feed', 'old posts', 'new posts', 'prune'], self.runs)
+
+    def test_items_run_again_at_the_deadline_they_return(self):
+        self.subject.add(self._item('feed', PRIORITY_FEED, 0, again=60))
+
+        self._run_due()
+        self._run_due()
+        self.now += timedelta(minutes=60)
+        self._run_due()
+
+        self.assertEqual(['feed', 'feed'], self.runs)
+
+    def test_failing_item_is_retried_later(self):
+        item = WorkItem('feed', 'todayilearned', PRIORITY_FEED, self.now, mock.Mock(side_effect=ValueError()))
+        self.subject.add(item)
+
+        self._run_due()
+
+        item.action.assert_called_once()
+        self.assertGreater(item.deadline, datetime.utcnow() + Scheduler.RETRY_DELAY - timedelta(seconds=5))
+        self.subject._logger.exception.assert_called_once()
+
+    def test_run_finishes_current_item_after_stop(self):
+        def stop():
+            self.runs.append('stop')
+            self.subject.stop()
+            return datetime.utcnow()
+
+        self.subject.add(WorkItem('feed', 'first', PRIORITY_FEED, datetime.utcnow(), stop))
+        self.subject.add(WorkItem('feed', 'second', PRIORITY_FEED, datetime.utcnow(), stop))
+
+        self.subject.run()
+
+        self.assertEqual(['stop'], self.runs)
+        self.assertTrue(self.subject.stopping)
+
+
+    def test_run_calls_before_next_before_every_item(self):
+        def before_next():
+            self.runs.append('before')
+            if len(self.runs) == 1:
+                self.subject.add(WorkItem('feed', 'added', PRIORITY_FEED, datetime.utcnow(), stop))
+
+        def stop():
+            self.runs.append('added')
+            self.subject.stop()
+
+        self.subject = Scheduler(before_next=before_next)
+        self.subject.add(WorkItem('posts', 'later', PRIORITY_POSTS, datetime.utcnow() + timedelta(hours=1), stop))
+
+        self.subject.run()
+
+        self.assertEqual(['before', 'added'], self.runs)
+
+    def test_wake_stops_sleeping_until_the_next_deadline(self):
+        def before_next():
+            self.runs.append('before')
+            if len(self.runs) == 1:
+                self.subject.wake()
+            else:
+                self.subject.stop()
+
+        self.subject = Scheduler(before_next=before_next)
+        self.subject.add(WorkItem('feed', 'later', PRIORITY_FEED, datetime.utcnow() + timedelta(hours=1), mock.Mock()))
+        started = datetime.utcnow()
+
+        self.subject.run()
+
+        self.assertEqual(['before', 'before'], self.runs)
+        self.assertLess(datetime.utcnow() - started, timedelta(seconds=5))
+
+    def test_run_stops_when_stop_comes_in_after_the_wakeup_was_cleared(self):
+        # Like a signal handler calling stop() right after run() cleared the wakeup
+        self.subject._before_next = self.subject._stopping.set
+        self.subject.add(WorkItem('feed', 'later', PRIORITY_FEED, datetime.utcnow() + timedelta(hours=1), mock.Mock()))
+
+        runner = threading.Thread(target=self.subject.run, daemon=True)
+        runner.start()
+        runner.join(timeout=5)
+
+        self.assertFalse(runner.is_alive())
+        self.subject.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime
+from unittest import mock
+from unittest.mock import MagicMock
+
+from models.models import PostDTO
+from reddit.reader import RedditReader
+from reddit.stream_reader import RedditStreamReader
+from tests import get_test_data
+
+
+class RedditStreamReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subject = RedditStreamReader()
+        self.subject.logger = mock.Mock()
+        self.subject._request = mock.Mock()
+
+    @staticmethod
+    def _thread_post() -> PostDTO:
+        return PostDTO(reddit_link='https://www.reddit.com/r/todayilearned/comments/14bzcv9/til/', title='Unused',
+                       created=datetime(2023, 6, 17), updated=datetime(2023, 6, 17), author='/u/Flares117')
+
+    def _read(self, reader: RedditReader, thread: str):
+        reader._request = mock.Mock(return_value=MagicMock(status_code=200, text=thread, headers={}))
+        return reader.get_post_details(self._thread_post())
+
+    def _assert_parents_first(self, comments):
+        seen = {'14bzcv9'}
+        for comment in comments:
+            self.assertIn(comment.parent, seen | {'jod0x0x'})  # The parent of jod5e5e was deleted
+            seen.add(comment.id)
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_get_post_details_reads_the_same_as_the_whole_page(self):
+        thread = get_test_data('today_i_learned_thread.html')
+        expected_post, expected_comments = self._read(RedditReader(), thread)
+
+        post, comments = self._read(self.subject, thread)
+
+        self.assertEqual(expected_post, post)
+        self.assertEqual(sorted(expected_comments, key=lambda comment: comment.id),
+                         sorted(comments, key=lambda comment: comment.id))
+        # Thread by thread, and within a thread level by level
+        self.assertEqual(['jod1a1a', 'jod2b2b', 'jod3c3c', 'jod4d4d', 'deleted-14bzcv9-1687031100', 'jod5e5e', 'jod6f6f'],
+                         [comment.id for comment in comments])
+        self._assert_parents_first(comments)
+        self.subject.logger.warning.assert_not_called()
+
+    def test_get_post_details_loads_hidden_comments_from_thread_pages(self):
+        thread, deep_thread = get_test_data('today_i_learned_thread.html'), get_test_data('today_i_learned_deep_thread.html')
+        nothing_more = '{"json": {"errors": [], "data": {"things": []}}}'
+        self.subject._request.side_effect = lambda method, url, **kwargs: MagicMock(
+            status_code=200, headers={},
+            text=nothing_more if 'morechildren' in url else deep_thread if 'jod7g7g' in url else thread)
+
+        _, comments = self.subject.get_post_details(self._thread_post())
+
+        self.assertEqual(['jod7g7g', 'jod7h7h'], [comment.id for comment in comments][-2:])
+        self.assertEqual('jod6f6f', comments[-2].parent)
+
+    @mock.patch('reddit.reader.MORE_COMMENTS_REQUESTS', 0)
+    def test_page_that_cannot_be_split_is_read_as_a_whole(self):
+        thread = get_test_data('today_i_learned_thread.html')
+        # Cut off in the middle of the comments
+        thread = thread[:thread.index('id="thing_t1_jod6f6f"')]
+
+        _, comments = self._read(self.subject, thread)
+
+        self.subject.logger.warning.assert_called_once()
+        self.assertIn('jod1a1a', [comment.id for comment in comments])
+
+    def test_split_comment_area(self):
+        thread = get_test_data('today_i_learned_thread.html')
+
+        post_id, area_start, threads = RedditStreamReader._split_comment_area(thread)
+
+        self.assertEqual('14bzcv9', post_id)
+        self.assertTrue(thread[area_start:].startswith('<div id="siteTable_t3_14bzcv9"'))
+        for start, end in threads:
+            self.assertTrue(thread[start:end].startswith('<div'))
+            self.assertTrue(thread[start:end].endswith('</div>'))
@@ -1,160 +1,717 @@
+import hashlib
+import itertools
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import List
+from unittest import mock
 from unittest.mock import MagicMock
 
 from requests import HTTPError, Response
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
 
-from lemmy.api import LemmyAPI
+from models.models import Base, Comment, CommentDTO, Community, FeedMark, Lease, Post, SORT_HOT, SORT_NEW, body_hash
 from reddit.reader import RedditReader
-from models.models import SORT_NEW
-from tests import TEST_COMMUNITY, TEST_POSTS, LEMMY_POST_RETURN
+from tests import TEST_COMMUNITY, TEST_POSTS
+from utils import syncer as syncer_module
+from utils.leases import Leases
 from utils.syncer import Syncer
 
 
 class SyncerTestCase(unittest.TestCase):
     def setUp(self):
-        # Set up the necessary mock objects
-        self.db_session = MagicMock(spec=Session)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.db_session = sessionmaker(bind=engine)()
         self.reddit_reader = MagicMock(spec=RedditReader)
-        self.lemmy_api = MagicMock(spec=LemmyAPI)
 
-        # Create a Syncer instance for testing
-        self.syncer = Syncer(db=self.db_session, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.object(syncer_module, 'Lemmy'), \
+                mock.patch.object(syncer_module, 'WRITE_JOURNAL', os.path.join(directory.name, 'journal.jsonl')):
+            self.syncer = Syncer(db=self.db_session, reddit_reader=self.reddit_reader, username='user', password='pass')
         self.syncer._logger = MagicMock(spec=logging.Logger)
+        self.lemmy_api = self.syncer._lemmy
+
+        self.lemmy_api.community.get.side_effect = \
+            lambda name: {'community_view': {'community': {'id': 665, 'name': name}}}
+        lemmy_ids = itertools.count(100)
+        self.lemmy_api.post.create.side_effect = lambda **kwargs: self._lemmy_post(next(lemmy_ids))
+        self.lemmy_api.comment.create.side_effect = \
+            lambda **kwargs: {'comment_view': {'comment': {'id': next(lemmy_ids)}}}
+
+        patcher = mock.patch.object(syncer_module.config, 'community_map', [TEST_COMMUNITY])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _lemmy_post(lemmy_id: int) -> dict:
+        return {'post_view': {'post': {'ap_id': f'https://lem.my/post/{lemmy_id}', 'id': lemmy_id}}}
+
+    @staticmethod
+    def _posts():
+        return [replace(post) for post in TEST_POSTS]
+
+    def _add_post(self, lemmy_id: int = 1, created: datetime = None) -> Post:
+        now = datetime.utcnow()
+        db_post = Post(id=lemmy_id, community_id=665, reddit_link=f'https://red.dit/{lemmy_id}',
+                       lemmy_link=f'https://lem.my/post/{lemmy_id}', created=created or now, updated=now,
+                       author='/u/user1', enabled=1, next_update_at=now, update_interval=3600)
+        self.db_session.add(db_post)
+        self.db_session.commit()
+        return db_post
+
+    @staticmethod
+    def _comment(comment_id: str, parent: str, post_id: str = '1') -> CommentDTO:
+        return CommentDTO(id=comment_id, created=datetime(2023, 6, 17, 21), author='user2', body='Body',
+                          parent=parent, post_id=post_id)
 
     def test_scrape_new_posts(self):
         """Happy path"""
-        # Mock the necessary objects
-        self.reddit_reader.get_subreddit_topics.return_value = TEST_POSTS
+        self.reddit_reader.get_subreddit_topics.return_value = self._posts()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
 
-        # Mock the return value of self.next_scrape_community
-        self.syncer.next_scrape_community = MagicMock(return_value=TEST_COMMUNITY)
+        self.syncer.scrape_new_posts()
 
-        # Call the method being tested
+        self.reddit_reader.get_subreddit_topics.assert_called_once_with('test_subreddit', mode=SORT_NEW, feed=mock.ANY)
+        self.assertEqual(self.lemmy_api.post.create.call_count, len(TEST_POSTS))
+        self.assertEqual(len(TEST_POSTS), self.db_session.query(Post).count())
+        self.syncer._logger.error.assert_not_called()
+
+    def test_scrape_new_posts_reads_grouped_feeds(self):
+        communities = [dict(TEST_COMMUNITY, subreddit=f'sub{number}', community=f'com{number}',
+                            sort=SORT_HOT if number == 2 else SORT_NEW) for number in range(4)]
+        posts = self._posts()
+        self.reddit_reader.get_grouped_topics.return_value = {'sub0': posts[:1], 'sub1': [], 'sub3': posts[1:]}
+        self.reddit_reader.get_subreddit_topics.return_value = []
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+
+        with mock.patch.object(syncer_module.config, 'community_map', communities), \
+                mock.patch.object(syncer_module, 'FEED_GROUP_SIZE', 3):
+            self.syncer.scrape_new_posts()
+
+        self.reddit_reader.get_grouped_topics.assert_called_once_with(['sub0', 'sub1', 'sub3'], mode=SORT_NEW,
+                                                                      feed=mock.ANY)
+        self.reddit_reader.get_subreddit_topics.assert_called_once_with('sub2', mode=SORT_HOT, feed=mock.ANY)
+        # sub1 and sub2 have no new posts, so their communities aren't needed
+        self.assertEqual(['com0', 'com3'],
+                         [call.kwargs['name'] for call in self.lemmy_api.community.get.call_args_list])
+        self.assertEqual(len(TEST_POSTS), self.lemmy_api.post.create.call_count)
+        self.syncer._logger.error.assert_not_called()
+
+    def test_log_in_is_reused_across_rounds(self):
+        self.reddit_reader.get_subreddit_topics.return_value = self._posts()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+
+        self.syncer.update_comments()
         self.syncer.scrape_new_posts()
+        self.syncer.update_comments()
+
+        self.lemmy_api.log_in.assert_called_once_with('user', 'pass')
+
+    def test_log_in_again_after_failed_write(self):
+        self._add_post()
+        self.lemmy_api.post.create.side_effect = None
+        self.lemmy_api.post.create.return_value = None
+
+        self.syncer.update_comments()
+        self.syncer.clone_to_lemmy(self._posts()[0], 'test_subreddit', 665, '##### Test header')
+        self.syncer.update_comments()
+
+        self.assertEqual(2, self.lemmy_api.log_in.call_count)
+
+    def test_failed_log_in_stops_update(self):
+        self.lemmy_api.log_in.return_value = False
+        self.syncer.clear_aged = MagicMock()
+
+        self.syncer.update_comments()
+
+        self.syncer.clear_aged.assert_not_called()
+        self.syncer._logger.error.assert_called_once()
+
+    def test_community_id_is_saved(self):
+        self.assertEqual(665, self.syncer.get_community_id('test_community'))
+        self.assertEqual(665, self.syncer.get_community_id('test_community'))
+
+        self.lemmy_api.community.get.assert_called_once_with(name='test_community')
+        self.assertEqual(665, self.db_session.get(Community, 'test_community').id)
+
+    def test_community_id_is_refreshed_when_old(self):
+        self.db_session.add(Community(name='test_community', id=664, resolved_at=datetime.utcnow() - timedelta(days=2)))
+        self.db_session.commit()
+
+        self.assertEqual(665, self.syncer.get_community_id('test_community'))
+
+        self.assertEqual(665, self.db_session.get(Community, 'test_community').id)
+
+    def test_old_community_id_is_used_when_lemmy_fails(self):
+        self.db_session.add(Community(name='test_community', id=664, resolved_at=datetime.utcnow() - timedelta(days=2)))
+        self.db_session.commit()
+        self.lemmy_api.community.get.side_effect = None
+        self.lemmy_api.community.get.return_value = None
+
+        self.assertEqual(664, self.syncer.get_community_id('test_community'))
+        self.assertIsNone(self.syncer.get_community_id('unknown_community'))
 
-        # Assert that the appropriate methods were called with the expected arguments
-        self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
-        self.lemmy_api.create_post.assert_called()
+    def test_feed_groups(self):
+        communities = [dict(TEST_COMMUNITY, subreddit=str(number), sort=SORT_HOT if number % 3 else SORT_NEW)
+                       for number in range(7)]
 
-        # Assert that the expected number of posts were created
-        self.assertEqual(self.lemmy_api.create_post.call_count, len(TEST_POSTS))
-        self.syncer._logger.assert_not_called()
+        with mock.patch.object(syncer_module, 'FEED_GROUP_SIZE', 2):
+            groups = Syncer.feed_groups(communities)
+
+        self.assertEqual([['0', '3'], ['1', '2'], ['4', '5'], ['6']],
+                         [[com['subreddit'] for com in group] for group in groups])
 
     def test_scrape_new_posts_get_subreddit_topics_error_fails_gracefully(self):
-        # Mock the necessary objects
         self.reddit_reader.get_subreddit_topics.side_effect = HTTPError("Error")
 
-        # Mock the return value of self.next_scrape_community
-        self.syncer.next_scrape_community = MagicMock(return_value=TEST_COMMUNITY)
-
-        # Call the method being tested
         self.syncer.scrape_new_posts()
 
-        # Assert that the appropriate methods were called with the expected arguments
-        self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
-        self.lemmy_api.create_post.assert_not_called()
+        self.reddit_reader.get_subreddit_topics.assert_called_once_with('test_subreddit', mode=SORT_NEW, feed=mock.ANY)
+        self.lemmy_api.post.create.assert_not_called()
         self.syncer._logger.error.assert_called_once()
 
     def test_scrape_new_posts_get_post_details_error_fails_gracefully(self):
-        # Mock the necessary objects
-        self.reddit_reader.get_subreddit_topics.return_value = TEST_POSTS
+        self.reddit_reader.get_subreddit_topics.return_value = self._posts()
         self.reddit_reader.get_post_details.side_effect = HTTPError("Error")
 
-        # Mock the return value of self.next_scrape_community
-        self.syncer.next_scrape_community = MagicMock(return_value=TEST_COMMUNITY)
-
-        # Call the method being tested
         self.syncer.scrape_new_posts()
 
-        # Assert that the appropriate methods were called with the expected arguments
-        self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
         self.syncer._logger.error.assert_called_once()
-
-        # Assert nothing else is done
-        self.lemmy_api.create_post.assert_not_called()
+        self.lemmy_api.post.create.assert_not_called()
 
     def test_clone_to_lemmy_success(self):
-        # Mock the necessary objects
-        post = TEST_POSTS[0]
-        community = TEST_COMMUNITY
+        post = self._posts()[0]
 
-        # Mock the return values
-        self.syncer.prepare_post.return_value = post
-        self.lemmy_api.create_post.return_value = LEMMY_POST_RETURN
+        post = self.syncer.clone_to_lemmy(post, 'test_subreddit', 665, '##### Test header')
+        self.syncer._writes.flush()
 
-        # Call the method being tested
-        self.syncer.clone_to_lemmy(post, community)
-
-        # DB thinks everything is okay.
-        self.db_session.add.return_value = None
-        self.db_session.commit.return_value = None
-
-        # Assert that the appropriate methods were called with the expected arguments
-        self.lemmy_api.create_post.assert_called_once_with(
-            community_id=community.lemmy_id,
+        self.lemmy_api.post.create.assert_called_once_with(
+            community_id=665,
             name=post.title,
             body=post.body,
             url=post.external_link,
             nsfw=post.nsfw
         )
-        self.db_session.add.assert_called_once()
-        self.db_session.commit.assert_called_once()
+        self.assertEqual(100, post.lemmy_id)
+        db_post = self.db_session.query(Post).one()
+        self.assertEqual(('https://red.dit/1', 'https://lem.my/post/100'), (db_post.reddit_link, db_post.lemmy_link))
 
     def test_clone_to_lemmy_exception_in_create_post(self):
-        # Mock the necessary objects
-        post = TEST_POSTS[1]
-        community = TEST_COMMUNITY
-
-        # Mock the return value of self.prepare_post
-        self.syncer.prepare_post.return_value = post
-
-        # Mock an exception to be raised by self._lemmy.create_post
+        post = self._posts()[1]
         response = Response()
         response.status_code = 500
-        self.lemmy_api.create_post.side_effect = HTTPError("Error", response=response)
+        self.lemmy_api.post.create.side_effect = HTTPError("Error", response=response)
 
-        # Call the method being tested
-        self.syncer.clone_to_lemmy(post, community)
+        self.syncer.clone_to_lemmy(post, 'test_subreddit', 665, '##### Test header')
+        self.syncer._writes.flush()
 
-        # Assert that the appropriate methods were called with the expected arguments
-        self.lemmy_api.create_post.assert_called_once_with(
+        self.lemmy_api.post.create.assert_called_once_with(
             community_id=665,
             name='post 2',
             body=post.body,
             url='https://nope',
             nsfw=False
         )
-        self.syncer._logger.error.assert_called_once_with('HTTPError trying to post https://red.dit/2: Error: None')
-        self.db_session.add.assert_not_called()
-        self.db_session.commit.assert_not_called()
-
-    def test_clone_to_lemmy_timeout_is_ignored(self):
-        # Mock the necessary objects
-        post = TEST_POSTS[1]
-        community = TEST_COMMUNITY
-
-        # Mock the return value of self.prepare_post
-        self.syncer.prepare_post.return_value = post
-
-        # Mock an exception to be raised by self._lemmy.create_post
-        response = MagicMock()
-        response.status_code = 504
-        response.text = b'<html>\r\n<head><title>504 Gateway Time-out</title></head>\r\n<body>\r\n<center><h1>504 ' \
-                        b'Gateway Time-out</h1></center>\r\n<hr><center>openresty</center>\r\n</body>\r\n</html>\r\n'
-        self.lemmy_api.create_post.side_effect = HTTPError(
-            '504 Server Error: Gateway Time-out for url: https://foo.bar/api/v3/post', response=response
-        )
+        self.syncer._logger.error.assert_called_once_with(
+            'Something went horribly wrong when posting https://red.dit/2: Error')
+        self.assertEqual(0, self.db_session.query(Post).count())
+
+    def test_clone_to_lemmy_finds_post_that_got_no_answer(self):
+        post = self._posts()[1]
+        self.lemmy_api.post.create.side_effect = None
+        self.lemmy_api.post.create.return_value = None
+        self.lemmy_api.post.list.side_effect = lambda **kwargs: [
+            {'post': {'id': 7, 'ap_id': 'https://lem.my/post/7', 'body': 'Another post'}},
+            {'post': {'id': 8, 'ap_id': 'https://lem.my/post/8', 'body': post.body}},
+        ]
+
+        post = self.syncer.clone_to_lemmy(post, 'test_subreddit', 665, '##### Test header')
+        self.syncer._writes.flush()
 
-        # Call the method being tested
-        self.syncer.clone_to_lemmy(post, community)
-
-        # Ensure logs and write to Database
         self.syncer._logger.warning.assert_called_once()
-        self.db_session.add.assert_called()
-        self.db_session.commit.assert_called()
+        self.assertEqual(8, post.lemmy_id)
+        self.assertEqual([(8, 'https://lem.my/post/8')], self.db_session.query(Post.id, Post.lemmy_link).all())
+
+    def test_clone_to_lemmy_without_answer_or_post_fails(self):
+        post = self._posts()[1]
+        self.lemmy_api.post.create.side_effect = None
+        self.lemmy_api.post.create.return_value = None
+        self.lemmy_api.post.list.return_value = []
+
+        self.assertIsNone(self.syncer.clone_to_lemmy(post, 'test_subreddit', 665, '##### Test header'))
+        self.syncer._writes.flush()
+
+        self.lemmy_api.post.list.assert_called_once()
+        self.assertEqual(0, self.db_session.query(Post).count())
+
+    def test_clone_comments_to_lemmy_posts_replies_to_their_parents(self):
+        post = replace(TEST_POSTS[0], lemmy_id=self._add_post().id)
+        self.db_session.add(Comment(id=50, reddit_id='old', created=datetime.utcnow(), post_id=1))
+        self.db_session.commit()
+        comments = [self._comment('c1', '1'), self._comment('c2', 'c1'), self._comment('c3', 'old'),
+                    self._comment('c4', 'missing')]
+
+        synced = self.syncer.clone_comments_to_lemmy(post, comments)
+
+        self.assertFalse(synced)  # The parent of c4 is unknown
+        parents = [call.kwargs['parent_id'] for call in self.lemmy_api.comment.create.call_args_list]
+        self.assertEqual([None, 100, 50], parents)
+        self.assertEqual({'old': 50, 'c1': 100, 'c2': 101, 'c3': 102},
+                         {comment.reddit_id: comment.id for comment in self.db_session.query(Comment)})
+
+    def test_clone_comments_to_lemmy_posts_concurrently_after_parents(self):
+        post = replace(TEST_POSTS[0], lemmy_id=self._add_post().id)
+        comments = [self._comment(f'c{number}', '1') for number in range(4)]
+        comments += [self._comment(f'{parent.id}r{number}', parent.id) for parent in comments for number in range(3)]
+        comments += [self._comment(f'{parent.id}r', parent.id) for parent in comments[4:]]
+        lock = threading.Lock()
+        lemmy_ids = {}  # By Reddit ID, once Lemmy answered
+        created = []  # Reddit ID and parent ID of every comment sent to Lemmy
+        running = [0, 0]  # Comments being posted, and most at once
+
+        def create(content: str, post_id: int, parent_id: int = None) -> dict:
+            reddit_id = syncer_module._COMMENT_MARKER.match(content).group(1)
+            with lock:
+                created.append((reddit_id, parent_id))
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+                lemmy_ids[reddit_id] = 100 + len(lemmy_ids)
+                return {'comment_view': {'comment': {'id': lemmy_ids[reddit_id]}}}
+
+        self.lemmy_api.comment.create.side_effect = create
+        self.syncer._comment_pool = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.syncer._comment_pool.shutdown)
+        with mock.patch.object(syncer_module, 'COMMENT_WORKERS', 4):
+            synced = self.syncer.clone_comments_to_lemmy(post, comments)
+
+        self.assertTrue(synced)
+        self.assertGreater(running[1], 1)
+        self.assertEqual(sorted(comment.id for comment in comments), sorted(reddit_id for reddit_id, _ in created))
+        # Lemmy gives out an ID when it answers, so a reply with its parent's ID was sent after the parent was posted
+        parents = {comment.id: comment.parent for comment in comments}
+        self.assertEqual({reddit_id: lemmy_ids.get(parents[reddit_id]) for reddit_id, _ in created}, dict(created))
+        self.assertEqual(lemmy_ids, {comment.reddit_id: comment.id for comment in self.db_session.query(Comment)})
+
+    def test_clone_comments_to_lemmy_skips_replies_to_failed_comments(self):
+        post = replace(TEST_POSTS[0], lemmy_id=self._add_post().id)
+        response = Response()
+        response.status_code = 500
+        self.lemmy_api.comment.create.side_effect = HTTPError("Error", response=response)
+
+        synced = self.syncer.clone_comments_to_lemmy(post, [self._comment('c1', '1'), self._comment('c2', 'c1')])
+
+        self.assertFalse(synced)
+        self.lemmy_api.comment.create.assert_called_once()
+        self.assertEqual(0, self.db_session.query(Comment).count())
+
+    def test_clone_comments_to_lemmy_finds_comments_that_got_no_answer(self):
+        post = replace(TEST_POSTS[0], lemmy_id=self._add_post().id)
+        created = {}
+
+        def create(content, post_id, parent_id):
+            # Lemmy makes every comment, but the answers get lost
+            created[100 + len(created)] = content
+
+        self.lemmy_api.comment.create.side_effect = create
+        self.lemmy_api.comment.list.side_effect = lambda **kwargs: [
+            {'comment': {'id': comment_id, 'content': content}} for comment_id, content in created.items()
+            if 'ID: `c2`' not in content
+        ]
+        comments = [self._comment('c1', '1'), self._comment('c2', 'c1'), self._comment('c3', '1')]
+
+        synced = self.syncer.clone_comments_to_lemmy(post, comments)
+
+        self.assertFalse(synced)  # c2 wasn't found, so it's tried again next round
+        # c1 and c3 are looked up together, c2 once it could be posted as a reply to c1
+        self.assertEqual(2, self.lemmy_api.comment.list.call_count)
+        self.assertEqual(100, self.lemmy_api.comment.create.call_args_list[2].kwargs['parent_id'])
+        self.assertEqual({'c1': 100, 'c3': 101},
+                         {comment.reddit_id: comment.id for comment in self.db_session.query(Comment)})
+
+    def test_update_comments_edits_changed_comments(self):
+        db_post = self._add_post()
+        db_post.body_hash = body_hash(None)
+        self.db_session.add_all([Comment(id=50, reddit_id='c1', created=datetime.utcnow(), post_id=1,
+                                         body_hash=body_hash('Old body')),
+                                 Comment(id=51, reddit_id='c2', created=datetime.utcnow(), post_id=1,
+                                         body_hash=body_hash('Body')),
+                                 # Synced before bodies were hashed
+                                 Comment(id=52, reddit_id='c3', created=datetime.utcnow(), post_id=1),
+                                 # Hashed from the markdown, which differs between reader backends
+                                 Comment(id=53, reddit_id='c4', created=datetime.utcnow(), post_id=1,
+                                         body_hash=hashlib.sha1(b'Body').hexdigest())])
+        self.db_session.commit()
+        comments = [replace(self._comment(comment_id, '1'), body_hash=body_hash('Body'))
+                    for comment_id in ('c1', 'c2', 'c3', 'c4')]
+        self.reddit_reader.get_post_details.side_effect = \
+            lambda post: (replace(post, body_hash=body_hash(None), fingerprint='3:abc'), comments)
+
+        self.syncer.update_comments()
+
+        self.lemmy_api.comment.edit.assert_called_once()
+        self.assertEqual(50, self.lemmy_api.comment.edit.call_args.args[0])
+        self.assertIn('ID: `c1`', self.lemmy_api.comment.edit.call_args.kwargs['content'])
+        self.lemmy_api.post.edit.assert_not_called()
+        self.lemmy_api.comment.create.assert_not_called()
+        self.assertEqual({body_hash('Body')}, {hashed for hashed, in self.db_session.query(Comment.body_hash)})
+        self.assertEqual('3:abc', db_post.fingerprint)
+
+    def test_update_comments_edits_changed_post(self):
+        db_post = self._add_post()
+        db_post.body_hash = body_hash('Old body')
+        self.db_session.commit()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (
+            replace(post, reddit_link='https://old.reddit.com/r/test_subreddit/comments/1/post/', body='New body',
+                    body_hash=body_hash('New body')), [])
+
+        self.syncer.update_comments()
+
+        self.lemmy_api.post.edit.assert_called_once()
+        self.assertEqual(1, self.lemmy_api.post.edit.call_args.args[0])
+        self.assertTrue(self.lemmy_api.post.edit.call_args.kwargs['body'].startswith('##### Test header'))
+        self.assertTrue(self.lemmy_api.post.edit.call_args.kwargs['body'].endswith('New body'))
+        self.assertEqual(body_hash('New body'), db_post.body_hash)
+
+    def test_failed_edit_is_tried_again(self):
+        self._add_post()
+        self.db_session.add(Comment(id=50, reddit_id='c1', created=datetime.utcnow(), post_id=1,
+                                    body_hash=body_hash('Old body')))
+        self.db_session.commit()
+        self.lemmy_api.comment.edit.return_value = None
+        self.reddit_reader.get_post_details.side_effect = \
+            lambda post: (replace(post, fingerprint='1:abc'),
+                          [replace(self._comment('c1', '1'), body_hash=body_hash('Body'))])
+
+        self.syncer.update_comments()
+
+        self.assertEqual(body_hash('Old body'), self.db_session.get(Comment, 50).body_hash)
+        self.assertIsNone(self.db_session.get(Post, 1).fingerprint)
+
+    def test_update_comments_saves_page_validators_once_synced(self):
+        db_post = self._add_post()
+        validators = ('1:abc', '"v1"', 'Sat, 17 Jun 2023 21:00:00 GMT')
+        self.reddit_reader.get_post_details.side_effect = lambda post: (
+            replace(post, fingerprint=validators[0], etag=validators[1], last_modified=validators[2]),
+            [self._comment('c1', '1')])
+
+        self.syncer.update_comments()
+
+        self.assertEqual(validators, (db_post.fingerprint, db_post.etag, db_post.last_modified))
+        # The page is only read again if it changed since
+        db_post.next_update_at = datetime.utcnow()
+        self.db_session.commit()
+        self.syncer.update_comments()
+        post = self.reddit_reader.get_post_details.call_args.args[0]
+        self.assertEqual(validators, (post.fingerprint, post.etag, post.last_modified))
+
+    def test_update_comments_skips_unchanged_posts(self):
+        db_post = self._add_post()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, None)
+
+        self.syncer.update_comments()
+
+        self.lemmy_api.comment.create.assert_not_called()
+        self.assertEqual(7200, db_post.update_interval)
+        self.assertGreater(db_post.next_update_at, datetime.utcnow())
+
+    def test_update_comments_only_reads_due_posts_and_speeds_up_busy_ones(self):
+        busy = self._add_post(1)
+        self._add_post(2).next_update_at = datetime.utcnow() + timedelta(hours=1)
+        self.db_session.commit()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [self._comment('c1', '1')])
+
+        with mock.patch.object(syncer_module, 'MIN_UPDATE_INTERVAL', 900):
+            self.syncer.update_comments()
+
+        self.reddit_reader.get_post_details.assert_called_once()
+        self.assertEqual(busy.reddit_link, self.reddit_reader.get_post_details.call_args.args[0].reddit_link)
+        self.assertEqual(1800, busy.update_interval)
+        self.assertAlmostEqual(datetime.utcnow() + timedelta(seconds=1800), busy.next_update_at,
+                               delta=timedelta(seconds=60))
+
+    def test_new_post_starts_at_min_update_interval(self):
+        self.reddit_reader.get_subreddit_topics.return_value = self._posts()[:1]
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+
+        with mock.patch.object(syncer_module, 'MIN_UPDATE_INTERVAL', 900):
+            self.syncer.scrape_new_posts()
+
+        db_post = self.db_session.query(Post).one()
+        self.assertEqual(900, db_post.update_interval)
+        self.assertAlmostEqual(datetime.utcnow() + timedelta(seconds=900), db_post.next_update_at,
+                               delta=timedelta(seconds=60))
+
+    def test_update_due_posts_saves_queued_rows_at_the_end(self):
+        self._add_post()
+        # Left queued by a flush that failed
+        self.syncer._writes.add(Comment(id=50, reddit_id='c1', created=datetime.utcnow(), post_id=1))
+
+        self.syncer.update_due_posts()
+
+        self.assertEqual(['c1'], [comment.reddit_id for comment in self.db_session.query(Comment)])
+
+    def test_update_due_posts_takes_longest_waiting_first(self):
+        for lemmy_id in (1, 2, 3):
+            self._add_post(lemmy_id).next_update_at = datetime.utcnow() - timedelta(minutes=lemmy_id)
+        self.db_session.commit()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, None)
+
+        checked = self.syncer.update_due_posts(limit=2)
+
+        self.assertEqual(2, checked)
+        self.assertEqual([3, 2], [call.args[0].lemmy_id for call in self.reddit_reader.get_post_details.call_args_list])
+        self.assertEqual(self.db_session.get(Post, 1).next_update_at, self.syncer.next_update_due())
+
+    def test_update_due_posts_backs_off_after_fetch_error(self):
+        db_post = self._add_post()
+        self.reddit_reader.get_post_details.side_effect = HTTPError('Error')
+
+        self.syncer.update_due_posts()
+
+        self.assertGreater(db_post.next_update_at, datetime.utcnow())
+        self.syncer._logger.error.assert_called_once()
+
+    def test_update_due_posts_skips_posts_of_other_workers(self):
+        for lemmy_id in (1, 2):
+            self._add_post(lemmy_id).next_update_at = datetime.utcnow() - timedelta(minutes=lemmy_id)
+        self.db_session.commit()
+        other_worker = Leases(self.db_session, 'worker2')
+        other_worker.claim('post:2', 60)
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, None)
 
+        checked = self.syncer.update_due_posts()
+
+        self.assertEqual(1, checked)
+        self.assertEqual([1], [call.args[0].lemmy_id for call in self.reddit_reader.get_post_details.call_args_list])
+        # Its own lease is given up once the post is done
+        self.assertTrue(other_worker.claim('post:1', 60))
+
+    def test_update_due_posts_skips_posts_taken_over_while_the_batch_ran(self):
+        for lemmy_id in (1, 2):
+            self._add_post(lemmy_id).next_update_at = datetime.utcnow() - timedelta(minutes=lemmy_id)
+        self.db_session.commit()
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, None)
+        update_post = self.syncer._update_post
+
+        def slow_update(post, details, db_post):
+            # The first post takes longer than the leases, so another worker takes over the next one
+            Leases(self.db_session, 'worker2').claim('post:1', 60)
+            return update_post(post, details, db_post)
+
+        with mock.patch.object(syncer_module, 'LEASE_DURATION', 0), \
+                mock.patch.object(self.syncer, '_update_post', side_effect=slow_update) as updated:
+            self.syncer.update_due_posts()
+
+        self.assertEqual([2], [call.args[0].lemmy_id for call in updated.call_args_list])
+
+    def test_update_due_posts_keeps_no_write_transaction_open_while_posting(self):
+        self._add_post()
+        self.reddit_reader.get_post_details.side_effect = \
+            lambda post: (post, [self._comment('c1', post.reddit_link.split('/')[-1], post_id='1')])
+        dirty = []
+        self.lemmy_api.comment.create.side_effect = lambda **kwargs: dirty.append(bool(self.db_session.dirty)) or \
+            {'comment_view': {'comment': {'id': 100}}}
+
+        self.syncer.update_due_posts()
+
+        self.assertEqual([False], dirty)
+        self.assertGreater(self.db_session.get(Post, 1).next_update_at, datetime.utcnow())
+
+    def test_scrape_new_posts_skips_feeds_of_other_workers(self):
+        Leases(self.db_session, 'worker2').claim(f'feed:{SORT_NEW}:test_subreddit', 60)
+
+        self.syncer.scrape_new_posts()
+
+        self.reddit_reader.get_subreddit_topics.assert_not_called()
+        self.reddit_reader.get_grouped_topics.assert_not_called()
+
+    def test_scrape_new_posts_saves_marks(self):
+        posts = self._posts()
+        self.reddit_reader.get_subreddit_topics.return_value = posts
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+
+        self.syncer.scrape_new_posts()
+
+        feed = self.reddit_reader.get_subreddit_topics.call_args.kwargs['feed']
+        self.assertEqual({'test_subreddit': (posts[-1].updated, 'https://red.dit/3')}, feed.marks)
+        self.assertEqual([('test_subreddit', SORT_NEW, 'https://red.dit/3')],
+                         self.db_session.query(FeedMark.subreddit, FeedMark.sort, FeedMark.reddit_link).all())
+        # A worker that takes over the feed starts at the saved marks
+        self.assertEqual(['https://red.dit/3'],
+                         [link for _, link in self.syncer.load_feed(['test_subreddit'], SORT_NEW).marks.values()])
+
+    def test_scrape_new_posts_marks_stop_before_failed_post(self):
+        posts = self._posts()
+        self.reddit_reader.get_subreddit_topics.return_value = posts
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+        lemmy_ids = iter([100, None, 101])
+        self.lemmy_api.post.create.side_effect = \
+            lambda **kwargs: (lemmy_id := next(lemmy_ids)) and self._lemmy_post(lemmy_id)
+        self.lemmy_api.post.list.return_value = []
+
+        self.syncer.scrape_new_posts()
+
+        feed = self.reddit_reader.get_subreddit_topics.call_args.kwargs['feed']
+        self.assertEqual('https://red.dit/1', feed.marks['test_subreddit'][1])
+        # The whole feed is read again, so the failed post is retried
+        self.assertIsNone(feed.fingerprint)
+        self.assertEqual(2, self.db_session.query(Post).count())
+
+    def test_scrape_new_posts_unchanged_feed_skips_database(self):
+        self.reddit_reader.get_subreddit_topics.return_value = None
+        # The marks are loaded when the feed is first read
+        self.syncer.scrape_new_posts()
+        statements = []
+        event.listen(self.db_session.get_bind(), 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+
+        self.syncer.scrape_new_posts()
+
+        # Not even the lease on the feed is renewed
+        self.assertEqual([], statements)
+        self.lemmy_api.post.create.assert_not_called()
+
+    def test_scrape_new_posts_renews_feed_lease_before_it_runs_out(self):
+        self.reddit_reader.get_subreddit_topics.return_value = None
+        self.syncer.scrape_new_posts()
+        name = Syncer.feed_name([TEST_COMMUNITY])
+        self.syncer._feed_leases[name] = datetime.utcnow() + timedelta(seconds=syncer_module.LEASE_DURATION)
+
+        self.syncer.scrape_new_posts()
+
+        self.assertGreater(self.db_session.get(Lease, f'feed:{name}').expires_at,
+                           datetime.utcnow() + timedelta(seconds=syncer_module.SCRAPE_INTERVAL))
+        self.assertFalse(Leases(self.db_session, 'worker2').claim(f'feed:{name}', 60))
+
+    def test_forget_feed(self):
+        self.reddit_reader.get_subreddit_topics.return_value = []
+        self.syncer.scrape_new_posts()
+        name = Syncer.feed_name([TEST_COMMUNITY])
+
+        self.syncer.forget_feed(name)
+
+        self.assertNotIn(name, self.syncer._feeds)
+        # Another worker can read the feed right away
+        self.assertTrue(Leases(self.db_session, 'worker2').claim(f'feed:{name}', 60))
+
+    def test_next_update_due_without_posts(self):
+        self.assertIsNone(self.syncer.next_update_due())
+
+    def test_clear_aged(self):
+        self._add_post(1, created=datetime.utcnow() - timedelta(days=30))
+        self._add_post(2)
+        self.db_session.add_all([Comment(id=10, reddit_id='c1', created=datetime.utcnow(), post_id=1),
+                                 Comment(id=11, reddit_id='c2', created=datetime.utcnow(), post_id=2)])
+        self.db_session.commit()
+
+        self.syncer.clear_aged()
+
+        self.assertEqual([2], [post.id for post in self.db_session.query(Post)])
+        self.assertEqual(['c2'], [comment.reddit_id for comment in self.db_session.query(Comment)])
+
+    def _count_queries(self, keyword: str) -> List[str]:
+        """Collect the statements starting with keyword that are sent to the database from now on"""
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith(keyword):
+                statements.append(statement)
+
+        event.listen(self.db_session.get_bind(), 'before_cursor_execute', collect)
+        return statements
+
+    def test_filter_posted_looks_up_links_in_chunks(self):
+        now = datetime.utcnow()
+        self.db_session.add_all([Post(id=lemmy_id, community_id=665, reddit_link=f'https://red.dit/{lemmy_id}',
+                                      lemmy_link=f'https://lem.my/post/{lemmy_id}', created=now, updated=now,
+                                      author='/u/user1') for lemmy_id in range(250)])
+        self.db_session.commit()
+        posts = [replace(TEST_POSTS[0], reddit_link=f'https://red.dit/{lemmy_id}') for lemmy_id in range(200, 300)]
+        selects = self._count_queries('SELECT')
+
+        with mock.patch.object(syncer_module, '_QUERY_CHUNK_SIZE', 30):
+            new_posts = self.syncer.filter_posted(posts)
+
+        self.assertEqual([f'https://red.dit/{lemmy_id}' for lemmy_id in range(250, 300)],
+                         [post.reddit_link for post in new_posts])
+        self.assertEqual(4, len(selects))
+
+    def test_stored_comments_looks_up_ids_in_chunks(self):
+        self._add_post()
+        self.db_session.add_all([Comment(id=lemmy_id, reddit_id=f'c{lemmy_id}', created=datetime.utcnow(), post_id=1,
+                                         body_hash=f'hash{lemmy_id}') for lemmy_id in range(100)])
+        self.db_session.commit()
+        comments = [self._comment(f'c{lemmy_id}', '1') for lemmy_id in range(90, 110)]
+        selects = self._count_queries('SELECT')
+
+        with mock.patch.object(syncer_module, '_QUERY_CHUNK_SIZE', 7):
+            stored = self.syncer.stored_comments(comments)
+
+        self.assertEqual({f'c{lemmy_id}': (lemmy_id, f'hash{lemmy_id}') for lemmy_id in range(90, 100)}, stored)
+        self.assertEqual(3, len(selects))
+
+    def test_clear_aged_deletes_in_bulk(self):
+        for lemmy_id in range(1, 21):
+            self._add_post(lemmy_id, created=datetime.utcnow() - timedelta(days=30 if lemmy_id <= 15 else 0))
+        self.db_session.add_all([Comment(id=100 * post_id + number, reddit_id=f'c{post_id}_{number}',
+                                         created=datetime.utcnow(), post_id=post_id)
+                                 for post_id in range(1, 21) for number in range(10)])
+        self.db_session.commit()
+        deletes = self._count_queries('DELETE')
+        commits = []
+        event.listen(self.db_session, 'after_commit', lambda session: commits.append(session))
+
+        self.syncer.clear_aged()
+
+        # One statement for the comments and one for the posts, committed together
+        self.assertEqual(2, len(deletes))
+        self.assertEqual(1, len(commits))
+        self.assertEqual(list(range(16, 21)), [post.id for post in self.db_session.query(Post).order_by(Post.id)])
+        self.assertEqual(50, self.db_session.query(Comment).count())
+
+    def test_reschedule(self):
+        db_post = Post(created=datetime.utcnow(), update_interval=8000)
+
+        with mock.patch.object(syncer_module, 'MIN_UPDATE_INTERVAL', 3600), \
+                mock.patch.object(syncer_module, 'MAX_UPDATE_INTERVAL', 10000), \
+                mock.patch.object(syncer_module, 'MAX_POST_AGE', 86400):
+            Syncer.reschedule(db_post, new_comments=True)
+            self.assertEqual(4000, db_post.update_interval)
+            Syncer.reschedule(db_post, new_comments=True)
+            self.assertEqual(3600, db_post.update_interval)
+            Syncer.reschedule(db_post, new_comments=False)
+            Syncer.reschedule(db_post, new_comments=False)
+            self.assertEqual(10000, db_post.update_interval)
+
+        db_post = Post(created=datetime.utcnow() - timedelta(seconds=86000), update_interval=3600)
+        with mock.patch.object(syncer_module, 'MAX_POST_AGE', 86400):
+            Syncer.reschedule(db_post, new_comments=False)
+        self.assertLessEqual(db_post.next_update_at, db_post.created + timedelta(seconds=86400))
+
+
+    def test_aged_post_is_not_due_after_its_last_update(self):
+        self._add_post(1, created=datetime.utcnow() - timedelta(days=2))
+        self.reddit_reader.get_post_details.side_effect = lambda post: (post, [])
+
+        with mock.patch.object(syncer_module, 'MAX_POST_AGE', 86400):
+            self.assertEqual(1, self.syncer.update_due_posts())
+            self.assertEqual(0, self.syncer.update_due_posts())
+
+        self.reddit_reader.get_post_details.assert_called_once()
+        self.assertIsNone(self.db_session.get(Post, 1).next_update_at)
+        self.assertIsNone(self.syncer.next_update_due())
 
 if __name__ == '__main__':
     unittest.main()
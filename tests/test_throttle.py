@@ -0,0 +1,118 @@
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+
+from pythorhead import Lemmy
+from pythorhead import requestor as requestor_module
+from pythorhead.requestor import Request, Requestor
+from requests import Response
+
+from utils import throttle as throttle_module
+from utils.ratelimiter import AdaptiveTokenBucket
+from utils.throttle import LemmyThrottle
+
+
+class LemmyThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lemmy = MagicMock()
+        self.lemmy._requestor._auth.token = 'jwt'
+        self.lemmy._requestor._auth.api_url = 'https://lem.my/api/v3'
+        self.read = self.lemmy._requestor.api
+        self.limiter = MagicMock(spec=AdaptiveTokenBucket)
+        self.limiter.succeeded.return_value = 2.0
+        self.limiter.throttled.return_value = 1.0
+        self.subject = LemmyThrottle(self.lemmy, self.limiter, retries=2)
+        self.subject._session = MagicMock()
+        self.subject._logger = MagicMock()
+
+    @staticmethod
+    def _response(status: int, body: bytes = b'{"comment_view": {"comment": {"id": 7}}}', **headers) -> Response:
+        response = Response()
+        response.status_code = status
+        response._content = body
+        response.headers.update(headers)
+        return response
+
+    def test_writes_go_through_the_limiter(self):
+        self.subject._session.request.return_value = self._response(200)
+
+        answer = self.lemmy._requestor.api(Request.POST, '/comment', json={'content': 'Body'})
+
+        self.assertEqual({'comment_view': {'comment': {'id': 7}}}, answer)
+        self.subject._session.request.assert_called_once_with(
+            'POST', 'https://lem.my/api/v3/comment', headers=mock.ANY, json={'content': 'Body', 'auth': 'jwt'}
+        )
+        self.limiter.acquire.assert_called_once()
+        self.limiter.succeeded.assert_called_once()
+
+    def test_reads_go_through_pythorhead(self):
+        self.lemmy._requestor.api(Request.GET, '/comment/list', params={'post_id': 1})
+
+        self.read.assert_called_once_with(Request.GET, '/comment/list', params={'post_id': 1})
+        self.subject._session.request.assert_not_called()
+
+    def test_rejected_write_is_sent_again_after_retry_after(self):
+        self.subject._session.request.side_effect = [self._response(429, b'{}', **{'Retry-After': '3'}),
+                                                     self._response(200)]
+
+        answer = self.lemmy._requestor.api(Request.POST, '/comment', json={'content': 'Body'})
+
+        self.assertEqual(7, answer['comment_view']['comment']['id'])
+        self.limiter.throttled.assert_called_once_with(3.0)
+        self.assertEqual(2, self.limiter.acquire.call_count)
+
+    def test_write_that_timed_out_is_only_sent_again_when_it_is_an_edit(self):
+        self.subject._session.request.return_value = self._response(504, b'Gateway Time-out')
+
+        self.assertIsNone(self.lemmy._requestor.api(Request.POST, '/comment', json={'content': 'Body'}))
+        self.assertEqual(1, self.subject._session.request.call_count)
+
+        self.assertIsNone(self.lemmy._requestor.api(Request.PUT, '/comment', json={'comment_id': 7}))
+        # The first try, and the retries
+        self.assertEqual(1 + 3, self.subject._session.request.call_count)
+
+    def test_retry_after(self):
+        self.assertEqual(2.0, LemmyThrottle.retry_after(self._response(429, **{'Retry-After': '2'})))
+        self.assertEqual(0.0, LemmyThrottle.retry_after(
+            self._response(429, **{'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        ))
+        self.assertIsNone(LemmyThrottle.retry_after(self._response(429, **{'Retry-After': 'soon'})))
+        self.assertIsNone(LemmyThrottle.retry_after(self._response(502)))
+
+
+
+class PythorheadTestCase(unittest.TestCase):
+    """The throttle hooks into pythorhead's internals. These fail when a new version of pythorhead changes them"""
+
+    def setUp(self):
+        with mock.patch.object(requestor_module.requests, 'get', side_effect=OSError('No nodeinfo')):
+            self.lemmy = Lemmy('https://lem.my')
+        self.lemmy._requestor._auth.token = 'jwt'
+
+    def test_writes_of_pythorhead_go_through_the_throttle(self):
+        subject = LemmyThrottle(self.lemmy, MagicMock(spec=AdaptiveTokenBucket), retries=0)
+        subject._session = MagicMock()
+        subject._session.request.return_value.status_code = 200
+        subject._session.request.return_value.json.return_value = {'comment_view': {}}
+
+        self.assertEqual({'comment_view': {}}, self.lemmy.comment.create(post_id=1, content='Body'))
+
+        subject._session.request.assert_called_once_with(
+            'POST', 'https://lem.my/api/v3/comment', headers=mock.ANY,
+            json={'post_id': 1, 'content': 'Body', 'auth': 'jwt'}
+        )
+
+    def test_writes_are_sent_like_pythorhead_sends_them(self):
+        post = MagicMock(return_value=MagicMock(ok=True))
+        with mock.patch.dict(requestor_module.REQUEST_MAP, {Request.POST: post}):
+            Requestor.api(self.lemmy._requestor, Request.POST, '/comment', json={})
+
+        self.assertEqual(throttle_module._HEADERS, post.call_args.kwargs['headers'])
+
+    def test_pythorhead_that_works_differently_is_refused(self):
+        self.lemmy._requestor._auth = object()
+
+        self.assertRaises(TypeError, LemmyThrottle, self.lemmy, MagicMock(spec=AdaptiveTokenBucket), 0)
+
+if __name__ == '__main__':
+    unittest.main()